@@ -0,0 +1,409 @@
+"""
+Benchmark of the proxy forwarding path
+
+Start the proxy (RootAPI) in process against a SQLite (default) or a local Postgres database,
+register mock instances through RegistryAPI.post, stand up a mock supervisor,
+then drive load through /api/proxy for each proxy type and report
+RPS, latency percentiles, the proxy overhead (client latency minus the upstream duration in server-timing) and memory
+
+    python benchmarks/proxy.py --instances 3 --requests 2000 --concurrency 50 --output result.json
+
+--db postgresql uses the UTILMETA_PROXY_DB_* env vars, the databases should be ephemeral:
+the tables are migrated and the benchmark rows are written to them
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import re
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:     # pragma: no cover
+    resource = None
+
+try:
+    import psutil
+except ImportError:     # pragma: no cover
+    psutil = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROXY_TYPES = ('discovery', 'supervisor', 'operations', 'forward')
+SERVICE_NAME = 'bench-service'
+NODE_ID = 'bench-node'
+CLUSTER_ID = 'bench-cluster'
+SERVER_TIMING_PROXY = re.compile(r'(?:^|,)\s*proxy;dur=([\d.]+)')
+SERVER_TIMING_ENTRY = re.compile(r'(?:^|,)\s*([\w-]+);dur=([\d.]+)')
+
+
+# mock upstreams -------------------
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b'{}'
+    role = 'instance'
+
+    def respond(self):
+        length = int(self.headers.get('content-length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(self.body)))
+        self.send_header('x-mock-role', self.role)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(self.body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = do_OPTIONS = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_body(size: int) -> bytes:
+    # a JSON body of about the size
+    return json.dumps({'data': 'x' * max(size - 12, 0)}).encode()
+
+
+def serve_mocks(instance_ports: List[int], supervisor_port: int, payload_size: int, ready):
+    """
+    Serve the mock instances and the mock supervisor in a separate process,
+    so that they do not compete with the proxy for the GIL
+    """
+    import threading
+    servers = []
+    for port, role in [(p, 'instance') for p in instance_ports] + [(supervisor_port, 'supervisor')]:
+        handler = type('Handler', (MockHandler,), dict(body=make_body(payload_size), role=role))
+        server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        server.daemon_threads = True
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# measurements -------------------
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return round(values[index], 3)
+
+
+def summarize(values: List[float]) -> dict:
+    return dict(
+        mean=round(sum(values) / len(values), 3) if values else None,
+        p50=percentile(values, 50),
+        p95=percentile(values, 95),
+        p99=percentile(values, 99),
+        max=round(max(values), 3) if values else None,
+    )
+
+
+def get_memory() -> dict:
+    memory = {}
+    if psutil is not None:
+        memory['rss'] = psutil.Process().memory_info().rss
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        memory['peak_rss'] = peak if sys.platform == 'darwin' else peak * 1024
+    return memory
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.instance_ports = [get_free_port() for _ in range(args.instances)]
+        self.supervisor_port = get_free_port()
+        self.supervisor_url = f'http://127.0.0.1:{self.supervisor_port}'
+        self.workdir = tempfile.mkdtemp(prefix='utilmeta-proxy-bench-')
+        self.private_key = None
+        self.public_key = None
+        self.mocks = None
+
+    def start_mocks(self):
+        ready = multiprocessing.Event()
+        self.mocks = multiprocessing.Process(
+            target=serve_mocks,
+            args=(self.instance_ports, self.supervisor_port, self.args.payload_size, ready),
+            daemon=True
+        )
+        self.mocks.start()
+        if not ready.wait(10):
+            raise RuntimeError('mock upstreams failed to start')
+
+    def stop_mocks(self):
+        if self.mocks is not None:
+            self.mocks.terminate()
+            self.mocks.join(5)
+
+    def setup_env(self):
+        from utilmeta.ops.key import generate_key_pair
+        self.public_key, self.private_key = generate_key_pair(CLUSTER_ID)
+        environ = dict(
+            BASE_URL=f'http://127.0.0.1:{get_free_port()}/api',
+            SUPERVISOR_BASE_URL=self.supervisor_url,
+            SUPERVISOR_CLUSTER_ID=CLUSTER_ID,
+            SUPERVISOR_CLUSTER_KEY=self.public_key,
+            PRODUCTION='false',
+            PRIVATE='false',
+            HEALTH_CHECK_INTERVAL='0',
+            WORKERS='1',
+        )
+        if self.args.db == 'sqlite3':
+            environ.update(DB_ENGINE='sqlite3', DB_USER='', DB_PASSWORD='')
+        for key, value in environ.items():
+            os.environ[f'UTILMETA_PROXY_{key}'] = value
+        # SQLite database files are created in the work dir
+        os.chdir(self.workdir)
+        sys.path.insert(0, ROOT_DIR)
+        sys.path.insert(0, os.path.join(ROOT_DIR, 'utilmeta_proxy'))
+
+    def migrate(self):
+        from django.core.management import call_command
+        from utilmeta.ops.config import Operations
+        call_command('migrate', database='default', verbosity=0)
+        Operations.config().migrate(with_default=False)
+
+    def seed(self):
+        """
+        The instance resources are created by the supervisor sync of the instances,
+        the supervisor is created by the connect of the proxy, both are prepared here
+        """
+        from utilmeta.ops.models import Resource, Supervisor
+        from utilmeta_proxy.domain.service.models import Service, Instance, ServiceNameRecord
+        Instance.objects.filter(service__name=SERVICE_NAME).delete()
+        ServiceNameRecord.objects.filter(name=SERVICE_NAME).delete()
+        Service.objects.filter(name=SERVICE_NAME).delete()
+        Resource.objects.filter(service=SERVICE_NAME, type='instance').delete()
+        Supervisor.objects.filter(node_id=NODE_ID).delete()
+
+        Supervisor.objects.create(
+            service=SERVICE_NAME,
+            node_id=NODE_ID,
+            base_url=self.supervisor_url,
+            public_key=self.public_key,
+            ops_api=f'http://127.0.0.1:{self.instance_ports[0]}/api/ops',
+        )
+        resources = []
+        for i, port in enumerate(self.instance_ports):
+            address = f'127.0.0.1:{port}'
+            resources.append(Resource.objects.create(
+                type='instance',
+                service=SERVICE_NAME,
+                node_id=NODE_ID,
+                ident=address,
+                route=f'instance/{address}',
+                remote_id=f'bench-instance-{i}',
+            ))
+        return resources
+
+    async def register(self, client, resources) -> int:
+        registered = 0
+        for res in resources:
+            resp = await client.post('/api/registry', json=dict(
+                name=SERVICE_NAME,
+                address=res.ident,
+                base_url='/api',
+                ops_api='/api/ops',
+                instance_id=str(res.pk),
+                version='1.0.0',
+                asynchronous=True,
+                production=False,
+                language='python',
+                utilmeta_version='2.8.0',
+                backend='starlette',
+            ))
+            if resp.status_code != 200:
+                raise RuntimeError(f'register instance: {res.ident} failed: {resp.status_code} {resp.text}')
+            registered += 1
+        return registered
+
+    def make_token(self, expires: int = 3600) -> str:
+        from jwcrypto import jwk, jwt
+        token = jwt.JWT(header={'alg': 'RS256'}, claims={
+            'iss': self.supervisor_url,
+            'aud': CLUSTER_ID,
+            'nid': NODE_ID,
+            'exp': int(time.time()) + expires,
+        })
+        token.make_signed_token(jwk.JWK.from_json(self.private_key))
+        return token.serialize()
+
+    def get_headers(self, proxy_type: str) -> Dict[str, str]:
+        headers = {'x-utilmeta-proxy-type': proxy_type}
+        if proxy_type == 'discovery':
+            headers['x-utilmeta-service-name'] = SERVICE_NAME
+        elif proxy_type == 'supervisor':
+            # request from the supervisor with the cluster token
+            headers['x-utilmeta-node-id'] = NODE_ID
+            headers['x-utilmeta-cluster-id'] = CLUSTER_ID
+            headers['proxy-authorization'] = f'Bearer {self.make_token()}'
+        elif proxy_type == 'operations':
+            # request from a client of the supervisor with the node token
+            headers['x-utilmeta-node-id'] = NODE_ID
+            headers['authorization'] = f'Bearer {self.make_token()}'
+        elif proxy_type == 'forward':
+            # request from an instance to its supervisor
+            headers['x-utilmeta-node-id'] = NODE_ID
+        return headers
+
+    async def run_load(self, client, proxy_type: str) -> dict:
+        args = self.args
+        headers = self.get_headers(proxy_type)
+        path = f'/api/proxy/{args.path.lstrip("/")}'
+        for _ in range(args.warmup):
+            await client.get(path, headers=headers)
+
+        latencies = []
+        overheads = []
+        phases: Dict[str, list] = {}
+        statuses: Dict[str, int] = {}
+        errors = 0
+        pending = iter(range(args.requests))
+        memory_before = get_memory()
+
+        async def worker():
+            nonlocal errors
+            for _ in pending:
+                started = time.perf_counter()
+                try:
+                    resp = await client.get(path, headers=headers)
+                except Exception as e:
+                    errors += 1
+                    statuses[type(e).__name__] = statuses.get(type(e).__name__, 0) + 1
+                    continue
+                latency = (time.perf_counter() - started) * 1000
+                status = str(resp.status_code)
+                statuses[status] = statuses.get(status, 0) + 1
+                if resp.status_code >= 400:
+                    errors += 1
+                    continue
+                latencies.append(latency)
+                server_timing = resp.headers.get('server-timing') or ''
+                match = SERVER_TIMING_PROXY.search(server_timing)
+                if match:
+                    overheads.append(max(latency - float(match.group(1)), 0))
+                for name, dur in SERVER_TIMING_ENTRY.findall(server_timing):
+                    if name != 'proxy':
+                        phases.setdefault(name, []).append(float(dur))
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        duration = time.perf_counter() - started
+        return dict(
+            type=proxy_type,
+            requests=args.requests,
+            succeeded=len(latencies),
+            errors=errors,
+            statuses=statuses,
+            duration=round(duration, 3),
+            rps=round(len(latencies) / duration, 2) if duration else None,
+            latency_ms=summarize(latencies),
+            overhead_ms=summarize(overheads),
+            phases_ms={name: summarize(values) for name, values in phases.items()},
+            memory=dict(before=memory_before, after=get_memory()),
+        )
+
+    async def drive(self, resources) -> dict:
+        import httpx
+        from utilmeta_proxy.main import app
+        from utilmeta_proxy.service.proxy.pool import upstream_pool
+        # in-process ASGI calls, the client IP is 127.0.0.1 (same host as the mock instances)
+        transport = httpx.ASGITransport(app=app, client=('127.0.0.1', 50000))
+        results = []
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url='http://127.0.0.1', timeout=60) as client:
+                registered = await self.register(client, resources)
+                for proxy_type in self.args.types:
+                    result = await self.run_load(client, proxy_type)
+                    print(f'{proxy_type}: {result["rps"]} rps, p50={result["latency_ms"]["p50"]}ms, '
+                          f'p99={result["latency_ms"]["p99"]}ms, overhead p50={result["overhead_ms"]["p50"]}ms, '
+                          f'errors={result["errors"]}', file=sys.stderr)
+                    results.append(result)
+        finally:
+            await upstream_pool.aclose()
+        return dict(registered=registered, results=results)
+
+    def run(self) -> dict:
+        self.start_mocks()
+        try:
+            self.setup_env()
+            from utilmeta_proxy import __version__
+            import utilmeta_proxy.config.service  # noqa: setup the service
+            self.migrate()
+            resources = self.seed()
+            outcome = asyncio.run(self.drive(resources))
+        finally:
+            self.stop_mocks()
+        return dict(
+            benchmark='proxy',
+            version=__version__,
+            timestamp=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            config=dict(
+                db=self.args.db,
+                instances=self.args.instances,
+                requests=self.args.requests,
+                concurrency=self.args.concurrency,
+                warmup=self.args.warmup,
+                payload_size=self.args.payload_size,
+                path=self.args.path,
+            ),
+            **outcome
+        )
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark of the utilmeta-proxy forwarding path')
+    parser.add_argument('--db', choices=['sqlite3', 'postgresql'], default='sqlite3',
+                        help='postgresql uses the UTILMETA_PROXY_DB_* env vars')
+    parser.add_argument('--instances', type=int, default=3, help='mock instances to register')
+    parser.add_argument('--requests', type=int, default=1000, help='requests of each proxy type')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=20, help='requests before measuring')
+    parser.add_argument('--payload-size', type=int, default=512, help='body size of the mock responses')
+    parser.add_argument('--path', default='bench', help='request path under /api/proxy/')
+    parser.add_argument('--types', type=lambda v: [t.strip() for t in v.split(',') if t.strip()],
+                        default=list(PROXY_TYPES), help=f'comma separated proxy types: {",".join(PROXY_TYPES)}')
+    parser.add_argument('--output', default=None, help='write the JSON result to the file instead of stdout')
+    return parser
+
+
+def main(argv: List[str] = None):
+    args = get_parser().parse_args(argv)
+    invalid = [t for t in args.types if t not in PROXY_TYPES]
+    if invalid:
+        raise SystemExit(f'invalid proxy types: {invalid}')
+    if args.instances < 1:
+        raise SystemExit('at least 1 instance is required')
+    # the benchmark runs in a temp work dir
+    output_path = os.path.abspath(args.output) if args.output else None
+    output = json.dumps(Benchmark(args).run(), indent=2)
+    if output_path:
+        with open(output_path, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import os
+
+# the service settings are loaded from the environment when the modules are imported,
+# the tests only need the settings to import them (the database is not connected)
+TEST_ENV = dict(
+    DJANGO_SECRET_KEY='test',
+    DB_ENGINE='sqlite3',
+    DB_USER='',
+    DB_PASSWORD='',
+    BASE_URL='http://127.0.0.1:8080/api',
+    SUPERVISOR_BASE_URL='https://api.utilmeta.com/cluster',
+    SUPERVISOR_CLUSTER_ID='test',
+    SUPERVISOR_CLUSTER_KEY='{}',
+    HEALTH_CHECK_INTERVAL='0',
+)
+
+for key, value in TEST_ENV.items():
+    os.environ.setdefault(f'UTILMETA_PROXY_{key}', value)
+
+# setup the django settings for the models
+import utilmeta_proxy.config.service  # noqa: E402,F401
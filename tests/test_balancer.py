@@ -0,0 +1,63 @@
+import pytest
+from collections import Counter
+from utilmeta_proxy.domain.service.models import Instance
+from utilmeta_proxy.service.proxy.balancer import LoadBalancer, SmoothWeightedRoundRobin
+from utilmeta_proxy.service.proxy.stats import StatsRegistry
+
+
+def make_balancer() -> SmoothWeightedRoundRobin:
+    return SmoothWeightedRoundRobin(stats=StatsRegistry(flush_interval=0))
+
+
+class TestSmoothWeightedRoundRobin:
+    def test_schedule(self):
+        # the sequence of nginx for the weights 5, 1, 1
+        assert SmoothWeightedRoundRobin.get_schedule([5, 1, 1]) == [0, 0, 1, 0, 2, 0, 0]
+
+    def test_schedule_reduced_by_gcd(self):
+        assert SmoothWeightedRoundRobin.get_schedule([200, 100]) == SmoothWeightedRoundRobin.get_schedule([2, 1])
+        assert SmoothWeightedRoundRobin.get_schedule([100, 100, 100]) == [0, 1, 2]
+
+    def test_schedule_max_cycle(self):
+        schedule = SmoothWeightedRoundRobin.get_schedule([997, 3, 1])
+        assert len(schedule) <= SmoothWeightedRoundRobin.MAX_CYCLE + 3
+        counts = Counter(schedule)
+        # every instance keeps a share
+        assert counts[1] and counts[2]
+        assert counts[0] > counts[1] > 0
+
+    def test_order_follows_weights(self):
+        balancer = make_balancer()
+        instances = [Instance(pk=1, weight=3), Instance(pk=2, weight=1)]
+        chosen = [balancer.order(instances)[0].pk for _ in range(8)]
+        assert Counter(chosen) == {1: 6, 2: 2}
+        # smooth: the heavier instance is not picked in a burst
+        assert chosen[:4] == [1, 1, 2, 1]
+
+    def test_order_fallback(self):
+        balancer = make_balancer()
+        instances = [Instance(pk=1, weight=1), Instance(pk=2, weight=1), Instance(pk=3, weight=1)]
+        for _ in range(3):
+            ordered = balancer.order(instances)
+            assert sorted(inst.pk for inst in ordered) == [1, 2, 3]
+
+    def test_candidate_sets(self):
+        balancer = make_balancer()
+        a, b, c = Instance(pk=1, weight=1), Instance(pk=2, weight=1), Instance(pk=3, weight=1)
+        assert [balancer.order([a, b])[0].pk for _ in range(2)] == [1, 2]
+        # another candidate set (like an instance ejected) has its own position
+        assert [balancer.order([a, c])[0].pk for _ in range(2)] == [1, 3]
+        assert balancer.order([a, b])[0].pk == 1
+
+    def test_max_schedules(self):
+        balancer = make_balancer()
+        balancer.MAX_SCHEDULES = 4
+        for pk in range(10):
+            balancer.order([Instance(pk=pk, weight=1), Instance(pk=pk + 100, weight=2)])
+        assert len(balancer.schedules) <= 4
+
+
+class TestLoadBalancer:
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            LoadBalancer()
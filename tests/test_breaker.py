@@ -0,0 +1,111 @@
+from utilmeta.core import response
+from utilmeta_proxy.service.proxy.breaker import BreakerRegistry, CLOSED, OPEN, HALF_OPEN
+
+OK = response.Response(status=200)
+UNAVAILABLE = response.Response(status=503)
+
+
+def make_registry(**kwargs) -> BreakerRegistry:
+    options = dict(failures=3, open_seconds=1, half_open_probes=1, slow_threshold=0)
+    options.update(kwargs)
+    return BreakerRegistry(**options)
+
+
+def elapse(registry: BreakerRegistry, pk: int):
+    # pass the open duration of the circuit
+    breaker = registry.breakers[pk]
+    breaker.opened -= breaker.open_duration
+
+
+class TestBreakerRegistry:
+    def test_closed(self):
+        registry = make_registry()
+        registry.record(1, OK)
+        assert registry.get_state(1) == CLOSED
+        assert 1 not in registry.breakers
+        assert registry.acquire(1)
+
+    def test_open_after_consecutive_failures(self):
+        registry = make_registry()
+        registry.record(1, UNAVAILABLE)
+        registry.record(1, UNAVAILABLE)
+        registry.record(1, OK)
+        # a success resets the consecutive failures
+        registry.record(1, UNAVAILABLE)
+        registry.record(1, UNAVAILABLE)
+        assert registry.get_state(1) == CLOSED
+        registry.record(1, None)
+        assert registry.get_state(1) == OPEN
+        assert not registry.acquire(1)
+
+    def test_filter(self):
+        from utilmeta_proxy.domain.service.models import Instance
+        registry = make_registry(failures=1)
+        a, b = Instance(pk=1), Instance(pk=2)
+        registry.record(1, UNAVAILABLE)
+        assert registry.filter([a, b]) == [b]
+
+    def test_half_open_probes(self):
+        registry = make_registry(failures=1, half_open_probes=2)
+        registry.record(1, UNAVAILABLE)
+        elapse(registry, 1)
+        assert registry.get_state(1) == HALF_OPEN
+        assert registry.acquire(1)
+        assert registry.acquire(1)
+        assert not registry.acquire(1)
+        # a request not sent returns its probe slot
+        registry.release(1)
+        assert registry.acquire(1)
+
+    def test_half_open_success_closes(self):
+        closed = []
+        registry = make_registry(failures=1)
+        registry.listeners.append(lambda pk, state, *args: closed.append((pk, state)))
+        registry.record(1, UNAVAILABLE)
+        elapse(registry, 1)
+        assert registry.acquire(1)
+        registry.record(1, OK)
+        assert registry.get_state(1) == CLOSED
+        assert closed == [(1, OPEN), (1, CLOSED)]
+
+    def test_half_open_failure_reopens_with_doubled_duration(self):
+        registry = make_registry(failures=1, open_seconds=1)
+        registry.record(1, UNAVAILABLE)
+        for duration in (2, 4, 8, 8):
+            elapse(registry, 1)
+            assert registry.acquire(1)
+            registry.record(1, UNAVAILABLE)
+            assert registry.get_state(1) == OPEN
+            # capped by MAX_OPEN_FACTOR
+            assert registry.breakers[1].open_duration == duration
+
+    def test_response_of_request_sent_before_open(self):
+        registry = make_registry(failures=1)
+        registry.record(1, UNAVAILABLE)
+        registry.record(1, OK)
+        assert registry.get_state(1) == OPEN
+
+    def test_slow_response_is_failure(self):
+        registry = make_registry(failures=1, slow_threshold=100)
+        registry.record(1, OK, duration_ms=50)
+        assert registry.get_state(1) == CLOSED
+        registry.record(1, OK, duration_ms=150)
+        assert registry.get_state(1) == OPEN
+
+    def test_disabled(self):
+        registry = make_registry(failures=0)
+        for _ in range(10):
+            registry.record(1, UNAVAILABLE)
+        assert registry.acquire(1)
+        assert not registry.breakers
+
+    def test_shared_state(self):
+        registry = make_registry(failures=1)
+        registry.record(1, UNAVAILABLE)
+        other = make_registry(failures=1)
+        for args in registry.snapshot():
+            other.set_state(*args)
+        assert other.get_state(1) == OPEN
+        assert other.breakers[1].opened == registry.breakers[1].opened
+        other.set_state(1, CLOSED)
+        assert other.get_state(1) == CLOSED
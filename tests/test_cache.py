@@ -0,0 +1,180 @@
+import asyncio
+import time
+from email.utils import formatdate
+from utilmeta_proxy.service.proxy.cache import ResponseCache, CacheEntry, parse_cache_control
+
+
+def make_cache(**kwargs) -> ResponseCache:
+    options = dict(max_size=64 * 1024, max_entry_size=1024, directory=None)
+    options.update(kwargs)
+    return ResponseCache(**options)
+
+
+def make_entry(headers: dict, body: bytes = b'{}', request_headers: dict = None, status: int = 200) -> CacheEntry:
+    return make_cache().make_entry(status, headers, body, request_headers or {})
+
+
+class TestParseCacheControl:
+    def test_directives(self):
+        assert parse_cache_control('public, max-age=60, s-maxage="30", No-Cache') == {
+            'public': None, 'max-age': '60', 's-maxage': '30', 'no-cache': None}
+        assert parse_cache_control(None) == {}
+
+
+class TestFreshness:
+    def test_max_age(self):
+        assert ResponseCache.get_lifetime({'cache-control': 'max-age=60'}) == 60
+
+    def test_s_maxage_precedence(self):
+        # a shared cache prefers s-maxage over max-age and Expires
+        assert ResponseCache.get_lifetime({
+            'cache-control': 'max-age=60, s-maxage=10',
+            'expires': formatdate(time.time() + 3600, usegmt=True),
+        }) == 10
+
+    def test_expires(self):
+        now = time.time()
+        assert ResponseCache.get_lifetime({
+            'expires': formatdate(now + 120, usegmt=True),
+            'date': formatdate(now, usegmt=True),
+        }) == 120
+        # invalid Expires means already expired
+        assert ResponseCache.get_lifetime({'expires': '0'}) == 0
+
+    def test_fresh(self):
+        entry = make_entry({'cache-control': 'max-age=60'})
+        assert entry.fresh
+        entry.stored -= 61
+        assert not entry.fresh
+
+    def test_age(self):
+        # the age reported by upstream counts to the current age
+        entry = make_entry({'cache-control': 'max-age=60', 'age': '50'})
+        assert entry.age >= 50
+        assert entry.fresh
+        assert not make_entry({'cache-control': 'max-age=60', 'age': '70'}).fresh
+
+    def test_no_cache(self):
+        entry = make_entry({'cache-control': 'max-age=60, no-cache', 'etag': '"a"'})
+        assert not entry.fresh
+        assert not entry.expired
+
+    def test_request_cache_control(self):
+        entry = make_entry({'cache-control': 'max-age=60'})
+        entry.stored -= 10
+        assert entry.is_fresh_for({})
+        assert not entry.is_fresh_for({'cache-control': 'no-cache'})
+        assert not entry.is_fresh_for({'cache-control': 'max-age=0'})
+        assert not entry.is_fresh_for({'cache-control': 'max-age=5'})
+        assert entry.is_fresh_for({'cache-control': 'max-age=30'})
+        assert not entry.is_fresh_for({'cache-control': 'min-fresh=55'})
+        assert entry.is_fresh_for({'cache-control': 'min-fresh=30'})
+        # a request max-age does not extend the freshness of the response
+        entry.stored -= 60
+        assert not entry.is_fresh_for({'cache-control': 'max-age=3600'})
+
+    def test_expired(self):
+        entry = make_entry({'cache-control': 'max-age=1'})
+        entry.stored -= 2
+        assert entry.expired
+        # a stale entry with a validator can be revalidated
+        entry = make_entry({'cache-control': 'max-age=1', 'etag': '"a"'})
+        entry.stored -= 2
+        assert not entry.expired
+
+    def test_revalidated(self):
+        entry = make_entry({'cache-control': 'max-age=1', 'etag': '"a"', 'x-version': '1'})
+        entry.stored -= 2
+        updated = entry.revalidated({'cache-control': 'max-age=60', 'x-version': '2', 'set-cookie': 'a=1'}, 60)
+        assert updated.fresh
+        assert updated.body == entry.body
+        assert updated.get_header('x-version') == '2'
+        assert updated.get_header('set-cookie') is None
+
+
+class TestStorable:
+    def test_not_stored(self):
+        for headers in [
+            {'cache-control': 'no-store, max-age=60'},
+            {'cache-control': 'private, max-age=60'},
+            {'cache-control': 'max-age=60', 'set-cookie': 'a=1'},
+            {'cache-control': 'max-age=60', 'vary': '*'},
+            # neither fresh nor able to revalidate
+            {},
+        ]:
+            assert make_entry(headers) is None, headers
+
+    def test_status(self):
+        assert make_entry({'cache-control': 'max-age=60'}, status=500) is None
+        assert make_entry({'cache-control': 'max-age=60'}, status=404) is not None
+
+    def test_entry_size(self):
+        assert make_entry({'cache-control': 'max-age=60'}, body=b'x' * 2048) is None
+
+    def test_authorized(self):
+        authorized = {'authorization': 'Bearer t'}
+        assert make_entry({'cache-control': 'max-age=60'}, request_headers=authorized) is None
+        assert make_entry({'cache-control': 'public, max-age=60'}, request_headers=authorized) is not None
+
+    def test_validators_only(self):
+        assert make_entry({'etag': '"a"'}) is not None
+        assert make_entry({'last-modified': formatdate(time.time(), usegmt=True)}) is not None
+
+
+class TestConditional:
+    def test_etag(self):
+        entry = make_entry({'cache-control': 'max-age=60', 'etag': 'W/"a"'})
+        assert entry.not_modified({'if-none-match': '"b", "a"'})
+        assert entry.not_modified({'if-none-match': '*'})
+        assert not entry.not_modified({'if-none-match': '"b"'})
+        assert entry.to_response({'if-none-match': '"a"'}).status == 304
+        assert entry.to_response({}).status == 200
+
+    def test_last_modified(self):
+        modified = time.time() - 100
+        entry = make_entry({'cache-control': 'max-age=60', 'last-modified': formatdate(modified, usegmt=True)})
+        assert entry.not_modified({'if-modified-since': formatdate(modified + 10, usegmt=True)})
+        assert not entry.not_modified({'if-modified-since': formatdate(modified - 10, usegmt=True)})
+
+
+class TestResponseCache:
+    def test_vary(self):
+        async def run():
+            cache = make_cache()
+            entry = make_entry({'cache-control': 'max-age=60', 'vary': 'Accept-Language'})
+            await cache.set('p', {'accept-language': 'en'}, entry)
+            assert await cache.get('p', {'accept-language': 'en'}) is entry
+            assert await cache.get('p', {'accept-language': 'fr'}) is None
+        asyncio.run(run())
+
+    def test_varies_pruned_on_eviction(self):
+        async def run():
+            cache = make_cache(max_size=3000)
+            for i in range(10):
+                entry = make_entry({'cache-control': 'max-age=60', 'vary': 'accept'}, body=b'x' * 1000)
+                await cache.set(f'p{i}', {'accept': 'a'}, entry)
+            assert set(cache.varies) == set(cache.counts) == {'p8', 'p9'}
+        asyncio.run(run())
+
+    def test_varies_pruned_on_expiry(self):
+        async def run():
+            cache = make_cache()
+            entry = make_entry({'cache-control': 'max-age=1', 'vary': 'accept'})
+            await cache.set('p', {'accept': 'a'}, entry)
+            entry.stored -= 2
+            assert await cache.get('p', {'accept': 'a'}) is None
+            assert 'p' not in cache.varies
+            assert not cache.entries
+        asyncio.run(run())
+
+    def test_disk_tier(self, tmp_path):
+        async def run():
+            cache = make_cache(max_size=1500, directory=str(tmp_path), disk_max_size=64 * 1024)
+            first = make_entry({'cache-control': 'max-age=60', 'etag': '"a"'}, body=b'a' * 1000)
+            await cache.set('p1', {}, first)
+            await cache.set('p2', {}, make_entry({'cache-control': 'max-age=60'}, body=b'b' * 1000))
+            assert 'p1' not in cache.entries
+            entry = await cache.get('p1', {})
+            assert entry.body == first.body
+            assert entry.etag == '"a"'
+        asyncio.run(run())
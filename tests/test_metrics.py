@@ -0,0 +1,46 @@
+import json
+import pytest
+from utilmeta_proxy.service.proxy.metrics import Metric, MetricsRegistry
+
+
+def make_registry():
+    registry = MetricsRegistry(prefix='test', enabled=True)
+    counter = registry.counter('requests_total', 'Requests', ('status',))
+    histogram = registry.histogram('duration_seconds', 'Durations', buckets=(0.1, 1))
+    return registry, counter, histogram
+
+
+class TestMetrics:
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            Metric('test', 'test')
+
+    def test_render(self):
+        registry, counter, histogram = make_registry()
+        counter.inc(('200',))
+        histogram.observe((), 0.5)
+        lines = registry.render().splitlines()
+        assert 'test_requests_total{status="200"} 1' in lines
+        assert 'test_duration_seconds_bucket{le="0.1"} 0' in lines
+        assert 'test_duration_seconds_bucket{le="1"} 1' in lines
+        assert 'test_duration_seconds_count 1' in lines
+
+    def test_shared(self):
+        registry, counter, histogram = make_registry()
+        other, other_counter, other_histogram = make_registry()
+        counter.inc(('200',))
+        histogram.observe((), 0.05)
+        other_counter.inc(('200',), 2)
+        other_counter.inc(('500',))
+        other_histogram.observe((), 5)
+        # dumped by another worker
+        registry.shared = lambda: [json.loads(json.dumps(other.dump()))]
+        lines = registry.render().splitlines()
+        assert 'test_requests_total{status="200"} 3' in lines
+        assert 'test_requests_total{status="500"} 1' in lines
+        assert 'test_duration_seconds_bucket{le="0.1"} 1' in lines
+        assert 'test_duration_seconds_bucket{le="1"} 1' in lines
+        assert 'test_duration_seconds_bucket{le="+Inf"} 2' in lines
+        assert 'test_duration_seconds_count 2' in lines
+        # the local values are not changed by the merge
+        assert counter.values == {('200',): 1}
@@ -0,0 +1,61 @@
+import asyncio
+import gzip
+import httpx
+from utilmeta_proxy.service.proxy.coalesce import copy_response
+from utilmeta_proxy.service.proxy.compress import compress_response
+from utilmeta_proxy.service.proxy.pool import UpstreamPool
+
+BODY = b'{"data": "' + b'x' * 2048 + b'"}'
+
+
+def make_pool(headers: dict, content: bytes) -> UpstreamPool:
+    def handler(request: httpx.Request) -> httpx.Response:
+        # not read by the transport, like a response from the network
+        return httpx.Response(200, headers=headers, stream=httpx.ByteStream(content))
+
+    class MockPool(UpstreamPool):
+        def create_client(self, origin: str, http2: bool = False) -> httpx.AsyncClient:
+            return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    return MockPool()
+
+
+def request(pool: UpstreamPool, stream: bool = False):
+    async def run():
+        resp = await pool.request('http://upstream', 'GET', path='data', stream=stream)
+        body = resp.body if not stream else b''.join([chunk async for chunk in resp.event_stream])
+        return resp, body
+    return asyncio.run(run())
+
+
+class TestBufferedResponse:
+    def test_encoded_body_relayed_as_is(self):
+        # brotli / zstd is not decoded by httpx, any encoding is relayed as it is
+        for encoding, content in [('gzip', gzip.compress(BODY)), ('br', b'\x1b\x00\x00\x00encoded')]:
+            pool = make_pool({'content-type': 'application/json', 'content-encoding': encoding}, content)
+            resp, body = request(pool)
+            assert body == content
+            assert resp.headers.get('content-encoding') == encoding
+            assert not pool.clients[('http://upstream', False)].active
+
+    def test_not_compressed_again(self):
+        content = gzip.compress(BODY)
+        resp, _ = request(make_pool({'content-type': 'application/json', 'content-encoding': 'gzip'}, content))
+        compressed = compress_response(resp, 'gzip, br', method='GET')
+        assert compressed is resp
+        assert compressed.body == content
+
+    def test_identity_compressed(self):
+        resp, _ = request(make_pool({'content-type': 'application/json'}, BODY))
+        assert resp.body == BODY
+        compressed = compress_response(resp, 'gzip', method='GET')
+        assert compressed.headers.get('content-encoding') == 'gzip'
+        assert gzip.decompress(compressed.body) == BODY
+
+    def test_coalesced_copy(self):
+        content = gzip.compress(BODY)
+        resp, _ = request(make_pool({'content-type': 'application/json', 'content-encoding': 'gzip'}, content))
+        shared = copy_response(resp)
+        assert shared.body == content
+        assert shared.headers.get('content-encoding') == 'gzip'
+        assert shared.status == 200
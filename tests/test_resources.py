@@ -0,0 +1,107 @@
+import copy
+from utilmeta_proxy.domain.service.resources import ResourceIndex, get_identity, iter_entries
+
+RESOURCES = {
+    'metadata': {'name': 'svc', 'version': '1.0.0'},
+    'openapi': {
+        'openapi': '3.1.0',
+        'info': {'title': 'svc'},
+        'paths': {
+            '/users': {'get': {'operationId': 'users'}},
+            '/articles': {'get': {'operationId': 'articles'}},
+        },
+        'components': {
+            'schemas': {
+                'User': {'type': 'object'},
+                'Article': {'type': 'object'},
+            },
+        },
+    },
+    'tables': [
+        {'ref': 'app.models.User', 'name': 'user'},
+        {'ref': 'app.models.Article', 'name': 'article'},
+    ],
+    'instances': [{'address': '127.0.0.1:8000'}],
+}
+
+
+def diff(previous: dict, current: dict):
+    synced, _ = ResourceIndex.build(previous, etag='v1')
+    index, entries = ResourceIndex.build(current)
+    return synced.diff(index, entries)
+
+
+def paths(items: list) -> list:
+    return sorted(item['path'] for item in items)
+
+
+class TestEntries:
+    def test_identity(self):
+        assert get_identity('tables', {'ref': 'a.B', 'name': 'b'}) == 'a.B'
+        assert get_identity('databases', {'alias': 'default'}) == 'default'
+        # no identity field, identified by the content
+        assert get_identity('tables', {'columns': []}).startswith('#')
+
+    def test_keys(self):
+        keys = set(dict(iter_entries(RESOURCES)))
+        assert ('metadata',) in keys
+        assert ('openapi', 'paths', '/users') in keys
+        assert ('openapi', 'components', 'schemas', 'User') in keys
+        assert ('openapi', 'info') in keys
+        assert ('tables', 'app.models.User') in keys
+        assert ('instances', '127.0.0.1:8000') in keys
+
+
+class TestResourceIndexDiff:
+    def test_unchanged(self):
+        delta = diff(RESOURCES, copy.deepcopy(RESOURCES))
+        assert delta.changes == 0
+        assert delta.total == len(dict(iter_entries(RESOURCES)))
+
+    def test_added_updated_removed(self):
+        current = copy.deepcopy(RESOURCES)
+        current['openapi']['paths']['/comments'] = {'get': {'operationId': 'comments'}}
+        current['openapi']['paths']['/users']['post'] = {'operationId': 'create_user'}
+        del current['openapi']['components']['schemas']['Article']
+        current['tables'][0]['name'] = 'users'
+        delta = diff(RESOURCES, current)
+        assert paths(delta.added) == [['openapi', 'paths', '/comments']]
+        assert paths(delta.updated) == [['openapi', 'paths', '/users'], ['tables', 'app.models.User']]
+        assert paths(delta.removed) == [['openapi', 'components', 'schemas', 'Article']]
+        updated = {tuple(item['path']): item['value'] for item in delta.updated}
+        assert updated[('tables', 'app.models.User')] == current['tables'][0]
+        assert all('value' not in item for item in delta.removed)
+
+    def test_list_order_ignored(self):
+        current = copy.deepcopy(RESOURCES)
+        current['tables'].reverse()
+        assert diff(RESOURCES, current).changes == 0
+
+    def test_removed_kind(self):
+        current = copy.deepcopy(RESOURCES)
+        del current['instances']
+        delta = diff(RESOURCES, current)
+        assert paths(delta.removed) == [['instances', '127.0.0.1:8000']]
+
+    def test_worth(self):
+        current = copy.deepcopy(RESOURCES)
+        current['metadata']['version'] = '1.0.1'
+        assert diff(RESOURCES, current).worth(max_ratio=0.5)
+        # a delta of most entries is uploaded in full
+        changed = copy.deepcopy(RESOURCES)
+        for item in changed['tables'] + changed['instances']:
+            item['changed'] = True
+        for value in changed['openapi']['paths'].values():
+            value['changed'] = True
+        changed['metadata']['version'] = '2.0.0'
+        delta = diff(RESOURCES, changed)
+        assert not delta.worth(max_ratio=0.5)
+
+    def test_to_body(self):
+        current = copy.deepcopy(RESOURCES)
+        current['metadata']['version'] = '1.0.1'
+        body = diff(RESOURCES, current).to_body(current['metadata'], base_etag='v1', resources_etag='e2')
+        assert body['base_etag'] == 'v1'
+        assert body['resources_etag'] == 'e2'
+        assert body['updated'] == [{'path': ['metadata'], 'value': current['metadata']}]
+        assert body['added'] == body['removed'] == []
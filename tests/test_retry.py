@@ -0,0 +1,67 @@
+import pytest
+from utilmeta_proxy.service.proxy.retry import Deadline, RetryBudget
+
+
+class TestDeadline:
+    def test_split(self):
+        deadline = Deadline(3, max_attempts=3)
+        assert deadline.get_timeout(3) == pytest.approx(1, abs=0.01)
+        assert deadline.get_timeout(2) == pytest.approx(1.5, abs=0.01)
+        # the last attempt takes all the remaining time
+        assert deadline.get_timeout(1) == pytest.approx(3, abs=0.01)
+
+    def test_attempts_capped(self):
+        deadline = Deadline(4, max_attempts=2)
+        assert deadline.get_timeout(10) == pytest.approx(2, abs=0.01)
+        assert deadline.get_timeout(0) == pytest.approx(4, abs=0.01)
+
+    def test_remaining_split(self):
+        deadline = Deadline(3, max_attempts=3)
+        # the first attempt used 2 seconds
+        deadline.expires -= 2
+        assert deadline.get_timeout(2) == pytest.approx(0.5, abs=0.01)
+
+    def test_expired(self):
+        deadline = Deadline(1)
+        assert not deadline.expired
+        deadline.expires -= 1 - Deadline.MIN_TIMEOUT / 2
+        assert deadline.expired
+        assert deadline.get_timeout() == Deadline.MIN_TIMEOUT
+
+    def test_min_attempts(self):
+        assert Deadline(1, max_attempts=0).max_attempts == 1
+
+
+class TestRetryBudget:
+    def test_withdraw(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        assert budget.withdraw()
+        assert budget.withdraw()
+        assert not budget.withdraw()
+
+    def test_deposit(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        budget.tokens = 0
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+        for _ in range(10):
+            budget.deposit()
+        assert budget.tokens == 2
+
+    def test_refill(self):
+        budget = RetryBudget(ratio=0, min_per_second=5, max_tokens=10)
+        budget.tokens = 0
+        budget.updated -= 1
+        assert budget.withdraw()
+        assert budget.tokens == pytest.approx(4, abs=0.01)
+        budget.updated -= 100
+        budget.refill()
+        assert budget.tokens == 10
+
+    def test_no_refill(self):
+        budget = RetryBudget(ratio=0.2, min_per_second=0, max_tokens=1)
+        assert budget.withdraw()
+        budget.updated -= 100
+        assert not budget.withdraw()
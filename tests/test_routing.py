@@ -0,0 +1,64 @@
+from utilmeta_proxy.domain.service.routing import MissCache, RoutingTable
+from utilmeta_proxy.domain.service.source import parse_networks
+
+
+class TestMissCache:
+    def test_expires(self):
+        cache = MissCache(ttl=5, max_size=10)
+        cache.set('a')
+        assert 'a' in cache
+        cache.entries['a'] = (cache.entries['a'][0] - 5, None)
+        assert 'a' not in cache
+        assert not cache.entries
+
+    def test_bounded(self):
+        cache = MissCache(ttl=5, max_size=3)
+        for i in range(10):
+            cache.set(str(i), i)
+        assert list(cache.entries) == ['7', '8', '9']
+        assert cache.get('9')[1] == 9
+
+    def test_expired_purged(self):
+        cache = MissCache(ttl=5, max_size=3)
+        cache.set('a')
+        cache.set('b')
+        cache.set('c')
+        cache.entries['a'] = (cache.entries['a'][0] - 5, None)
+        cache.entries['b'] = (cache.entries['b'][0] - 5, None)
+        cache.purged -= 5
+        cache.set('d')
+        assert list(cache.entries) == ['c', 'd']
+
+    def test_disabled(self):
+        cache = MissCache(ttl=5, max_size=0)
+        cache.set('a')
+        assert 'a' not in cache
+
+
+class TestFallbackSource:
+    def test_private_by_default(self):
+        table = RoutingTable()
+        assert table.is_fallback_source('10.0.0.1')
+        assert table.is_fallback_source('127.0.0.1')
+        assert not table.is_fallback_source('8.8.8.8')
+        assert not table.is_fallback_source('invalid')
+
+    def test_networks(self):
+        table = RoutingTable()
+        table.fallback_networks = parse_networks('203.0.113.0/24, ::1/128, invalid')
+        assert len(table.fallback_networks) == 2
+        assert table.is_fallback_source('203.0.113.5')
+        assert table.is_fallback_source('::1')
+        assert not table.is_fallback_source('10.0.0.1')
+
+
+class TestRoutingTable:
+    def test_update_clears_misses(self):
+        from utilmeta_proxy.domain.service.models import Service, Instance
+        table = RoutingTable()
+        table.missing.set('svc')
+        table.source_fallbacks.set('10.0.0.1')
+        table.update_service(Service(pk=1, name='svc'))
+        table.update_instance(Instance(pk=1, service_id=1, host='10.0.0.1', connected=True))
+        assert 'svc' not in table.missing
+        assert '10.0.0.1' not in table.source_fallbacks
@@ -0,0 +1,8 @@
+from utilmeta_proxy.service.proxy.tunnel import get_websocket_routes
+
+
+class TestWebSocketRoutes:
+    def test_mount_path(self):
+        assert [route.path for route in get_websocket_routes('api')] == ['/api/proxy', '/api/proxy/{path:path}']
+        assert [route.path for route in get_websocket_routes('/v1/api/')][0] == '/v1/api/proxy'
+        assert [route.path for route in get_websocket_routes('')][0] == '/proxy'
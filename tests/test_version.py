@@ -0,0 +1,123 @@
+import pytest
+from utilmeta_proxy.domain.service.version import Version, parse_version, parse_loose_version, \
+    compile_version_range
+
+
+def matches(expression: str, version: str) -> bool:
+    return compile_version_range(expression).contains(parse_version(version))
+
+
+class TestParseVersion:
+    def test_full(self):
+        assert parse_version('1.2.3') == Version(1, 2, 3)
+        assert parse_version('v1.2.3') == Version(1, 2, 3)
+        assert parse_version('1.2.3+build.5') == Version(1, 2, 3)
+
+    def test_partial(self):
+        assert parse_version('1') == Version(1, 0, 0)
+        assert parse_version('1.2') == Version(1, 2, 0)
+
+    def test_prerelease(self):
+        assert parse_version('1.2.3-beta.1') == Version(1, 2, 3, ('beta', '1'))
+        assert str(parse_version('1.2.3-rc.1')) == '1.2.3-rc.1'
+
+    def test_invalid(self):
+        assert parse_version('') is None
+        assert parse_version('1.*') is None
+        assert parse_version('1.2.3.post1') is None
+        assert parse_version('1.0.0rc1') is None
+
+    def test_precedence(self):
+        ordered = ['1.0.0-alpha', '1.0.0-alpha.1', '1.0.0-alpha.beta', '1.0.0-beta',
+                   '1.0.0-beta.2', '1.0.0-beta.11', '1.0.0-rc.1', '1.0.0', '1.0.1']
+        keys = [parse_version(v).key for v in ordered]
+        assert keys == sorted(keys)
+
+
+class TestParseLooseVersion:
+    def test_post_release(self):
+        assert parse_loose_version('1.2.3.post1') == Version(1, 2, 3)
+        assert parse_loose_version('1.2.3.4') == Version(1, 2, 3)
+
+    def test_pep440_prerelease(self):
+        assert parse_loose_version('1.0.0rc1') == Version(1, 0, 0, ('rc', '1'))
+        assert parse_loose_version('2.1b2') == Version(2, 1, 0, ('b', '2'))
+        assert parse_loose_version('1.4.0.dev3') == Version(1, 4, 0, ('dev', '3'))
+
+    def test_snapshot(self):
+        assert parse_loose_version('2.1-SNAPSHOT') == Version(2, 1, 0, ('snapshot',))
+
+    def test_invalid(self):
+        assert parse_loose_version('') is None
+        assert parse_loose_version('latest') is None
+
+
+class TestCompileVersionRange:
+    @pytest.mark.parametrize('expression,version,expected', [
+        ('*', '3.4.5', True),
+        ('1', '1.9.9', True),
+        ('1', '2.0.0', False),
+        ('1.*', '1.0.0', True),
+        ('1.2', '1.2.7', True),
+        ('1.2', '1.3.0', False),
+        ('1.2.3', '1.2.3', True),
+        ('1.2.3', '1.2.4', False),
+        ('^1.2.3', '1.9.0', True),
+        ('^1.2.3', '2.0.0', False),
+        ('^1.2.3', '1.2.2', False),
+        ('^0.2.3', '0.2.9', True),
+        ('^0.2.3', '0.3.0', False),
+        ('^0.0.3', '0.0.4', False),
+        ('~1.2.3', '1.2.9', True),
+        ('~1.2.3', '1.3.0', False),
+        ('>=1.2', '1.2.0', True),
+        ('>=1.2', '1.1.9', False),
+        ('>1.2.3', '1.2.3', False),
+        ('>1.2', '1.2.9', False),
+        ('>1.2', '1.3.0', True),
+        ('<2', '1.99.0', True),
+        ('<2', '2.0.0', False),
+        ('<=1.4', '1.4.9', True),
+        ('<=1.4', '1.5.0', False),
+        ('>=1.2 <2', '1.5.0', True),
+        ('>=1.2, <2', '2.1.0', False),
+        ('>= 1.2', '1.3.0', True),
+    ])
+    def test_ranges(self, expression, version, expected):
+        assert matches(expression, version) is expected
+
+    def test_wildcard_comparators(self):
+        assert not matches('<*', '1.0.0')
+        assert not matches('>*', '1.0.0')
+
+    def test_invalid(self):
+        for expression in ('>>1', 'abc', '1.2-beta'):
+            with pytest.raises(ValueError):
+                compile_version_range(expression)
+
+
+class TestPrerelease:
+    def test_excluded_from_ranges(self):
+        # a canary pre-release is not routed by the ranges of its release
+        assert not matches('1', '1.3.0-rc.1')
+        assert not matches('1.*', '1.3.0-rc.1')
+        assert not matches('^1.2.0', '1.3.0-rc.1')
+        assert not matches('>=1.0', '1.3.0-rc.1')
+
+    def test_pinned(self):
+        assert matches('1.3.0-rc.1', '1.3.0-rc.1')
+        assert not matches('1.3.0-rc.1', '1.3.0-rc.2')
+        assert not matches('1.3.0-rc.1', '1.3.0')
+
+    def test_same_release(self):
+        # a pinned pre-release allows the later pre-releases of the same release only
+        assert matches('>=1.3.0-rc.1', '1.3.0-rc.2')
+        assert matches('>=1.3.0-rc.1', '1.3.0')
+        assert not matches('>=1.3.0-rc.1', '1.4.0-rc.1')
+        assert matches('^1.3.0-beta.1', '1.3.0-rc.1')
+
+    def test_loose_prerelease(self):
+        # a PEP 440 pre-release is parsed as pre-release, not routed as the release
+        version = parse_loose_version('1.0.0rc1')
+        assert not compile_version_range('1').contains(version)
+        assert compile_version_range('1').contains(parse_loose_version('1.0.0.post1'))
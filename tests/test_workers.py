@@ -0,0 +1,43 @@
+import threading
+import time
+from utilmeta_proxy.service.workers import WorkerBus
+
+
+class TestWorkerBusLock:
+    def test_exclusive(self, tmp_path):
+        bus = WorkerBus(directory=str(tmp_path))
+        events = []
+
+        def run(name):
+            with bus.lock('sync-1'):
+                events.append(('enter', name))
+                time.sleep(0.05)
+                events.append(('exit', name))
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # never entered by another holder before the current one exits
+        assert [event for event, _ in events] == ['enter', 'exit'] * 3
+        assert (tmp_path / 'sync-1.lock').exists()
+
+    def test_not_started(self):
+        with WorkerBus().lock('sync-1'):
+            pass
+
+
+class TestMetricsShare:
+    def test_read(self, tmp_path):
+        import json
+        from utilmeta_proxy.service.workers import MetricsShare
+        bus = WorkerBus(directory=str(tmp_path))
+        share = MetricsShare(bus)
+        share.write()
+        (tmp_path / 'metrics-1.json').write_text(json.dumps({'a': [[[], 1]]}))
+        (tmp_path / 'worker-1.sock').write_text('')
+        (tmp_path / 'metrics-2.json').write_text(json.dumps({'a': [[[], 2]]}))
+        # the dump of this worker is not read, and worker 2 is exited
+        assert share.read() == [{'a': [[[], 1]]}]
+        assert not (tmp_path / 'metrics-2.json').exists()
@@ -7,7 +7,7 @@ class ServiceEnvironment(Env):
     DJANGO_SECRET_KEY: str = ''
 
     # databases ---------
-    DB_ENGINE: Literal['postgresql', 'mysql'] = 'postgresql'
+    DB_ENGINE: Literal['postgresql', 'mysql', 'sqlite3'] = 'postgresql'
     DB_HOST: str = '127.0.0.1'
     DB_USER: str
     DB_PASSWORD: str
@@ -30,6 +30,88 @@ class ServiceEnvironment(Env):
     DEFAULT_TIMEOUT: int = 15
     LOAD_TIMEOUT: int = 15
     CORS_MAX_AGE: int = 3600 * 24
+    WORKERS: int = 1                # worker processes (the workers extra), the workers on the host share state by local IPC
+    WORKER_STATE_DIR: str = None    # private (0o700) dir of the worker sockets and leader lock, default per user
+
+    # upstream connections ---------
+    UPSTREAM_MAX_CONNECTIONS: int = 100        # per upstream host
+    UPSTREAM_MAX_KEEPALIVE: int = 20           # per upstream host
+    UPSTREAM_KEEPALIVE_EXPIRY: int = 30
+    UPSTREAM_IDLE_TIMEOUT: int = 300           # close the pooled client of an unused host
+    UPSTREAM_HTTP2: bool = False               # h2c (prior knowledge) to the instances, requires the http2 extra
+    # can be override by "http2" in Service.data
+    SUPERVISOR_HTTP2: bool = False             # negotiate h2 over TLS with the supervisor, requires the http2 extra
+    STREAMING: bool = True                     # relay request / response bodies chunk by chunk
+    STREAM_CHUNK_SIZE: int = 64 * 1024
+    ROUTING_RECONCILE_INTERVAL: int = 30       # reload routing table from database
+    ROUTING_MISS_CACHE_SIZE: int = 4096        # lookups that missed the routing table, the least recent are dropped
+    SOURCE_FALLBACK_NETWORKS: str = None       # CIDRs (comma separated) of the source addresses not in the routing
+    # table that are looked up in database, default to the private networks
+    LOAD_BALANCER: str = 'p2c'
+    # p2c / peak_ewma / least_outstanding / weighted_round_robin / rank
+    # can be override by "load_balancer" in Service.data
+    STATS_FLUSH_INTERVAL: int = 60             # write live instance avg_time / avg_rps to database
+    HEALTH_CHECK_INTERVAL: int = 10            # 0 to disable active health checks
+    HEALTH_CHECK_TIMEOUT: int = 3
+    HEALTH_CHECK_CONCURRENCY: int = 20
+    HEALTH_CHECK_FAILURES: int = 3             # consecutive failures to eject an instance
+    HEALTH_CHECK_SUCCESSES: int = 2            # consecutive successes to restore an ejected instance
+    HEALTH_CHECK_PATH: str = None              # path under instance base_url, default to probe the ops_api
+    BREAKER_FAILURES: int = 5                  # consecutive failures to open the circuit of an instance, 0 to disable
+    BREAKER_OPEN_SECONDS: int = 30             # doubled on failed half-open probes
+    BREAKER_HALF_OPEN_PROBES: int = 1          # concurrent probe requests allowed for a half-open instance
+    BREAKER_SLOW_THRESHOLD: int = 0            # response time (ms) that counted as failure, 0 to disable
+    RETRY_MAX_ATTEMPTS: int = 3                # attempts of a request, the timeout is split across them
+    RETRY_BUDGET_RATIO: float = 0.2            # retries allowed per successful request
+    RETRY_BUDGET_MIN_PER_SECOND: float = 5     # retries allowed regardless of the ratio
+    RETRY_BUDGET_MAX_TOKENS: float = 100
+    HEDGE: bool = False                        # hedge idempotent requests, can be override by "hedge" in Service.data
+    HEDGE_PERCENTILE: int = 95                 # delay before sending the hedged request
+    HEDGE_BUDGET: float = 0.05                 # max ratio of hedged requests
+    HEDGE_MIN_DELAY: int = 10                  # ms
+    COALESCE: bool = False                     # share identical concurrent GET / HEAD upstream calls
+    # can be override by "coalesce" in Service.data
+    COALESCE_VARY_HEADERS: str = 'authorization,cookie,accept,accept-encoding,accept-language'
+    RESPONSE_CACHE: bool = False               # cache GET responses by Cache-Control / ETag / Last-Modified
+    # can be override by "cache" in Service.data
+    CACHE_MAX_SIZE: int = 64 * 1024 * 1024     # bytes in memory, 0 to disable
+    CACHE_MAX_ENTRY_SIZE: int = 1024 * 1024
+    CACHE_DIR: str = None                      # directory of the on-disk tier for the entries evicted from memory
+    CACHE_DISK_MAX_SIZE: int = 1024 * 1024 * 1024
+    COMPRESSION: bool = True                   # compress the uncompressed responses by the client Accept-Encoding
+    COMPRESS_MIN_SIZE: int = 1024
+    COMPRESS_LEVEL: int = 5
+    COMPRESS_ENCODINGS: str = 'zstd,br,gzip'   # by preference, br / zstd requires the compression extra
+    TUNNEL_MAX_CONNECTIONS: int = 1000         # concurrent WebSocket tunnels and event streams, 0 for unlimited
+    TUNNEL_IDLE_TIMEOUT: int = 300             # close a tunnel / event stream that has no message for the seconds
+    TOKEN_CACHE_SIZE: int = 4096               # verified proxy / operations tokens, 0 to disable
+    TOKEN_CACHE_TTL: int = 300                 # max seconds to cache a verified token (capped by the token exp)
+    SUPERVISOR_CACHE_TTL: int = 10             # seconds to cache the supervisor of a node id, 0 to disable
+    SUPERVISOR_CACHE_SIZE: int = 1024          # node ids to cache, the least recently used are dropped
+    SUPERVISOR_SYNC_WINDOW: float = 2          # seconds to coalesce the registrations of a service into one sync
+    SUPERVISOR_SYNC_CONCURRENCY: int = 4       # services to connect / sync to the supervisor at the same time
+    SUPERVISOR_SYNC_RETRIES: int = 5
+    SUPERVISOR_SYNC_RETRY_DELAY: float = 5     # doubled on each failed retry
+    SUPERVISOR_SYNC_MAX_RETRY_DELAY: float = 300
+    SUPERVISOR_DELTA_SYNC: bool = True         # upload the changes since the last sync instead of the full resources
+    SUPERVISOR_DELTA_MAX_RATIO: float = 0.5    # upload in full if the changed resources exceed the ratio
+    METRICS: bool = True                       # in-process metrics at /api/metrics (Prometheus text format)
+    METRICS_SHARE_INTERVAL: int = 5            # seconds, with WORKERS > 1 every worker dumps its metrics to the
+    # worker state dir, a scrape served by any worker returns the sum of all the workers
+    METRICS_TOKEN: str = None                  # bearer token to scrape the metrics, loopback / private IPs only if not set
+    SERVER_TIMING: bool = True                 # phases (auth / route / connect / upstream / retry) in server-timing
+    TIMING_LOG_SAMPLE: float = 0               # ratio of the requests to log the phase timings to the ops log
+    TIMING_LOG_SLOW: int = 0                   # ms, always log the phase timings of the slower requests, 0 to disable
+    TRACING: bool = True                       # span the proxied requests and propagate them by W3C traceparent
+    TRACING_EXPORTER: Literal['otlp', 'file'] = None    # export the spans, no spans if not set
+    TRACING_ENDPOINT: str = None               # OTLP/HTTP collector, like http://127.0.0.1:4318
+    TRACING_FILE: str = None                   # JSON lines of the file exporter, default to traces.jsonl in cwd
+    TRACING_SAMPLE: float = 1                  # ratio to sample the requests without a traceparent
+    TRACING_QUEUE_SIZE: int = 2048             # spans waiting to export, the spans over the size are dropped
+    TRACING_BATCH_SIZE: int = 512
+    TRACING_EXPORT_INTERVAL: int = 5
+    TRACING_EXPORT_TIMEOUT: int = 10
+    # --------------------------
 
 
 # env = ServiceEnvironment(sys_env='UTILMETA_PROXY_')
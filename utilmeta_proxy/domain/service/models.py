@@ -35,7 +35,7 @@ class Instance(AwaitableModel):
     service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='instances')
     service_id: str
 
-    host = models.GenericIPAddressField()
+    host = models.GenericIPAddressField(db_index=True)
     port = models.PositiveIntegerField(default=None, null=True)
     address = models.CharField(max_length=255, unique=True)
     base_url = models.TextField()
@@ -0,0 +1,168 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+from utilmeta.core import api, request
+from utilmeta.ops.client import SupervisorClient, SupervisorResourcesResponse, SupervisorResponse
+from utilmeta.utils import fast_digest, json_dumps
+from utilmeta_proxy.config.env import env
+
+IDENTITY_FIELDS = {
+    'tables': ('ref', 'ident', 'name'),
+    'instances': ('address', 'ident'),
+    'databases': ('alias',),
+    'caches': ('alias',),
+    'tasks': ('name', 'ident', 'id'),
+}
+DEFAULT_IDENTITY_FIELDS = ('remote_id', 'ident', 'name', 'alias', 'id')
+# resources that are always sent as a whole
+WHOLE_KINDS = ('metadata',)
+# responses of a supervisor that does not support the delta upload
+DELTA_UNSUPPORTED_STATUSES = (404, 405, 501)
+# base etag of the delta is not the resources of the supervisor
+DELTA_CONFLICT_STATUSES = (409, 412)
+
+EntryKey = Tuple[str, ...]
+
+
+def digest(value) -> str:
+    return fast_digest(json_dumps(value), compress=True, case_insensitive=False)
+
+
+def get_identity(kind: str, item) -> str:
+    if isinstance(item, dict):
+        for field in IDENTITY_FIELDS.get(kind, DEFAULT_IDENTITY_FIELDS):
+            value = item.get(field)
+            if value is not None and value != '':
+                return str(value)
+    # no identity, the item is identified by its content (an update is a removal and an addition)
+    return '#' + digest(item)
+
+
+def iter_entries(resources: dict) -> Iterator[Tuple[EntryKey, object]]:
+    """
+    Split the resources document into entries keyed by resource identity:
+    the items of the resource lists by their identity fields, the OpenAPI document by path and component
+    """
+    for kind, value in resources.items():
+        if kind == 'openapi' and isinstance(value, dict):
+            for section, content in value.items():
+                if section == 'paths' and isinstance(content, dict):
+                    for path, item in content.items():
+                        yield (kind, section, path), item
+                elif section == 'components' and isinstance(content, dict):
+                    for component_type, components in content.items():
+                        if not isinstance(components, dict):
+                            yield (kind, section, component_type), components
+                            continue
+                        for name, component in components.items():
+                            yield (kind, section, component_type, name), component
+                else:
+                    yield (kind, section), content
+        elif isinstance(value, list) and kind not in WHOLE_KINDS:
+            for item in value:
+                yield (kind, get_identity(kind, item)), item
+        else:
+            yield (kind,), value
+
+
+class ResourceIndex:
+    """
+    Digest of each resource entry of a synced resources document,
+    the next document is diffed against the digests, the synced document is not kept or serialized again
+    """
+    __slots__ = ('etag', 'digests')
+
+    def __init__(self, etag: Optional[str], digests: Dict[EntryKey, str]):
+        self.etag = etag
+        # etag of the supervisor resources after the sync
+        self.digests = digests
+
+    @classmethod
+    def build(cls, resources: dict, etag: str = None) -> Tuple['ResourceIndex', Dict[EntryKey, object]]:
+        """
+        :return: the index and the entries of the resources
+        """
+        entries = dict(iter_entries(resources))
+        return cls(etag, {key: digest(value) for key, value in entries.items()}), entries
+
+    def diff(self, index: 'ResourceIndex', entries: Dict[EntryKey, object]) -> 'ResourcesDelta':
+        """
+        Changes from this (synced) index to the index of the new entries
+        """
+        added = []
+        updated = []
+        for key, value_digest in index.digests.items():
+            previous = self.digests.get(key)
+            if previous is None:
+                added.append(dict(path=list(key), value=entries[key]))
+            elif previous != value_digest:
+                updated.append(dict(path=list(key), value=entries[key]))
+        removed = [dict(path=list(key)) for key in self.digests if key not in index.digests]
+        return ResourcesDelta(added=added, updated=updated, removed=removed, total=len(index.digests))
+
+
+class ResourcesDelta:
+    __slots__ = ('added', 'updated', 'removed', 'total')
+
+    def __init__(self, added: List[dict], updated: List[dict], removed: List[dict], total: int):
+        self.added = added
+        self.updated = updated
+        self.removed = removed
+        self.total = total
+
+    @property
+    def changes(self) -> int:
+        return len(self.added) + len(self.updated) + len(self.removed)
+
+    def worth(self, max_ratio: float = env.SUPERVISOR_DELTA_MAX_RATIO) -> bool:
+        """
+        A delta of most entries costs more to apply than a full upload
+        """
+        return self.changes <= max(1.0, self.total * max_ratio)
+
+    def to_body(self, metadata, base_etag: str, resources_etag: str = None) -> dict:
+        return dict(
+            metadata=metadata,
+            base_etag=base_etag,
+            resources_etag=resources_etag,
+            added=self.added,
+            updated=self.updated,
+            removed=self.removed,
+        )
+
+
+class DeltaSupervisorClient(SupervisorClient):
+    """
+    Delta stage of the resources upload:
+    POST /resources/delta {metadata, base_etag, resources_etag, added, updated, removed}
+    with the entries of (added / updated) {path, value} and (removed) {path}, where path is the entry key:
+    [kind, identity] for the resource lists, [openapi, paths, path] / [openapi, components, type, name]
+    for the OpenAPI document and [kind] for the whole values.
+    The supervisor applies it to the resources of base_etag and responds as the full upload
+    (all the resources with the new etag), 409 / 412 if base_etag is not its current resources.
+    The endpoints of the SupervisorClient are bound to its own instances, so this client only sends the delta
+    """
+    @api.post('/resources/delta')
+    def upload_resources_delta(self, data: dict = request.Body) \
+            -> Union[SupervisorResourcesResponse, SupervisorResponse]:
+        pass
+
+
+class SyncedResources:
+    """
+    Index of the last synced resources of each service (in memory), a service without index is synced in full
+    """
+    def __init__(self):
+        self.indexes: Dict[str, ResourceIndex] = {}
+        self.unsupported: Set[str] = set()
+        # node ids of the supervisors that do not support the delta upload
+
+    def get(self, service_id) -> Optional[ResourceIndex]:
+        return self.indexes.get(str(service_id))
+
+    def set(self, service_id, index: ResourceIndex):
+        self.indexes[str(service_id)] = index
+
+    def discard(self, service_id):
+        self.indexes.pop(str(service_id), None)
+
+
+synced_resources = SyncedResources()
@@ -0,0 +1,393 @@
+import asyncio
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from django.db import models
+from typing import Callable, Dict, List, Optional, Tuple
+from .models import Service, ServiceNameRecord, Instance
+from .version import Version, parse_version, parse_loose_version, compile_version_range
+from .source import SourceIndex, parse_networks
+from utilmeta_proxy.config.env import env
+
+
+def get_fields(obj: models.Model) -> tuple:
+    return tuple(getattr(obj, field.attname) for field in obj._meta.concrete_fields)
+
+
+def get_instance_version(instance: Instance) -> Version:
+    return parse_version(instance.version) or parse_loose_version(instance.version) or Version(
+        instance.version_major or 0,
+        instance.version_minor or 0,
+        instance.version_patch or 0,
+    )
+
+
+class ServiceRoute:
+    MAX_CACHED_MATCHES = 256
+
+    def __init__(self, service: Service):
+        self.service = service
+        self.names = {service.name}
+        self.instances: Dict[int, Instance] = {}
+        # connected instances only
+        self._index: Optional[Tuple[list, List[Tuple[Version, Instance]]]] = None
+        # instances sorted by version: (keys, [(version, instance)])
+        self._matches: Dict[str, List[Instance]] = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({repr(self.service.name)}, instances={len(self.instances)})'
+
+    @property
+    def connected(self) -> List[Instance]:
+        return list(self.instances.values())
+
+    def add_instance(self, instance: Instance):
+        self.instances[instance.pk] = instance
+        self._index = None
+        self._matches = {}
+
+    def remove_instance(self, instance: Instance):
+        if self.instances.pop(instance.pk, None) is not None:
+            self._index = None
+            self._matches = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            items = sorted(
+                [(get_instance_version(inst), inst) for inst in self.instances.values()],
+                key=lambda item: item[0].key
+            )
+            self._index = ([version.key for version, _ in items], items)
+        return self._index
+
+    def match_version(self, accept_version: str) -> List[Instance]:
+        """
+        Match connected instances by the accept version expression,
+        the result is cached until the instances changed
+        :raise ValueError: invalid expression
+        """
+        matched = self._matches.get(accept_version)
+        if matched is not None:
+            return matched
+        version_range = compile_version_range(accept_version)
+        keys, items = self.index
+        start, end = 0, len(keys)
+        if version_range.lower is not None:
+            start = (bisect_left if version_range.lower_inclusive else bisect_right)(keys, version_range.lower)
+        if version_range.upper is not None:
+            end = (bisect_right if version_range.upper_inclusive else bisect_left)(keys, version_range.upper)
+        matched = [inst for version, inst in items[start:end] if version_range.allows(version)]
+        if len(self._matches) < self.MAX_CACHED_MATCHES:
+            self._matches[accept_version] = matched
+        return matched
+
+
+class MissCache:
+    """
+    Lookups that missed the routing table, so that the database is queried at most once per ttl for a key.
+    The keys come from the requests, so the cache is a bounded LRU and the expired entries are dropped
+    """
+    def __init__(self, ttl: float, max_size: int = env.ROUTING_MISS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: 'OrderedDict[str, Tuple[float, object]]' = OrderedDict()
+        # key -> (expires, value)
+        self.purged = time.monotonic()
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: str) -> Optional[Tuple[float, object]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self.entries.pop(key, None)
+            return None
+        return entry
+
+    def set(self, key: str, value=None):
+        if not self.max_size:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.purge()
+
+    def pop(self, key: str):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def purge(self):
+        """
+        Drop the expired entries (scanned at most once per ttl), then the least recently used ones
+        """
+        now = time.monotonic()
+        if now - self.purged >= self.ttl:
+            self.purged = now
+            for key, (expires, _) in list(self.entries.items()):
+                if expires <= now:
+                    self.entries.pop(key, None)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class RoutingTable:
+    """
+    In-process routing table of services and their connected instances,
+    updated by registry on changes, and reconciled with database periodically
+    so that proxy requests does not need to query database
+    """
+    MISS_TTL = 5
+
+    def __init__(self, reconcile_interval: int = env.ROUTING_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self.services: Dict[int, ServiceRoute] = {}
+        self.names: Dict[str, ServiceRoute] = {}
+        self.remote_ids: Dict[str, Instance] = {}
+        self.missing = MissCache(self.MISS_TTL)
+        # service names not found in database
+        self.sources = SourceIndex()
+        self.source_fallbacks = MissCache(self.MISS_TTL)
+        # source address not in the index -> instance from database
+        self.fallback_networks = parse_networks(env.SOURCE_FALLBACK_NETWORKS)
+        self.loaded = False
+        self._changes = None
+        # changes made during a reload, re-applied after the reloaded table is swapped in
+        self.listeners: List[Callable[..., None]] = []
+        # called with (change, *args) on the changes of the table, change is "service" / "instance" / "remove"
+        self._lock = None
+        self._task = None
+
+    async def load(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.loaded:
+                return
+            await self.reload()
+
+    async def reload(self, notify: bool = True):
+        previous = self.snapshot() if notify and self.listeners and self.loaded else None
+        self._changes = []
+        try:
+            await self._reload()
+        finally:
+            changes, self._changes = self._changes, None
+        # the changes are already notified when they are made
+        listeners, self.listeners = self.listeners, []
+        try:
+            for func, args in changes:
+                func(*args)
+        finally:
+            self.listeners = listeners
+        if previous is not None:
+            self.notify_changes(*previous)
+
+    def snapshot(self) -> Tuple[Dict[int, tuple], Dict[int, Tuple[tuple, Instance]]]:
+        services = {}
+        instances = {}
+        for pk, route in self.services.items():
+            services[pk] = (get_fields(route.service), set(route.names))
+            for inst in route.instances.values():
+                instances[inst.pk] = (get_fields(inst), inst)
+        return services, instances
+
+    def notify_changes(self, services: Dict[int, tuple], instances: Dict[int, Tuple[tuple, Instance]]):
+        """
+        Notify the differences of the reloaded table, so that the listeners can apply them without reloading
+        """
+        current = set()
+        for pk, route in self.services.items():
+            if services.get(pk) != (get_fields(route.service), route.names):
+                self.notify('service', route.service, list(route.names))
+            for inst in route.instances.values():
+                current.add(inst.pk)
+                previous = instances.get(inst.pk)
+                if not previous or previous[0] != get_fields(inst):
+                    self.notify('instance', inst)
+        for pk, (_, inst) in instances.items():
+            if pk not in current:
+                self.notify('remove', inst)
+
+    def notify(self, change: str, *args):
+        for listener in self.listeners:
+            try:
+                listener(change, *args)
+            except Exception as e:
+                print(f'routing table listener failed with error: {e}')
+
+    async def _reload(self):
+        services: Dict[int, ServiceRoute] = {}
+        names: Dict[str, ServiceRoute] = {}
+        remote_ids: Dict[str, Instance] = {}
+        sources = SourceIndex()
+
+        async for service in Service.objects.all():
+            services[service.pk] = ServiceRoute(service)
+            sources.update_service(service)
+        async for record in ServiceNameRecord.objects.all():
+            route = services.get(record.service_id)
+            if route:
+                route.names.add(record.name)
+                names[record.name] = route
+        for route in services.values():
+            # current name takes precedence over the name records
+            names[route.service.name] = route
+        async for inst in Instance.objects.filter(connected=True):
+            route = services.get(inst.service_id)
+            if not route:
+                continue
+            route.add_instance(inst)
+            sources.add_instance(inst)
+            if inst.remote_id:
+                remote_ids[inst.remote_id] = inst
+
+        self.services = services
+        self.names = names
+        self.remote_ids = remote_ids
+        self.sources = sources
+        self.missing.clear()
+        self.source_fallbacks.clear()
+        self.loaded = True
+
+    async def get(self, name: str) -> Optional[ServiceRoute]:
+        if not name:
+            return None
+        if not self.loaded:
+            await self.load()
+        route = self.names.get(name)
+        if route:
+            return route
+        if name in self.missing:
+            return None
+        # maybe registered by another process since the last reconcile
+        service = await Service.objects.filter(
+            models.Q(name=name) | models.Q(
+                name_records__name=name
+            )
+        ).afirst()
+        if not service:
+            self.missing.set(name)
+            return None
+        names = [record_name async for record_name in ServiceNameRecord.objects.filter(
+            service=service).values_list('name', flat=True)]
+        route = self.update_service(service, names=names)
+        async for inst in Instance.objects.filter(service=service, connected=True):
+            self.update_instance(inst)
+        return route
+
+    def get_instance(self, remote_id: str) -> Optional[Instance]:
+        return self.remote_ids.get(remote_id)
+
+    async def identify(self, address) -> Tuple[Optional[Instance], Optional[int]]:
+        """
+        Identify the calling instance and service (pk) by the source address
+        """
+        if not self.loaded:
+            await self.load()
+        instance, service_id = self.sources.identify(address)
+        if instance or service_id:
+            return instance, service_id
+        if not self.is_fallback_source(address):
+            return None, None
+        key = str(address)
+        fallback = self.source_fallbacks.get(key)
+        if fallback:
+            instance = fallback[1]
+        else:
+            # maybe registered by another process since the last reconcile, or disconnected
+            instance = await Instance.objects.filter(host=key).afirst()
+            self.source_fallbacks.set(key, instance)
+            if instance and instance.connected:
+                self.update_instance(instance)
+        if instance:
+            return instance, instance.service_id
+        return None, None
+
+    def is_fallback_source(self, address) -> bool:
+        """
+        Only the source addresses in the fallback networks are looked up in database,
+        the others are identified by the routing table (updated on registration and reconciled)
+        """
+        address = SourceIndex.parse_address(address)
+        if address is None:
+            return False
+        if self.fallback_networks:
+            return any(network.version == address.version and address in network
+                       for network in self.fallback_networks)
+        return address.is_private
+
+    def update_service(self, service: Service, names: List[str] = ()) -> ServiceRoute:
+        if self._changes is not None:
+            self._changes.append((self.update_service, (service, names)))
+        route = self.services.get(service.pk)
+        if route:
+            route.service = service
+        else:
+            route = self.services[service.pk] = ServiceRoute(service)
+        route.names.add(service.name)
+        route.names.update(names)
+        self.sources.update_service(service)
+        for name in route.names:
+            self.names[name] = route
+            self.missing.pop(name)
+        self.notify('service', service, list(names))
+        return route
+
+    def update_instance(self, instance: Instance):
+        if self._changes is not None:
+            self._changes.append((self.update_instance, (instance,)))
+        if not instance.connected:
+            return self.remove_instance(instance)
+        route = self.services.get(instance.service_id)
+        if not route:
+            # service not loaded yet, will be added by the next get / reload
+            return
+        current = route.instances.get(instance.pk)
+        if current and current.remote_id and current.remote_id != instance.remote_id:
+            self.remote_ids.pop(current.remote_id, None)
+        route.add_instance(instance)
+        self.sources.add_instance(instance)
+        self.source_fallbacks.pop(str(instance.host))
+        if instance.remote_id:
+            self.remote_ids[instance.remote_id] = instance
+        self.notify('instance', instance)
+
+    def remove_instance(self, instance: Instance):
+        if self._changes is not None:
+            self._changes.append((self.remove_instance, (instance,)))
+        route = self.services.get(instance.service_id)
+        if route:
+            route.remove_instance(instance)
+        self.sources.remove_instance(instance)
+        if instance.remote_id:
+            current = self.remote_ids.get(instance.remote_id)
+            if current and current.pk == instance.pk:
+                self.remote_ids.pop(instance.remote_id, None)
+        self.notify('remove', instance)
+
+    async def reconcile(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                # every worker reconciles its own table, the differences are not published
+                await self.reload(notify=False)
+            except Exception as e:
+                print(f'reconcile routing table failed with error: {e}')
+
+    def start(self):
+        if self._task or not self.reconcile_interval:
+            return
+        self._task = asyncio.ensure_future(self.reconcile())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+routing_table = RoutingTable()
@@ -1,6 +1,7 @@
 import utype
 from utilmeta.core import orm
 from .models import Instance
+from .version import parse_version, parse_loose_version
 from utype.types import *
 
 
@@ -52,22 +53,19 @@ class InstanceSchema(orm.Schema[Instance]):
     avg_time: float = orm.Field(no_input='a')
     avg_rps: float = orm.Field(no_input='a')
 
+    # supervisor connect / resources sync of the service, run in background after the registry
+    sync_status: Optional[str] = orm.Field(no_input=True, default=None, defer_default=True)
+    # pending / syncing / synced / retrying / failed
+    sync_error: Optional[str] = orm.Field(no_input=True, default=None, defer_default=True)
+
 
 class InstanceRegistrySchema(InstanceSchema):
     __options__ = utype.Options(mode='a')
 
     def __validate__(self):
         if self.version:
-            versions = self.version.split('-')[0].split('.')
-            try:
-                self.version_major = int(versions[0])
-            except (TypeError, IndexError, ValueError):
-                pass
-            try:
-                self.version_minor = int(versions[1])
-            except (TypeError, IndexError, ValueError):
-                pass
-            try:
-                self.version_patch = int(versions[2])
-            except (TypeError, IndexError, ValueError):
-                pass
+            # pre-release / build suffix is kept in version and matched by the routing version index
+            # versions that are not semver (1.2.3.post1 / 1.0.0rc1) are routed by their leading integers
+            parsed = parse_version(self.version) or parse_loose_version(self.version)
+            if parsed:
+                self.version_major, self.version_minor, self.version_patch = parsed.release
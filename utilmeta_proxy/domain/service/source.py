@@ -0,0 +1,119 @@
+from ipaddress import ip_address, ip_network, IPv4Address, IPv6Address, IPv4Network, IPv6Network
+from typing import Dict, List, Optional, Tuple, Union
+from .models import Service, Instance
+
+IPAddress = Union[IPv4Address, IPv6Address]
+IPNetwork = Union[IPv4Network, IPv6Network]
+
+
+def parse_networks(value: str) -> List[IPNetwork]:
+    networks = []
+    for cidr in str(value or '').split(','):
+        if not cidr.strip():
+            continue
+        try:
+            networks.append(ip_network(cidr.strip(), strict=False))
+        except ValueError:
+            print(f'invalid source network: {repr(cidr)}, ignored')
+    return networks
+
+
+class SourceIndex:
+    """
+    Source address -> calling instance / service
+    1. exact match of the instance host (hash lookup)
+    2. longest prefix match of the "source_networks" CIDRs in Service.data, for the services
+       that call from NAT / container networks that differ from the registered host
+    """
+    MAX_CACHED = 4096
+
+    def __init__(self):
+        self.hosts: Dict[IPAddress, Dict[int, Instance]] = {}
+        self.instance_hosts: Dict[int, IPAddress] = {}
+        self.networks: Dict[int, List[IPNetwork]] = {}
+        # service pk -> networks
+        self._prefixes: Optional[List[Tuple[int, IPNetwork, int]]] = None
+        # (prefix length, network, service pk), sorted by prefix length desc
+        self._cached: Dict[IPAddress, Optional[int]] = {}
+        # resolved service pk of the addresses matched by networks
+
+    @classmethod
+    def parse_address(cls, address) -> Optional[IPAddress]:
+        if isinstance(address, (IPv4Address, IPv6Address)):
+            return address
+        try:
+            return ip_address(str(address))
+        except ValueError:
+            return None
+
+    def add_instance(self, instance: Instance):
+        host = self.parse_address(instance.host)
+        if host is None:
+            return
+        self.remove_instance(instance)
+        self.hosts.setdefault(host, {})[instance.pk] = instance
+        self.instance_hosts[instance.pk] = host
+
+    def remove_instance(self, instance: Instance):
+        host = self.instance_hosts.pop(instance.pk, None)
+        if host is None:
+            return
+        instances = self.hosts.get(host)
+        if instances is not None:
+            instances.pop(instance.pk, None)
+            if not instances:
+                self.hosts.pop(host, None)
+
+    def update_service(self, service: Service):
+        networks = []
+        for cidr in (service.data or {}).get('source_networks') or []:
+            try:
+                networks.append(ip_network(str(cidr), strict=False))
+            except ValueError:
+                print(f'invalid source network: {repr(cidr)} of service: {repr(service.name)}, ignored')
+        if networks:
+            if self.networks.get(service.pk) == networks:
+                return
+            self.networks[service.pk] = networks
+        elif self.networks.pop(service.pk, None) is None:
+            return
+        self._prefixes = None
+        self._cached = {}
+
+    @property
+    def prefixes(self) -> List[Tuple[int, IPNetwork, int]]:
+        if self._prefixes is None:
+            self._prefixes = sorted(
+                [(network.prefixlen, network, pk) for pk, networks in self.networks.items() for network in networks],
+                key=lambda item: item[0],
+                reverse=True
+            )
+        return self._prefixes
+
+    def match_network(self, address: IPAddress) -> Optional[int]:
+        if not self.networks:
+            return None
+        if address in self._cached:
+            return self._cached[address]
+        service_id = None
+        for _, network, pk in self.prefixes:
+            if network.version == address.version and address in network:
+                service_id = pk
+                break
+        if len(self._cached) >= self.MAX_CACHED:
+            self._cached = {}
+        self._cached[address] = service_id
+        return service_id
+
+    def identify(self, address) -> Tuple[Optional[Instance], Optional[int]]:
+        """
+        :return: (instance, service pk) of the source address
+        """
+        address = self.parse_address(address)
+        if address is None:
+            return None, None
+        instances = self.hosts.get(address)
+        if instances:
+            instance = next(iter(instances.values()))
+            return instance, instance.service_id
+        return None, self.match_network(address)
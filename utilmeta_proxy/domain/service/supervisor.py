@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+from utilmeta.ops.config import Operations
+from utilmeta_proxy.config.env import env
+
+
+class SupervisorEntry:
+    __slots__ = ('supervisor', 'base_urls', 'expires')
+
+    def __init__(self, supervisor, base_urls: List[str], expires: float):
+        self.supervisor = supervisor
+        # utilmeta.ops.models.Supervisor, None if not exists
+        self.base_urls = base_urls
+        # base_url and backup_urls that passed Operations.check_supervisor
+        self.expires = expires
+
+
+class SupervisorCache:
+    """
+    node_id -> supervisor cache for the proxy requests, with the trusted base urls validated once,
+    entries expire after a short TTL and are refreshed when the registry changes the supervisor.
+    The node ids come from the requests, so the cache is a bounded LRU and the misses expire sooner
+    """
+    MISS_TTL = 2
+
+    def __init__(self, ttl: int = env.SUPERVISOR_CACHE_TTL, max_size: int = env.SUPERVISOR_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: 'OrderedDict[str, SupervisorEntry]' = OrderedDict()
+        self.purged = time.monotonic()
+        self.listeners: List[Callable[[Optional[str]], None]] = []
+
+    @classmethod
+    def get_base_urls(cls, supervisor) -> List[str]:
+        base_urls = []
+        config = Operations.config()
+        for base_url in [supervisor.base_url] + list(supervisor.backup_urls or []):
+            try:
+                if config:
+                    config.check_supervisor(base_url)
+            except ValueError:
+                continue
+            # --- THIS IS A SECURITY MEASURE
+            # in the worst case scenario, attacker got the ops db permission
+            # and changed the base url of supervisor (to a hostile address)
+            # the request will not be sent since it violate the [trusted_hosts]
+            base_urls.append(base_url)
+        return base_urls
+
+    async def get(self, node_id: str) -> Optional[SupervisorEntry]:
+        if not node_id:
+            return None
+        entry = self.entries.get(node_id)
+        if entry:
+            if entry.expires > time.monotonic():
+                self.entries.move_to_end(node_id)
+                return entry
+            self.entries.pop(node_id, None)
+        from utilmeta.ops.models import Supervisor
+        supervisor: Supervisor = await Supervisor.filter(
+            node_id=node_id,
+        ).afirst()
+        return self.set(node_id, supervisor)
+
+    def set(self, node_id: str, supervisor) -> SupervisorEntry:
+        entry = SupervisorEntry(
+            supervisor,
+            base_urls=self.get_base_urls(supervisor) if supervisor else [],
+            expires=time.monotonic() + (self.ttl if supervisor else min(self.ttl, self.MISS_TTL)),
+        )
+        if self.ttl and self.max_size:
+            self.entries[node_id] = entry
+            self.entries.move_to_end(node_id)
+            if len(self.entries) > self.max_size:
+                self.purge()
+        return entry
+
+    def purge(self):
+        """
+        Drop the expired entries (scanned at most once per MISS_TTL), then the least recently used ones
+        """
+        now = time.monotonic()
+        if now - self.purged >= self.MISS_TTL:
+            self.purged = now
+            for node_id, entry in list(self.entries.items()):
+                if entry.expires <= now:
+                    self.entries.pop(node_id, None)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def refresh(self, supervisor):
+        """
+        Called after the supervisor is created or updated
+        """
+        if not supervisor or not supervisor.node_id:
+            return
+        self.set(supervisor.node_id, supervisor)
+        self.notify(supervisor.node_id)
+
+    def invalidate(self, node_id: str = None):
+        if node_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(node_id, None)
+        self.notify(node_id)
+
+    def notify(self, node_id: Optional[str]):
+        for listener in self.listeners:
+            try:
+                listener(node_id)
+            except Exception as e:
+                print(f'supervisor cache listener failed with error: {e}')
+
+
+supervisor_cache = SupervisorCache()
@@ -0,0 +1,418 @@
+import asyncio
+import time
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Dict, List, Optional
+from utilmeta.ops.config import Operations
+from utilmeta.ops.proxy import RegistrySchema
+from utilmeta.utils import adapt_async
+from starlette.concurrency import run_in_threadpool
+from utilmeta_proxy.config.env import env, CLUSTER_KEY
+from .models import Service
+from .supervisor import supervisor_cache
+from .resources import ResourceIndex, DeltaSupervisorClient, synced_resources, \
+    DELTA_UNSUPPORTED_STATUSES, DELTA_CONFLICT_STATUSES
+
+ops_config = Operations.config()
+
+
+def defer_change(changes: Optional[List[tuple]], func, *args):
+    """
+    The supervisor cache is not thread-safe, the changes made in a worker thread
+    are collected and applied by the caller in the event loop thread
+    """
+    if changes is None:
+        func(*args)
+    else:
+        changes.append((func, args))
+
+
+def upload_delta(service: Service, supervisor, resources: dict,
+                 index: ResourceIndex, entries: dict, resources_etag: str = None):
+    """
+    Upload the changes since the last sync of the service,
+    :return: the response, or None to upload in full
+    """
+    synced = synced_resources.get(service.pk)
+    if not synced or supervisor.node_id in synced_resources.unsupported:
+        return None
+    if not synced.etag or synced.etag != supervisor.resources_etag:
+        # the resources of the supervisor is changed by others since the last sync
+        return None
+    delta = synced.diff(index, entries)
+    if not delta.worth():
+        return None
+    with DeltaSupervisorClient(
+        base_url=supervisor.base_url,
+        node_key=supervisor.public_key,
+        node_id=supervisor.node_id,
+        cluster_id=env.SUPERVISOR_CLUSTER_ID,
+        fail_silently=True
+    ) as client:
+        resp = client.upload_resources_delta(
+            data=delta.to_body(resources.get('metadata'), base_etag=synced.etag, resources_etag=resources_etag)
+        )
+    if resp.success:
+        print(f'sync resources delta to supervisor[{supervisor.node_id}]: {len(delta.added)} added, '
+              f'{len(delta.updated)} updated, {len(delta.removed)} removed')
+        return resp
+    if resp.status in DELTA_UNSUPPORTED_STATUSES:
+        synced_resources.unsupported.add(supervisor.node_id)
+        print(f'supervisor[{supervisor.node_id}] does not support delta resources, upload in full')
+    elif resp.status in DELTA_CONFLICT_STATUSES:
+        synced_resources.discard(service.pk)
+        print(f'supervisor[{supervisor.node_id}] resources changed since the last sync, upload in full')
+    else:
+        print(f'sync resources delta to supervisor[{supervisor.node_id}] failed with error: '
+              f'{resp.message}, upload in full')
+    return None
+
+
+@adapt_async(close_conn=ops_config.db_alias)
+def sync_supervisor(service: Service, resources: dict, resources_etag: str = None, changes: List[tuple] = None):
+    from utilmeta.ops.models import Supervisor
+    from utilmeta.ops.client import SupervisorClient, ResourcesSchema
+    from utilmeta.ops.resources import ResourcesManager
+
+    if not service.node_id:
+        return
+    if not resources:
+        return
+    supervisor: Supervisor = Supervisor.filter(
+        service=service.name,
+        node_id=service.node_id
+    ).first()
+    if not supervisor:
+        return
+    if supervisor.resources_etag and resources_etag == supervisor.resources_etag:
+        print('resource is identical to supervisor')
+        return
+
+    index = entries = None
+    if env.SUPERVISOR_DELTA_SYNC:
+        index, entries = ResourceIndex.build(resources)
+        synced = synced_resources.get(service.pk)
+        if synced and synced.etag and synced.etag == supervisor.resources_etag and synced.digests == index.digests:
+            print('resource is identical to the last sync')
+            return
+
+    manager = ResourcesManager()
+    with SupervisorClient(
+        base_url=supervisor.base_url,
+        node_key=supervisor.public_key,
+        node_id=supervisor.node_id,
+        cluster_id=env.SUPERVISOR_CLUSTER_ID,
+        fail_silently=True
+    ) as client:
+        resp = None
+        if index is not None:
+            resp = upload_delta(service, supervisor, resources, index, entries, resources_etag=resources_etag)
+        if resp is None:
+            resp = client.upload_resources(
+                data=ResourcesSchema(resources)
+            )
+        if not resp.success:
+            raise ValueError(f'sync to supervisor[{supervisor.node_id}]'
+                             f' failed with error: {resp.message}')
+
+        if supervisor.service != service.name:
+            print(f'update supervisor and resources service name to [{service.name}]')
+            supervisor.service = service.name
+            supervisor.save(update_fields=['service'])
+            manager.update_supervisor_service(service.name, node_id=supervisor.node_id)
+            defer_change(changes, supervisor_cache.refresh, supervisor)
+
+        if resp.status == 304:
+            if index is not None:
+                index.etag = supervisor.resources_etag
+                synced_resources.set(service.pk, index)
+            print('[304] resources is identical to the remote supervisor, done')
+            return
+
+        if resp.result.resources_etag:
+            supervisor.resources_etag = resp.result.resources_etag
+            supervisor.save(update_fields=['resources_etag'])
+            defer_change(changes, supervisor_cache.refresh, supervisor)
+        if index is not None:
+            # diff base of the next sync, a supervisor that returns no etag is synced in full
+            index.etag = resp.result.resources_etag
+            synced_resources.set(service.pk, index)
+
+        manager.save_resources(
+            resp.result.resources,
+            supervisor=supervisor
+        )
+
+        print(f'sync resources to supervisor[{supervisor.node_id}] successfully')
+        if resp.result.url:
+            if supervisor.url != resp.result.url:
+                supervisor.url = resp.result.url
+                supervisor.save(update_fields=['url'])
+                defer_change(changes, supervisor_cache.refresh, supervisor)
+            print(f'you can visit {resp.result.url} to view the updated resources')
+
+
+@adapt_async(close_conn=ops_config.db_alias)
+def connect_supervisor(service: Service, data: RegistrySchema, resources: dict = None, resources_etag: str = None,
+                       changes: List[tuple] = None):
+    from utilmeta.ops.client import SupervisorClient
+    from utilmeta.ops.connect import save_supervisor, update_service_supervisor
+    from utilmeta.ops.models import Supervisor
+
+    supervisor_obj = Supervisor.objects.create(
+        service=service.name,
+        base_url=env.SUPERVISOR_BASE_URL,
+        init_key=CLUSTER_KEY,  # for double-check
+        ops_api=service.ops_api or data.ops_api
+    )
+
+    try:
+        with SupervisorClient(
+            base_url=env.SUPERVISOR_BASE_URL,
+            cluster_key=CLUSTER_KEY,
+            fail_silently=True,
+            cluster_id=env.SUPERVISOR_CLUSTER_ID,
+        ) as cli:
+            resp = cli.add_node(
+                data=data.get_metadata()
+            )
+            if not resp.success:
+                raise ValueError(f'connect to supervisor failed with error: {resp.text}')
+
+            if resp.result:
+                # supervisor is returned (cannot access)
+                supervisor_obj = save_supervisor(resp.result)
+                if not supervisor_obj.node_id or supervisor_obj.node_id != resp.result.node_id:
+                    raise ValueError(f'supervisor failed to create: inconsistent node id: '
+                                     f'{supervisor_obj.node_id}, {resp.result.node_id}')
+            else:
+                # supervisor already updated in POST OperationsAPI/
+                supervisor_obj: Supervisor = Supervisor.objects.get(pk=supervisor_obj.pk)
+
+                # update after
+                if not supervisor_obj.node_id:
+                    raise ValueError('supervisor failed to create')
+
+            if supervisor_obj.node_id:
+                service.node_id = supervisor_obj.node_id
+                # save node here so that resources can be synced
+                service.save(update_fields=['node_id'])
+
+            update_service_supervisor(supervisor_obj)
+            if not supervisor_obj.local:
+                if not supervisor_obj.public_key:
+                    raise ValueError('supervisor failed to create: no public key')
+
+            defer_change(changes, supervisor_cache.refresh, supervisor_obj)
+
+    except Exception as e:
+        if supervisor_obj.node_id:
+            defer_change(changes, supervisor_cache.invalidate, supervisor_obj.node_id)
+        supervisor_obj.delete()
+        raise e
+
+    # sync after connect
+    sync_supervisor(service, resources=resources, resources_etag=resources_etag, changes=changes)
+
+
+@adapt_async(close_conn=ops_config.db_alias)
+def sync_service(service_id, data: RegistrySchema, resources: dict = None, resources_etag: str = None,
+                 changes: List[tuple] = None, lock: ContextManager = None) -> bool:
+    """
+    Connect or sync the service in a worker thread, holding the lock of the service across the workers,
+    so that the service is connected only once and the other workers sync to the connected node
+    :return: False if the service is not found
+    """
+    with lock or nullcontext():
+        # reload the service, the node may be connected by the previous job or another worker
+        service = Service.objects.filter(pk=service_id).first()
+        if service is None:
+            return False
+        if not service.node_id:
+            connect_supervisor(service, data=data, resources=resources,
+                               resources_etag=resources_etag, changes=changes)
+        elif resources:
+            sync_supervisor(service, resources=resources, resources_etag=resources_etag, changes=changes)
+    return True
+
+
+class SyncJob:
+    """
+    Pending connect / resources sync of a service, the registrations that arrive before it runs
+    replace the payload, so that only the latest resources are uploaded
+    """
+    __slots__ = ('service_id', 'data', 'resources', 'resources_etag', 'status', 'error',
+                 'attempts', 'due', 'dirty', 'synced_etag')
+
+    def __init__(self, service_id):
+        self.service_id = service_id
+        self.data: Optional[RegistrySchema] = None
+        self.resources = None
+        self.resources_etag = None
+        self.status = None
+        # pending / syncing / synced / retrying / failed
+        self.error = None
+        self.attempts = 0
+        self.due = 0.0
+        self.dirty = False
+        # updated while syncing, run again after the current one
+        self.synced_etag = None
+
+    def update(self, data: RegistrySchema, resources: dict = None, resources_etag: str = None):
+        self.data = data
+        if resources:
+            self.resources = resources
+            self.resources_etag = resources_etag
+
+    @property
+    def pending(self) -> bool:
+        return self.status in ('pending', 'retrying')
+
+
+class SupervisorSync:
+    """
+    Background queue of the supervisor connect / resources sync of the registered services,
+    so that the registering instance does not wait for the supervisor.
+    Jobs are deduplicated by service and delayed by a short window to coalesce a fleet restart
+    into one upload, failed jobs are retried with exponential backoff.
+    The workers of the host run the jobs of a service one at a time (by the lock), so only one connects it
+    """
+    def __init__(self,
+                 window: float = env.SUPERVISOR_SYNC_WINDOW,
+                 concurrency: int = env.SUPERVISOR_SYNC_CONCURRENCY,
+                 max_retries: int = env.SUPERVISOR_SYNC_RETRIES,
+                 retry_delay: float = env.SUPERVISOR_SYNC_RETRY_DELAY,
+                 max_retry_delay: float = env.SUPERVISOR_SYNC_MAX_RETRY_DELAY):
+        self.window = window
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.jobs: Dict[str, SyncJob] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        self._event: Optional[asyncio.Event] = None
+        self._task = None
+        self.lock: Optional[Callable[[str], ContextManager]] = None
+        # service id -> lock across the worker processes, jobs are only deduplicated in process without it
+
+    def get(self, service_id) -> Optional[SyncJob]:
+        return self.jobs.get(str(service_id))
+
+    def submit(self, service: Service, data: RegistrySchema,
+               resources: dict = None, resources_etag: str = None) -> Optional[SyncJob]:
+        """
+        :return: the job of the service, None if there is nothing to sync
+        """
+        key = str(service.pk)
+        job = self.jobs.get(key)
+        if service.node_id and not resources:
+            # connected, the instance sent no resources (etag is checked by the instance)
+            return job
+        if job is None:
+            job = self.jobs[key] = SyncJob(key)
+        elif service.node_id and job.status == 'synced' and resources_etag and resources_etag == job.synced_etag:
+            return job
+        job.update(data, resources=resources, resources_etag=resources_etag)
+        if job.status == 'syncing':
+            job.dirty = True
+            return job
+        if not job.pending:
+            job.due = time.monotonic() + self.window
+        job.status = 'pending'
+        job.attempts = 0
+        job.error = None
+        # started by the first submitted job
+        self.start()
+        if self._event:
+            self._event.set()
+        return job
+
+    async def run_job(self, job: SyncJob):
+        data, resources, resources_etag = job.data, job.resources, job.resources_etag
+        job.status = 'syncing'
+        job.dirty = False
+        try:
+            changes = []
+            try:
+                found = await run_in_threadpool(
+                    sync_service, job.service_id, data=data, resources=resources, resources_etag=resources_etag,
+                    changes=changes, lock=self.lock(job.service_id) if self.lock else None
+                )
+            finally:
+                # the supervisor cache changes (and the published invalidations) are applied in the loop thread
+                for func, args in changes:
+                    func(*args)
+            if not found:
+                self.jobs.pop(job.service_id, None)
+                return
+        except Exception as e:
+            job.attempts += 1
+            job.error = str(e)
+            print(f'supervisor sync of service [{job.service_id}] failed '
+                  f'(attempt {job.attempts}) with error: {e}')
+            if job.dirty:
+                # retry the newer payload right away
+                job.attempts = 0
+                job.status = 'pending'
+                job.due = time.monotonic() + self.window
+            elif job.attempts > self.max_retries:
+                job.status = 'failed'
+            else:
+                job.status = 'retrying'
+                job.due = time.monotonic() + min(self.retry_delay * 2 ** (job.attempts - 1), self.max_retry_delay)
+        else:
+            job.error = None
+            job.attempts = 0
+            job.synced_etag = resources_etag
+            if job.dirty and job.resources_etag != resources_etag:
+                job.status = 'pending'
+                job.due = time.monotonic() + self.window
+            else:
+                job.status = 'synced'
+        finally:
+            job.dirty = False
+            self.running.pop(job.service_id, None)
+            if self._event:
+                self._event.set()
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            wait = None
+            for key, job in list(self.jobs.items()):
+                if not job.pending or key in self.running:
+                    continue
+                if job.due > now:
+                    wait = job.due - now if wait is None else min(wait, job.due - now)
+                    continue
+                if len(self.running) >= self.concurrency:
+                    break
+                self.running[key] = asyncio.ensure_future(self.run_job(job))
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        running = list(self.running.values())
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        self.running.clear()
+
+
+supervisor_sync = SupervisorSync()
@@ -0,0 +1,213 @@
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple, Set
+
+VERSION_REGEX = re.compile(
+    r'^v?(?P<major>\d+|[*xX])(?:\.(?P<minor>\d+|[*xX]))?(?:\.(?P<patch>\d+|[*xX]))?'
+    r'(?:-(?P<prerelease>[0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$'
+)
+COMPARATOR_REGEX = re.compile(r'^(\^|~|>=|<=|>|<|==|=)?\s*(.+)$')
+LOOSE_VERSION_REGEX = re.compile(r'^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(.*)$', re.IGNORECASE)
+LOOSE_PRERELEASE_REGEX = re.compile(
+    r'^[._-]?(alpha|beta|preview|pre|rc|a|b|c|dev|snapshot)[._-]?(\d*)', re.IGNORECASE)
+WILDCARDS = ('*', 'x', 'X')
+
+
+class Version(NamedTuple):
+    major: int
+    minor: int = 0
+    patch: int = 0
+    prerelease: Tuple[str, ...] = ()
+
+    def __str__(self):
+        version = f'{self.major}.{self.minor}.{self.patch}'
+        if self.prerelease:
+            version += '-' + '.'.join(self.prerelease)
+        return version
+
+    @property
+    def release(self) -> Tuple[int, int, int]:
+        return self.major, self.minor, self.patch
+
+    @property
+    def key(self) -> tuple:
+        # semver precedence: 1.0.0-alpha < 1.0.0-alpha.1 < 1.0.0-beta < 1.0.0
+        if not self.prerelease:
+            return self.major, self.minor, self.patch, 1, ()
+        return self.major, self.minor, self.patch, 0, tuple(
+            (0, int(ident)) if ident.isdigit() else (1, ident) for ident in self.prerelease
+        )
+
+
+@lru_cache(maxsize=1024)
+def parse_version(version: str) -> Optional[Version]:
+    """
+    parse a full version like 1.2.3 / v1.2.3-beta.1 / 1.2.3+build, partial version like 1.2 is filled with 0
+    """
+    match = VERSION_REGEX.match(str(version or '').strip())
+    if not match:
+        return None
+    parts = [match.group('major'), match.group('minor'), match.group('patch')]
+    if any(p in WILDCARDS for p in parts):
+        return None
+    prerelease = match.group('prerelease')
+    return Version(
+        *[int(p) if p else 0 for p in parts],
+        prerelease=tuple(prerelease.split('.')) if prerelease else ()
+    )
+
+
+@lru_cache(maxsize=1024)
+def parse_loose_version(version: str) -> Optional[Version]:
+    """
+    parse the leading integers of a version that is not semver, like 1.2.3.post1 / 1.0.0rc1 / 2.1-SNAPSHOT,
+    a pre-release / dev suffix (PEP 440 / maven) is kept as pre-release so it is not routed as the release
+    """
+    match = LOOSE_VERSION_REGEX.match(str(version or '').strip())
+    if not match:
+        return None
+    major, minor, patch, suffix = match.groups()
+    prerelease = ()
+    pre = LOOSE_PRERELEASE_REGEX.match(suffix)
+    if pre:
+        name, number = pre.groups()
+        prerelease = (name.lower(), number) if number else (name.lower(),)
+    return Version(int(major), int(minor or 0), int(patch or 0), prerelease=prerelease)
+
+
+class VersionRange:
+    """
+    Compiled accept version expression, a range of [lower, upper] version keys
+    """
+    def __init__(self, lower: tuple = None, lower_inclusive: bool = True,
+                 upper: tuple = None, upper_inclusive: bool = False,
+                 prereleases: Set[Tuple[int, int, int]] = None):
+        self.lower = lower
+        self.lower_inclusive = lower_inclusive
+        self.upper = upper
+        self.upper_inclusive = upper_inclusive
+        self.prereleases = prereleases or set()
+        # releases (major, minor, patch) that allows pre-release versions
+
+    def __repr__(self):
+        lower = ('[' if self.lower_inclusive else '(') + str(self.lower)
+        upper = str(self.upper) + (']' if self.upper_inclusive else ')')
+        return f'{self.__class__.__name__}({lower}, {upper})'
+
+    def intersect(self, other: 'VersionRange') -> 'VersionRange':
+        lower, lower_inclusive = self.lower, self.lower_inclusive
+        if other.lower is not None and (lower is None or other.lower > lower or (
+                other.lower == lower and not other.lower_inclusive)):
+            lower, lower_inclusive = other.lower, other.lower_inclusive
+        upper, upper_inclusive = self.upper, self.upper_inclusive
+        if other.upper is not None and (upper is None or other.upper < upper or (
+                other.upper == upper and not other.upper_inclusive)):
+            upper, upper_inclusive = other.upper, other.upper_inclusive
+        return VersionRange(
+            lower, lower_inclusive, upper, upper_inclusive,
+            prereleases=self.prereleases | other.prereleases
+        )
+
+    def contains(self, version: Version) -> bool:
+        key = version.key
+        if self.lower is not None:
+            if key < self.lower or (key == self.lower and not self.lower_inclusive):
+                return False
+        if self.upper is not None:
+            if key > self.upper or (key == self.upper and not self.upper_inclusive):
+                return False
+        return self.allows(version)
+
+    def allows(self, version: Version) -> bool:
+        # pre-release versions only satisfy the expression that pins a pre-release of the same release
+        # so that 1.* will not be routed to a 1.3.0-rc.1 canary
+        return not version.prerelease or version.release in self.prereleases
+
+
+def _release(major: int, minor: int = 0, patch: int = 0) -> tuple:
+    return Version(major, minor, patch).key
+
+
+def _compile_comparator(op: str, version: str) -> VersionRange:
+    match = VERSION_REGEX.match(version)
+    if not match:
+        raise ValueError(f'Invalid version: {repr(version)}')
+    parts = []
+    for p in [match.group('major'), match.group('minor'), match.group('patch')]:
+        if not p or p in WILDCARDS:
+            break
+        parts.append(int(p))
+    prerelease = match.group('prerelease')
+    if not parts:
+        if op in ('<', '>'):
+            # <* / >* matches nothing
+            return VersionRange(upper=_release(0), upper_inclusive=False)
+        return VersionRange()
+
+    full = len(parts) == 3
+    if prerelease and not full:
+        raise ValueError(f'Invalid version: {repr(version)}, pre-release requires a full version')
+    exact = Version(*parts, prerelease=tuple(prerelease.split('.')) if prerelease else ())
+    prereleases = {exact.release} if prerelease else set()
+    major, minor, patch = (parts + [0, 0])[:3]
+
+    # the first version after the partial version: 1 -> 2.0.0, 1.2 -> 1.3.0
+    if len(parts) == 1:
+        bump = _release(major + 1)
+    elif len(parts) == 2:
+        bump = _release(major, minor + 1)
+    else:
+        bump = None
+
+    if op in (None, '=', '=='):
+        if full:
+            return VersionRange(exact.key, True, exact.key, True, prereleases=prereleases)
+        return VersionRange(exact.key, True, bump, False)
+    if op == '^':
+        if major:
+            upper = _release(major + 1)
+        elif minor or len(parts) == 2:
+            upper = _release(0, minor + 1)
+        elif len(parts) == 3:
+            upper = _release(0, 0, patch + 1)
+        else:
+            upper = _release(1)
+        return VersionRange(exact.key, True, upper, False, prereleases=prereleases)
+    if op == '~':
+        upper = _release(major + 1) if len(parts) == 1 else _release(major, minor + 1)
+        return VersionRange(exact.key, True, upper, False, prereleases=prereleases)
+    if op == '>=':
+        return VersionRange(exact.key, True, prereleases=prereleases)
+    if op == '>':
+        if full:
+            return VersionRange(exact.key, False, prereleases=prereleases)
+        return VersionRange(bump, True)
+    if op == '<':
+        return VersionRange(upper=exact.key, upper_inclusive=False, prereleases=prereleases)
+    if op == '<=':
+        if full:
+            return VersionRange(upper=exact.key, upper_inclusive=True, prereleases=prereleases)
+        return VersionRange(upper=bump, upper_inclusive=False)
+    raise ValueError(f'Invalid version operator: {repr(op)}')
+
+
+@lru_cache(maxsize=1024)
+def compile_version_range(expression: str) -> VersionRange:
+    """
+    Compile accept version expression, comparators separated by space or comma are intersected
+    * / 1 / 1.* / 1.2 / 1.2.3 / 1.2.3-beta.1
+    ^1.2.3 / ~1.2.3 / >=1.2 / >1.2.3 / <2 / <=1.4 / >=1.2 <2
+    """
+    version_range = VersionRange()
+    comparators = [c for c in re.split(r'[\s,]+', str(expression or '').strip()) if c]
+    for i, comparator in enumerate(comparators):
+        if comparator in ('^', '~', '>=', '<=', '>', '<', '=', '==') and i + 1 < len(comparators):
+            # operator separated from version by space: >= 1.2
+            comparators[i + 1] = comparator + comparators[i + 1]
+            continue
+        match = COMPARATOR_REGEX.match(comparator)
+        if not match:
+            raise ValueError(f'Invalid version expression: {repr(expression)}')
+        op, version = match.groups()
+        version_range = version_range.intersect(_compile_comparator(op, version))
+    return version_range
@@ -1,9 +1,43 @@
 from utilmeta_proxy.config.service import service
+from utilmeta_proxy.config.env import env
 from utilmeta_proxy.service.connect import connect_to_supervisor
+from utilmeta_proxy.service.workers import worker_bus, share_state, run_workers, metrics_share
+from utilmeta_proxy.service.proxy.pool import upstream_pool
+from utilmeta_proxy.service.proxy.stats import instance_stats
+from utilmeta_proxy.service.proxy.health import health_checker
+from utilmeta_proxy.service.proxy.tunnel import get_websocket_routes
+from utilmeta_proxy.service.proxy.tracing import tracer
+from utilmeta_proxy.domain.service.routing import routing_table
+from utilmeta_proxy.domain.service.sync import supervisor_sync
+from utilmeta.utils import omit
 
 app = service.application()
+# WebSocket upgrades are not handled by the API classes, route them to the tunnel
+app.router.routes.extend(get_websocket_routes(service.root_url))
 
-connect_to_supervisor()
+share_state(worker_bus)
+# host-wide tasks run in the leader worker only, the results are shared to the other workers
+worker_bus.on_leader(health_checker.start)
+# connect in a thread, it waits for the OperationsAPI of this service to be live
+worker_bus.on_leader(omit(connect_to_supervisor))
+
+service.on_startup(worker_bus.start)
+service.on_startup(metrics_share.start)
+service.on_startup(instance_stats.start_flush)
+service.on_startup(tracer.start)
+# the routing changes are published on a best-effort bus, every worker reconciles with the database
+service.on_startup(routing_table.start)
+service.on_shutdown(routing_table.stop)
+service.on_shutdown(instance_stats.stop_flush)
+service.on_shutdown(health_checker.stop)
+service.on_shutdown(metrics_share.stop)
+service.on_shutdown(worker_bus.stop)
+service.on_shutdown(tracer.stop)
+service.on_shutdown(supervisor_sync.stop)
+service.on_shutdown(upstream_pool.aclose)
 
 if __name__ == '__main__':
-    service.run()
+    if env.WORKERS > 1:
+        run_workers(service, workers=env.WORKERS)
+    else:
+        service.run()
@@ -1,8 +1,12 @@
-from utilmeta.core import api, response
+import hmac
+from ipaddress import ip_address
+from utilmeta.core import api, request, response
 from utilmeta.ops import __spec_version__
+from utilmeta.utils import exceptions
 from utilmeta_proxy.config.env import env
 from utilmeta_proxy.domain.service.api import RegistryAPI
 from .proxy.api import ProxyAPI
+from utilmeta_proxy.service.proxy.metrics import proxy_metrics, CONTENT_TYPE
 
 
 class ErrorResponse(response.Response):
@@ -29,6 +33,33 @@ class RootAPI(api.API):
             'proxy_url': '/proxy',
         }
 
+    @api.get('metrics')
+    def metrics(self, authorization: str = request.HeaderParam('Authorization', default=None)):
+        if not proxy_metrics.enabled:
+            raise exceptions.NotFound
+        if env.METRICS_TOKEN:
+            scheme, _, token = str(authorization or '').partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip(), env.METRICS_TOKEN):
+                raise exceptions.Unauthorized
+        elif not self.is_private_source():
+            # the metrics expose the services, instances and error rates, served to the intranet only without a token
+            raise exceptions.PermissionDenied('metrics: METRICS_TOKEN is required to scrape from a public address')
+        return response.Response(content=proxy_metrics.render(), content_type=CONTENT_TYPE)
+
+    def is_private_source(self) -> bool:
+        """
+        Both the connected peer and the forwarded client address (X-Forwarded-For can be set by anyone)
+        should be loopback or private
+        """
+        addresses = [self.request.ip_address]
+        client = getattr(self.request.adaptor.request, 'client', None)
+        if client and getattr(client, 'host', None):
+            try:
+                addresses.append(ip_address(client.host))
+            except ValueError:
+                return False
+        return all(addr is not None and addr.is_private for addr in addresses)
+
     @api.handle('*')
     def handle_errors(self, error) -> ErrorResponse:
         return ErrorResponse(error=error)
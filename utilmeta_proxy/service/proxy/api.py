@@ -1,13 +1,35 @@
-from utilmeta.core import api, request, cli, response
+import asyncio
+import random
+from utilmeta.core import api, request, response
 from utype.types import *
-from utilmeta.utils import exceptions, DEFAULT_IDEMPOTENT_METHODS, DEFAULT_RETRY_ON_STATUSES, Headers, is_hop_by_hop
-from django.db import models
+from time import perf_counter
+from utilmeta.utils import exceptions, DEFAULT_IDEMPOTENT_METHODS, DEFAULT_RETRY_ON_STATUSES, HAS_BODY_METHODS, \
+    Headers, Error, is_hop_by_hop
 from utilmeta.ops.config import Operations
 from utilmeta.ops.log import request_logger, Logger
 from utilmeta_proxy.config.env import env, CLUSTER_KEY
 from utilmeta_proxy.domain.service.models import Service, Instance
+from utilmeta_proxy.domain.service.routing import routing_table, ServiceRoute
+from utilmeta_proxy.domain.service.supervisor import supervisor_cache
+from utilmeta_proxy.service.proxy.pool import upstream_pool, tunnel_limiter, is_http2_enabled, StreamResponse, \
+    UpstreamTrace
+from utilmeta_proxy.service.proxy.stats import instance_stats
+from utilmeta_proxy.service.proxy.balancer import get_load_balancer
+from utilmeta_proxy.service.proxy.health import health_checker
+from utilmeta_proxy.service.proxy.breaker import instance_breakers
+from utilmeta_proxy.service.proxy.hedge import get_hedge_policy, HedgePolicy
+from utilmeta_proxy.service.proxy.retry import Deadline, retry_budget
+from utilmeta_proxy.service.proxy.tokens import token_cache, VerifiedToken
+from utilmeta_proxy.service.proxy.coalesce import single_flight, is_coalesce_enabled, get_vary_headers, \
+    copy_response, COALESCE_METHODS, UNCOALESCED_HEADERS
+from utilmeta_proxy.service.proxy.cache import response_cache, is_cache_enabled
+from utilmeta_proxy.service.proxy.compress import compress_response
+from utilmeta_proxy.service.proxy.metrics import proxy_metrics, observe_lookup, get_instance_label, \
+    active_requests, requests_total, request_duration, upstream_duration, upstream_connect, retries_total
+from utilmeta_proxy.service.proxy.tracing import tracer, Span
 
 UTILMETA_HEADER_PREFIX = 'x-utilmeta-'
+TIMING_PHASES = ('auth', 'route', 'connect', 'upstream', 'transfer', 'retry', 'total')
 EXCLUDE_HEADERS = [
     'content-length',
     'x-forwarded-for',
@@ -21,6 +43,48 @@ def forward_header(header):
             and not is_hop_by_hop(header) and header not in EXCLUDE_HEADERS)
 
 
+async def stamp_source(ip_address, headers: Headers, timings: Dict[str, float] = None):
+    """
+    Identify the calling instance / service of a discovery request and stamp it to the forwarded headers
+    """
+    if env.PRIVATE:
+        if not ip_address.is_private:
+            raise exceptions.NotFound
+    instance, service_id = await observe_lookup('source', routing_table.identify(ip_address), timings=timings)
+    if instance or service_id:
+        if instance and instance.remote_id:
+            headers['x-utilmeta-source-instance-id'] = instance.remote_id
+        headers['x-utilmeta-source-service'] = str(service_id)
+    else:
+        if env.VALIDATE_FORWARD_IPS:
+            raise exceptions.NotFound
+
+
+def select_instances(route: ServiceRoute, instance_id: str = None, accept_version: str = None) -> List[Instance]:
+    if instance_id:
+        instance = routing_table.get_instance(instance_id)
+        return [instance] if instance and instance.service_id == route.service.pk else []
+    if accept_version and accept_version != '*':
+        try:
+            return route.match_version(accept_version)
+        except ValueError:
+            raise exceptions.BadRequest(f'Invalid accept version: {repr(accept_version)}')
+    return route.connected
+
+
+def rank_instances(service: Optional[Service], instances: List[Instance]) -> List[Instance]:
+    connected = health_checker.filter([inst for inst in instances if inst.connected])
+    if not connected:
+        raise exceptions.ServiceUnavailable
+    connected = instance_breakers.filter(connected)
+    if not connected:
+        # circuits of all the instances are open
+        raise exceptions.ServiceUnavailable
+    if len(connected) == 1:
+        return connected
+    return get_load_balancer(service).order(connected)
+
+
 # @api.CORS(allow_origin='*')
 class ProxyAPI(api.API):
     # 1. reverse-proxy from supervisor (for All apis includes OperationsAPI)
@@ -54,7 +118,7 @@ class ProxyAPI(api.API):
     ] = request.HeaderParam('X-UtilMeta-Proxy-Type', alias_from=[
         'x-proxy-type'
     ], default=None)
-    timeout: int = request.HeaderParam('X-UtilMeta-Request-Timeout', alias_from=[
+    timeout: float = request.HeaderParam('X-UtilMeta-Request-Timeout', alias_from=[
         'x-request-timeout'
     ], default=env.DEFAULT_TIMEOUT)
 
@@ -72,6 +136,16 @@ class ProxyAPI(api.API):
         self.base_url = None
         self.instance = None
         self.retries = 0
+        self.hedged = False
+        self.coalesced = False
+        self.cache_status = None
+        self.upstream_ms = None
+        # duration of the last upstream attempt until the response headers
+        self.timings: Dict[str, float] = {}
+        # phase -> ms, written to server-timing
+        self.streaming = env.STREAMING
+        self.event_stream = 'text/event-stream' in str(self.request.headers.get('accept') or '').lower()
+        self.deadline = Deadline(self.timeout or env.DEFAULT_TIMEOUT)
         self.token_type, self.token = self.request.authorization
         self.headers = Headers({k: v for k, v in self.request.headers.items() if forward_header(k)})
         if self.operation_idempotent is None:
@@ -79,33 +153,419 @@ class ProxyAPI(api.API):
 
         self.logger: Logger = request_logger.getter(self.request)
         self.logger.make_events_only(True)
+        self.started = perf_counter()
+        self.recorded = False
+        if proxy_metrics.enabled:
+            active_requests[self] = self.proxy_type or ''
+        self.span: Optional[Span] = tracer.start_span(
+            f'proxy {self.request.adaptor.request_method}',
+            traceparent=self.request.headers.get('traceparent'),
+            tracestate=self.request.headers.get('tracestate'),
+            attributes={
+                'http.request.method': str(self.request.adaptor.request_method).upper(),
+                'url.path': self.request.path,
+                'client.address': str(self.request.ip_address),
+                'utilmeta.proxy.type': self.proxy_type,
+            }
+        ) if tracer.active else None
 
     async def make_request(self, path: str):
+        if self.event_stream:
+            return await self.make_event_stream_request(path)
+        if self.should_cache():
+            resp = await self.make_cached_request(path)
+        else:
+            resp = await self.send_request(path)
+        return compress_response(
+            resp,
+            accept_encoding=self.request.headers.get('accept-encoding'),
+            method=self.request.adaptor.request_method
+        )
+
+    async def make_event_stream_request(self, path: str):
+        """
+        Server-sent events are relayed as they arrive and hold the connection,
+        so they are not cached / coalesced / hedged, and count to the tunnel connections
+        """
+        if not tunnel_limiter.acquire():
+            raise exceptions.ServiceUnavailable('Too many tunnel connections')
+        self.streaming = True
+        try:
+            resp = await self.make_upstream_request(path)
+        except BaseException:
+            tunnel_limiter.release()
+            raise
+        if isinstance(resp, StreamResponse):
+            resp.on_close(tunnel_limiter.release)
+        else:
+            tunnel_limiter.release()
+        return resp
+
+    async def send_request(self, path: str):
+        if self.should_coalesce():
+            return await self.make_coalesced_request(path)
+        return await self.make_upstream_request(path)
+
+    def should_cache(self) -> bool:
+        if not response_cache.enabled:
+            return False
+        if not response_cache.is_cacheable_request(self.request.adaptor.request_method, self.request.headers):
+            return False
+        return is_cache_enabled(self.service)
+
+    async def make_cached_request(self, path: str):
+        primary = response_cache.get_primary_key(
+            self.proxy_type,
+            self.service.pk if self.service else self.base_urls,
+            self.node_id,
+            self.instance_id,
+            self.accept_version,
+            path,
+            self.request.adaptor.query_string,
+        )
+        request_headers = self.request.headers
+        entry = await response_cache.get(primary, request_headers)
+        if entry:
+            if entry.is_fresh_for(request_headers):
+                self.cache_status = 'hit'
+                return entry.to_response(request_headers)
+            # revalidate with the stored validators, the conditions of the client are handled by the entry
+            for key in ('if-none-match', 'if-modified-since'):
+                self.headers.pop(key, None)
+            if entry.etag:
+                self.headers['if-none-match'] = entry.etag
+            if entry.last_modified:
+                self.headers['if-modified-since'] = entry.last_modified
+
+        resp = await self.send_request(path)
+        if resp.is_aborted:
+            self.cache_status = 'miss'
+            return resp
+        if entry and resp.status == 304 and (entry.etag or entry.last_modified):
+            await resp.aclose()
+            entry = entry.revalidated(resp.headers, lifetime=response_cache.get_lifetime(resp.headers))
+            await response_cache.set(primary, request_headers, entry)
+            self.cache_status = 'revalidated'
+            return entry.to_response(request_headers)
+
+        self.cache_status = 'miss'
+        if str(self.request.adaptor.request_method).upper() != 'GET':
+            return resp
+        status = resp.status
+        headers = Headers(dict(resp.headers))
+
+        def store(body: bytes):
+            cache_entry = response_cache.make_entry(status, headers, body, request_headers)
+            if cache_entry:
+                asyncio.ensure_future(response_cache.set(primary, request_headers, cache_entry))
+
+        if isinstance(resp, StreamResponse):
+            resp.tee(store, max_size=response_cache.max_entry_size)
+        else:
+            store(resp.body)
+        return resp
+
+    def should_coalesce(self) -> bool:
+        if str(self.request.adaptor.request_method).upper() not in COALESCE_METHODS:
+            return False
+        if self.request.content_length or self.request.headers.get('transfer-encoding'):
+            return False
+        # the outgoing headers: conditions of the client or the validators of a cache revalidation
+        if any(self.headers.get(header) for header in UNCOALESCED_HEADERS):
+            return False
+        return is_coalesce_enabled(self.service)
+
+    def get_coalesce_key(self, path: str) -> tuple:
+        return (
+            str(self.request.adaptor.request_method).upper(),
+            self.proxy_type,
+            self.service.pk if self.service else tuple(self.base_urls),
+            self.node_id,
+            self.instance_id,
+            self.accept_version,
+            path,
+            self.request.adaptor.query_string,
+            tuple(self.request.headers.get(header) for header in get_vary_headers()),
+        )
+
+    async def make_coalesced_request(self, path: str):
+        """
+        Identical concurrent safe requests share one upstream call,
+        the response is buffered (not streamed) so that it can be fanned out to all the waiters
+        """
+        self.streaming = False
+
+        async def call():
+            return await self.make_upstream_request(path), self.base_url, self.instance, self.retries
+
+        (resp, base_url, instance, retries), shared = await single_flight.do(self.get_coalesce_key(path), call)
+        if not shared:
+            return resp
+        self.coalesced = True
+        self.base_url = base_url
+        self.instance = instance
+        self.retries = retries
+        return copy_response(resp)
+
+    async def make_upstream_request(self, path: str):
         if not self.base_urls:
             raise exceptions.NotFound
-        for i, base_url in enumerate(self.base_urls):
-            with cli.Client(
-                base_url=base_url,
-                default_timeout=self.timeout,
-                fail_silently=True
-            ) as client:
-                resp = await client.async_request(
-                    method=self.request.adaptor.request_method,
-                    path=path,
-                    query=self.request.query,
-                    headers=dict(self.headers),
-                    data=await self.request.aread(),
-                )
-                self.base_url = base_url
-                if self.instances:
-                    try:
-                        self.instance = self.instances[i]
-                    except IndexError:
-                        pass
-                if not self.should_retry(resp) or i == len(self.base_urls) - 1:
-                    # should not retry of its the last response
-                    return resp
+        content = await self.get_request_content()
+        hedge = get_hedge_policy(self.service) \
+            if self.operation_idempotent and len(self.base_urls) > 1 and not self.event_stream else None
+        if hedge:
+            hedge.deposit()
+        resp = None
+        i = 0
+        while i < len(self.base_urls):
+            base_url = self.base_urls[i]
+            instance = self.instances[i] if i < len(self.instances) else None
+            i += 1
+            if resp is not None and (self.deadline.expired or self.retries + 1 >= self.deadline.max_attempts):
+                break
+            if instance and not instance_breakers.acquire(instance.pk):
+                # circuit is open or the half-open probe budget is used up
+                continue
+            if resp is not None:
+                if not retry_budget.withdraw():
+                    # retry budget exhausted: the cluster is unhealthy, do not multiply the load
+                    if instance:
+                        instance_breakers.release(instance.pk)
+                    break
+                await resp.aclose()
                 self.retries += 1
+            elif self.deadline.expired:
+                if instance:
+                    instance_breakers.release(instance.pk)
+                raise exceptions.GatewayTimeout
+            attempts = min(len(self.base_urls) - i + 1, self.deadline.max_attempts - self.retries) \
+                if self.operation_idempotent else 1
+            timeout = self.deadline.get_timeout(attempts)
+            if hedge and i < len(self.base_urls):
+                resp, i = await self.make_hedged_request(hedge, path, content, base_url, instance, i, timeout)
+            else:
+                resp = await self.make_attempt(path, content, base_url, instance, timeout, hedge=hedge)
+            if not instance_breakers.is_failure(resp):
+                retry_budget.deposit()
+            if not self.should_retry(resp):
+                return resp
+        if resp is None:
+            raise exceptions.ServiceUnavailable
+        # should not retry of its the last response
+        return resp
+
+    async def make_attempt(self, path: str, content, base_url: str, instance: Instance = None,
+                           timeout: float = None, hedge: HedgePolicy = None) -> response.Response:
+        resp, upstream_ms, trace = await self.send_attempt(path, content, base_url, instance, timeout, hedge=hedge)
+        self.apply_attempt(base_url, instance, upstream_ms, trace)
+        return resp
+
+    async def send_attempt(self, path: str, content, base_url: str, instance: Instance = None,
+                           timeout: float = None, hedge: HedgePolicy = None) -> tuple:
+        """
+        Send an attempt without changing the state of the request (the hedged attempts run concurrently),
+        the state is applied by apply_attempt for the attempt whose response is used
+        :return: the response, the duration (ms) and the trace of the attempt
+        """
+        started = instance_stats.start(instance.pk) if instance else None
+        timeout = timeout or self.deadline.get_timeout()
+        headers = dict(self.headers)
+        # propagate the remaining deadline so that the nested hops (proxy / service) can respect it
+        headers['x-utilmeta-request-timeout'] = f'{timeout:.3f}'
+        resp = None
+        span = self.start_attempt_span(base_url, instance)
+        if span:
+            headers['traceparent'] = span.traceparent
+            if span.tracestate:
+                headers['tracestate'] = span.tracestate
+            else:
+                headers.pop('tracestate', None)
+        trace = UpstreamTrace() if proxy_metrics.enabled or env.SERVER_TIMING else None
+        sent = perf_counter()
+        try:
+            resp = await upstream_pool.request(
+                base_url,
+                method=self.request.adaptor.request_method,
+                path=path,
+                query_string=self.request.adaptor.query_string,
+                headers=headers,
+                content=content,
+                timeout=timeout,
+                stream=self.streaming,
+                # event stream can be silent between the events longer than the request timeout
+                idle_timeout=env.TUNNEL_IDLE_TIMEOUT if self.event_stream else None,
+                http2=self.use_http2(),
+                trace=trace,
+            )
+        except asyncio.CancelledError:
+            if instance:
+                instance_stats.cancel(instance.pk)
+                instance_breakers.release(instance.pk)
+            if span:
+                # like the loser of a hedged request
+                span.set_attribute('utilmeta.proxy.cancelled', True)
+                span.end()
+            raise
+        finally:
+            if instance and resp is not None:
+                duration_ms = instance_stats.finish(
+                    instance.pk, started, error=resp.is_aborted or resp.status >= 500)
+                instance_breakers.record(instance.pk, resp, duration_ms)
+                if hedge and not instance_breakers.is_failure(resp):
+                    hedge.record(duration_ms)
+        upstream_ms = round((perf_counter() - sent) * 1000, 3)
+        if trace and proxy_metrics.enabled:
+            labels = (self.proxy_type, self.get_service_label(), get_instance_label(instance))
+            upstream_duration.observe(labels, upstream_ms / 1000)
+            if trace.connect_ms is not None:
+                upstream_connect.observe(labels, trace.connect_ms / 1000)
+        if span:
+            self.end_attempt_span(span, resp, trace)
+        return resp, upstream_ms, trace
+
+    def apply_attempt(self, base_url: str, instance: Optional[Instance], upstream_ms: float,
+                      trace: UpstreamTrace = None):
+        if self.upstream_ms is not None:
+            # the previous attempt is retried
+            self.add_timing('retry', self.upstream_ms)
+        self.upstream_ms = upstream_ms
+        if trace:
+            self.set_attempt_timings(trace)
+        if instance:
+            self.instance = instance
+        self.base_url = base_url
+
+    def start_attempt_span(self, base_url: str, instance: Instance = None) -> Optional[Span]:
+        if not self.span:
+            return None
+        return self.span.child(f'upstream {self.request.adaptor.request_method}', attributes={
+            'http.request.method': str(self.request.adaptor.request_method).upper(),
+            'server.address': base_url,
+            'utilmeta.instance.id': get_instance_label(instance) or None,
+            'utilmeta.proxy.attempt': self.retries + 1,
+        })
+
+    @classmethod
+    def end_attempt_span(cls, span: Span, resp: response.Response, trace: UpstreamTrace = None):
+        if resp.is_aborted:
+            error = resp.error
+            if error:
+                span.set_attribute('error.type', type(error.exception).__name__)
+            span.set_error(str(error.exception) if error else 'upstream request aborted')
+        else:
+            span.set_attribute('http.response.status_code', resp.status)
+            if resp.status >= 500:
+                span.set_error()
+        if trace and trace.connect_ms is not None:
+            span.set_attribute('utilmeta.proxy.connect_ms', round(trace.connect_ms, 3))
+        span.end()
+
+    def add_timing(self, phase: str, duration_ms: float):
+        self.timings[phase] = self.timings.get(phase, 0) + duration_ms
+
+    def set_attempt_timings(self, trace: UpstreamTrace):
+        """
+        Phases of the last upstream attempt: connect (if a new connection is opened),
+        upstream (until the response headers) and transfer (the buffered body)
+        """
+        connect_ms = trace.connect_ms or 0
+        headers_ms = self.upstream_ms if trace.headers_ms is None else min(trace.headers_ms, self.upstream_ms)
+        for phase in ('connect', 'upstream', 'transfer'):
+            self.timings.pop(phase, None)
+        if connect_ms:
+            self.timings['connect'] = connect_ms
+        self.timings['upstream'] = max(headers_ms - connect_ms, 0)
+        if not self.streaming and self.upstream_ms > headers_ms:
+            self.timings['transfer'] = self.upstream_ms - headers_ms
+
+    def use_http2(self) -> bool:
+        if self.proxy_type == 'forward':
+            # forward to the supervisor
+            return env.SUPERVISOR_HTTP2
+        return is_http2_enabled(self.service)
+
+    async def make_hedged_request(self, hedge: HedgePolicy, path: str, content,
+                                  base_url: str, instance: Optional[Instance], index: int, timeout: float):
+        """
+        Send the attempt, if it has not answered within the hedge delay, send another attempt
+        to the next available instance, the first (non-failure) response wins and the other is cancelled
+        :return: the response and the index of the next base url to retry
+        """
+        primary = asyncio.ensure_future(self.send_attempt(path, content, base_url, instance, timeout, hedge=hedge))
+        targets = {primary: (base_url, instance)}
+        pending = {primary}
+        result = winner = None
+        try:
+            delay = hedge.delay
+            if delay is not None:
+                await asyncio.wait([primary], timeout=delay)
+            if delay is not None and not primary.done():
+                hedged_url = hedged_instance = None
+                while index < len(self.base_urls):
+                    hedged_url = self.base_urls[index]
+                    hedged_instance = self.instances[index] if index < len(self.instances) else None
+                    index += 1
+                    if hedged_instance and not instance_breakers.acquire(hedged_instance.pk):
+                        hedged_url = None
+                        continue
+                    break
+                if hedged_url and self.retries + 1 < self.deadline.max_attempts \
+                        and hedge.withdraw() and retry_budget.withdraw():
+                    # the hedged attempt is an attempt of the request like a retry:
+                    # it's bounded by the max attempts and the retry budget, and counted in the retries
+                    self.retries += 1
+                    self.hedged = True
+                    secondary = asyncio.ensure_future(
+                        self.send_attempt(path, content, hedged_url, hedged_instance, timeout, hedge=hedge))
+                    targets[secondary] = (hedged_url, hedged_instance)
+                    pending.add(secondary)
+                elif hedged_url and hedged_instance:
+                    instance_breakers.release(hedged_instance.pk)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = task.result()
+                    if result is None or (self.should_retry(result[0]) and not self.should_retry(attempt[0])):
+                        if result is not None:
+                            await result[0].aclose()
+                        result, winner = attempt, task
+                    else:
+                        await attempt[0].aclose()
+                if not self.should_retry(result[0]):
+                    break
+        except BaseException:
+            # cancelled or failed, the response of the chosen attempt is not returned
+            if result is not None:
+                await result[0].aclose()
+            raise
+        finally:
+            # the attempts not finished (like the loser) are cancelled, their connections are released
+            for task in pending:
+                task.cancel()
+            for task in pending:
+                try:
+                    attempt = await task
+                except (asyncio.CancelledError, Exception):
+                    continue
+                await attempt[0].aclose()
+        resp, upstream_ms, trace = result
+        winner_url, winner_instance = targets[winner]
+        self.apply_attempt(winner_url, winner_instance, upstream_ms, trace)
+        return resp, index
+
+    async def get_request_content(self):
+        if str(self.request.adaptor.request_method).lower() not in HAS_BODY_METHODS:
+            return None
+        if not env.STREAMING or (self.operation_idempotent and len(self.base_urls) > 1):
+            # body may be replayed to the next base url
+            return await self.request.aread()
+        content_length = self.request.content_length
+        if content_length:
+            # keep the upstream request from falling back to chunked encoding
+            self.headers['content-length'] = str(content_length)
+        elif not self.request.headers.get('transfer-encoding'):
+            return None
+        return self.request.adaptor.request.stream()
 
     def should_retry(self, resp: response.Response) -> bool:
         if not self.operation_idempotent:
@@ -147,92 +607,24 @@ class ProxyAPI(api.API):
     async def handle_discovery(self):
         if not self.service_name:
             raise exceptions.NotFound
-        if env.PRIVATE:
-            if not self.request.ip_address.is_private:
-                raise exceptions.NotFound
-        instance: Instance = await Instance.objects.filter(
-            ip=self.request.ip_address,
-        ).afirst()
-        if instance:
-            if instance.remote_id:
-                self.headers['x-utilmeta-source-instance-id'] = instance.remote_id
-            self.headers['x-utilmeta-source-service'] = instance.service_id
-        else:
-            if env.VALIDATE_FORWARD_IPS:
-                raise exceptions.NotFound
+        await stamp_source(self.request.ip_address, self.headers, timings=self.timings)
         await self.handle_service()
 
     async def handle_service(self):
-        self.service = await Service.objects.filter(
-            models.Q(name=self.service_name) | models.Q(
-                name_records__name=self.service_name
-            )
-        ).afirst()
-        if not self.service:
+        route = await observe_lookup('routing', routing_table.get(self.service_name), timings=self.timings)
+        if not route:
             raise exceptions.NotFound
-        instance_qs = Instance.objects.filter(service=self.service, connected=True)
-        if self.instance_id:
-            instance_qs = instance_qs.filter(remote_id=self.instance_id)
-        else:
-            if self.accept_version and self.accept_version != '*':
-                # 1.1
-                # 1.*
-                # 1.2
-                # ^1.2.3
-                # 1
-                # 1
-                version = self.accept_version.lstrip('v')
-                versions = version.lstrip('~').lstrip('^').split('.')
-                if len(versions) < 3:
-                    versions += ['*'] * (3 - len(versions))
-                major, minor, patch = versions[:3]
-                version_q = models.Q()
-                if major != '*':
-                    version_q = models.Q(
-                        version_major=major,
-                    )
-                if minor != '*':
-                    if version.startswith('^'):
-                        version_q &= models.Q(
-                            version_minor__gte=minor,
-                        )
-                    else:
-                        version_q &= models.Q(
-                            version_minor=minor,
-                        )
-                if patch != '*':
-                    if version.startswith('~'):
-                        version_q &= models.Q(
-                            version_patch__gte=patch,
-                        )
-                    elif not version.startswith('^'):
-                        version_q &= models.Q(version_patch=patch)
-                instance_qs = instance_qs.filter(version_q)
-        self.instances = self.rank_instances([inst async for inst in instance_qs])
+        self.service = route.service
+        self.instances = self.rank_instances(
+            select_instances(route, instance_id=self.instance_id, accept_version=self.accept_version)
+        )
         if self.proxy_type == 'operations':
             self.base_urls = [inst.ops_api for inst in self.instances]
         else:
             self.base_urls = [inst.base_url for inst in self.instances]
 
-    @classmethod
-    def rank_instances(cls, instances: List[Instance]) -> List[Instance]:
-        import random
-        connected = [inst for inst in instances if inst.connected]
-        if not connected:
-            raise exceptions.ServiceUnavailable
-        if len(connected) == 1:
-            return connected
-        inst_scores = {}
-        sort_by_load = sorted(
-            connected, key=lambda inst: inst.avg_load, reverse=True)
-        sort_by_time = sorted(
-            connected, key=lambda inst: inst.avg_time, reverse=True)
-        sort_by_rps = sorted(
-            connected, key=lambda inst: inst.rps, reverse=True)
-        for inst in connected:
-            inst_scores[inst] = (sort_by_load.index(inst) + sort_by_time.index(inst) + sort_by_rps.index(inst) + 1) \
-                                * inst.weight * random.randrange(8, 12) / 10  # add randomness
-        return sorted(connected, key=lambda inst: inst_scores[inst], reverse=True)
+    def rank_instances(self, instances: List[Instance]) -> List[Instance]:
+        return rank_instances(self.service, instances)
 
     async def handle_forward(self):
         # 1. forward to supervisor
@@ -244,67 +636,64 @@ class ProxyAPI(api.API):
                 raise exceptions.NotFound
         if env.SUPERVISOR_CLUSTER_ID:
             self.headers['x-cluster-id'] = env.SUPERVISOR_CLUSTER_ID
-        instance: Instance = await Instance.objects.filter(
-            ip=self.request.ip_address,
-        ).afirst()
+        instance, service_id = await observe_lookup('source', routing_table.identify(self.request.ip_address),
+                                                     timings=self.timings)
 
-        if instance:
-            if instance.remote_id:
+        if instance or service_id:
+            if instance and instance.remote_id:
                 self.headers['x-source-instance-id'] = instance.remote_id
         else:
             if env.VALIDATE_FORWARD_IPS:
                 raise exceptions.NotFound
 
-        from utilmeta.ops.models import Supervisor
-        supervisor: Supervisor = await Supervisor.filter(
-            node_id=self.node_id,
-        ).afirst()
-        if not supervisor:
+        cached = await observe_lookup('supervisor', supervisor_cache.get(self.node_id), timings=self.timings)
+        if not cached or not cached.supervisor:
             raise exceptions.NotFound
+        supervisor = cached.supervisor
         self.headers.setdefault('x-node-id', self.node_id)
         self.headers.setdefault('x-node-key', supervisor.public_key)
         self.supervisor = supervisor
-        self.base_urls = []
-        config = Operations.config()
-        for base_url in [supervisor.base_url] + supervisor.backup_urls:
-            try:
-                if config:
-                    config.check_supervisor(base_url)
-            except ValueError:
-                continue
-            # also check supervisor here
-            # --- THIS IS A SECURITY MEASURE
-            # in the worst case scenario, attacker got the ops db permission
-            # and changed the base url of supervisor (to a hostile address)
-            # the request will not be sent since it violate the [trusted_hosts]
-            self.base_urls.append(base_url)
-
-    def validate_proxy_authorization(self):
+        # trusted base urls are validated by Operations.check_supervisor when cached
+        self.base_urls = list(cached.base_urls)
+
+    def validate_proxy_authorization(self) -> VerifiedToken:
         if not self.proxy_authorization:
             raise exceptions.ProxyAuthenticationRequired
         if ' ' in self.proxy_authorization:
             self.proxy_authorization = self.proxy_authorization.split()[1]
 
-        from utilmeta.ops.key import decode_token
-        try:
-            token_data = decode_token(self.proxy_authorization, public_key=CLUSTER_KEY)
-        except ValueError:
-            raise exceptions.BadRequest('Invalid token format', state='token_expired')
+        verified = token_cache.get(self.proxy_authorization, scope=env.SUPERVISOR_CLUSTER_ID)
+        if verified:
+            # signature, issuer and audience are verified, skip the decoding
+            token_data = verified.claims
+        else:
+            from utilmeta.ops.key import decode_token
+            try:
+                token_data = decode_token(self.proxy_authorization, public_key=CLUSTER_KEY)
+            except Exception:
+                # ValueError for malformed token, JWException for invalid signature or expired token
+                raise exceptions.BadRequest('Invalid token format', state='token_expired')
+            if not token_data:
+                raise exceptions.BadRequest('Invalid token format', state='token_expired')
+
+            issuer = token_data.get('iss') or ''
+            if not str(env.SUPERVISOR_BASE_URL).startswith(issuer):
+                raise exceptions.Conflict(f'Invalid token issuer: {repr(issuer)}')
+            audience = token_data.get('aud') or ''
+            if env.SUPERVISOR_CLUSTER_ID != audience:
+                raise exceptions.Conflict(f'Invalid cluster id: {repr(audience)}')
 
         token_node_id = token_data.get('nid')
         if token_node_id != self.node_id:
             raise exceptions.Conflict(f'Invalid node id')
-        issuer = token_data.get('iss') or ''
-        if not str(env.SUPERVISOR_BASE_URL).startswith(issuer):
-            raise exceptions.Conflict(f'Invalid token issuer: {repr(issuer)}')
-        audience = token_data.get('aud') or ''
-        if env.SUPERVISOR_CLUSTER_ID != audience:
-            raise exceptions.Conflict(f'Invalid cluster id: {repr(audience)}')
         expires = token_data.get('exp')
         if not expires:
             raise exceptions.UnprocessableEntity('Invalid token: no expires')
         if self.request.time.timestamp() > expires:
             raise exceptions.BadRequest('Invalid token: expired', state='token_expired')
+        if not verified:
+            verified = token_cache.set(self.proxy_authorization, token_data, scope=env.SUPERVISOR_CLUSTER_ID)
+        return verified
 
     async def handle_supervisor(self):
         # this is from outside (or this is a global cluster)
@@ -318,13 +707,13 @@ class ProxyAPI(api.API):
         # handle proxy from utilmeta supervisor
         # 1. request OperationsAPI
         # 2. request other apis (test endpoint)
+        started = perf_counter()
         self.validate_proxy_authorization()
-        from utilmeta.ops.models import Supervisor
-        self.supervisor: Supervisor = await Supervisor.filter(
-            node_id=self.node_id,
-        ).afirst()
-        if not self.supervisor:
+        self.add_timing('auth', (perf_counter() - started) * 1000)
+        cached = await observe_lookup('supervisor', supervisor_cache.get(self.node_id), timings=self.timings)
+        if not cached or not cached.supervisor:
             raise exceptions.NotFound
+        self.supervisor = cached.supervisor
         self.service_name = self.supervisor.service
         await self.handle_service()
 
@@ -334,26 +723,39 @@ class ProxyAPI(api.API):
         self.node_id = self.node_id or self.request.query.get('node')
         if not self.node_id:
             raise exceptions.NotFound
+        started = perf_counter()
         if self.token:
             # from client directly
             # take the token to authorize
-            from utilmeta.ops.models import Supervisor
-            from utilmeta.ops.key import decode_token
-
-            async for supervisor in Supervisor.objects.filter(
-                node_id=self.node_id,
-                # we don't use service name as identifier
-                # that might not be synced
-                disabled=False,
-                public_key__isnull=False
-            ):
-                try:
-                    token_data = decode_token(self.token, public_key=supervisor.public_key)
-                except ValueError:
+            scope = f'node:{self.node_id}'
+            verified = token_cache.get(self.token, scope=scope)
+            if verified:
+                self.supervisor = verified.supervisor
+            else:
+                from utilmeta.ops.models import Supervisor
+                from utilmeta.ops.key import decode_token
+                decoded = False
+                async for supervisor in Supervisor.objects.filter(
+                    node_id=self.node_id,
+                    # we don't use service name as identifier
+                    # that might not be synced
+                    disabled=False,
+                    public_key__isnull=False
+                ):
+                    decoded = True
+                    try:
+                        token_data = decode_token(self.token, public_key=supervisor.public_key)
+                    except Exception:
+                        # signed by other supervisor, or invalid
+                        continue
+                    if not token_data:
+                        continue
+                    self.supervisor = supervisor
+                    token_cache.set(self.token, token_data, scope=scope, supervisor=supervisor)
+                    break
+                if decoded and not self.supervisor:
                     raise exceptions.PermissionDenied
-                if not token_data:
-                    continue
-                self.supervisor = supervisor
+            self.add_timing('auth', (perf_counter() - started) * 1000)
 
         elif self.proxy_authorization:
             # maybe from utilmeta platform, use proxy authorization to auth
@@ -362,16 +764,16 @@ class ProxyAPI(api.API):
             elif self.cluster_id != env.SUPERVISOR_CLUSTER_ID:
                 raise exceptions.NotFound
             self.validate_proxy_authorization()
-            from utilmeta.ops.models import Supervisor
-            self.supervisor: Supervisor = await Supervisor.filter(
-                node_id=self.node_id,
-            ).afirst()
+            self.add_timing('auth', (perf_counter() - started) * 1000)
+            cached = await observe_lookup('supervisor', supervisor_cache.get(self.node_id), timings=self.timings)
+            self.supervisor = cached.supervisor if cached else None
 
             if not self.supervisor:
                 # maybe the first time /ops query when supervisor is not created
                 # we will pass since the proxy authorization check has passed
                 if not self.service_name:
                     raise exceptions.NotFound
+                from utilmeta.ops.models import Supervisor
                 self.supervisor = Supervisor(
                     service=self.service_name,
                     base_url=env.SUPERVISOR_BASE_URL,
@@ -403,10 +805,81 @@ class ProxyAPI(api.API):
         elif self.proxy_type == 'forward':
             return await self.handle_forward()
 
+    def get_service_label(self) -> str:
+        # resolved service only, the requested name is not trusted to bound the label values
+        if self.service:
+            return self.service.name
+        if self.supervisor and self.supervisor.pk:
+            return self.supervisor.service
+        return ''
+
+    def record_metrics(self, status: int):
+        if self.recorded or not proxy_metrics.enabled:
+            return
+        self.recorded = True
+        active_requests.pop(self, None)
+        labels = (self.proxy_type or '', self.get_service_label(), get_instance_label(self.instance), str(status))
+        requests_total.inc(labels)
+        request_duration.observe(labels, perf_counter() - self.started)
+        if self.retries:
+            retries_total.inc(labels[:2], self.retries)
+
+    def end_span(self, status: int, error: Error = None):
+        """
+        The span of the proxied request ends when the response headers are ready (same as the request duration)
+        """
+        span = self.span
+        if not span or span.end_time is not None:
+            return
+        span.set_attribute('http.response.status_code', status)
+        span.set_attribute('utilmeta.service', self.get_service_label() or None)
+        span.set_attribute('utilmeta.instance.id', get_instance_label(self.instance) or None)
+        if self.retries:
+            span.set_attribute('utilmeta.proxy.retries', self.retries)
+        if self.hedged:
+            span.set_attribute('utilmeta.proxy.hedged', True)
+        if self.coalesced:
+            span.set_attribute('utilmeta.proxy.coalesced', True)
+        if self.cache_status:
+            span.set_attribute('utilmeta.proxy.cache', self.cache_status)
+        for phase, value in self.timings.items():
+            span.set_attribute(f'utilmeta.proxy.timing.{phase}', round(value, 3))
+        if error is not None and status >= 500:
+            span.set_error(str(error.exception))
+        elif status >= 500:
+            span.set_error()
+        span.end()
+
+    @api.handle('*')
+    def handle_errors(self, error: Error):
+        self.record_metrics(error.status)
+        self.end_span(error.status, error)
+        # handled by the RootAPI
+        return error
+
+    def log_timings(self):
+        """
+        Sample the phase timings into the ops log of the request, the slow requests are always logged
+        """
+        slow = env.TIMING_LOG_SLOW and self.timings.get('total', 0) >= env.TIMING_LOG_SLOW
+        if not slow and not (env.TIMING_LOG_SAMPLE and random.random() < env.TIMING_LOG_SAMPLE):
+            return
+        self.logger.info('proxy timings', **{phase: round(value, 3) for phase, value in self.timings.items()})
+
     @api.after('*')
     def process_response(self, resp: response.Response):
+        self.record_metrics(resp.status)
         server_timing = resp.headers.get('server-timing')
-        proxy_timing = f'proxy;dur={resp.duration_ms}'
+        # the proxied response is not bound to the request, use the measured upstream duration
+        proxy_timing = f'proxy;dur={resp.duration_ms if self.upstream_ms is None else self.upstream_ms}'
+        if env.SERVER_TIMING:
+            self.timings['total'] = (perf_counter() - self.started) * 1000
+            proxy_timing += ''.join(f',{phase};dur={round(self.timings[phase], 3)}'
+                                    for phase in TIMING_PHASES if phase in self.timings)
+            self.log_timings()
+        self.end_span(resp.status)
+        if self.cache_status:
+            proxy_timing += f',cache;desc={self.cache_status}'
         if server_timing:
             server_timing = f'{proxy_timing},{server_timing}'
         else:
@@ -416,6 +889,10 @@ class ProxyAPI(api.API):
             resp.set_header('X-UtilMeta-Proxy-Destination-Base-URL', self.base_url)
             if self.retries:
                 resp.set_header('X-UtilMeta-Proxy-Retries', self.retries)
+            if self.hedged:
+                resp.set_header('X-UtilMeta-Proxy-Hedged', 'true')
+            if self.coalesced:
+                resp.set_header('X-UtilMeta-Proxy-Coalesced', 'true')
             if self.instance and self.instance.remote_id:
                 resp.set_header('X-UtilMeta-Proxy-Destination-Instance-Id', self.instance.remote_id)
             # marked this response as a normally returned response (instead of a threw error)
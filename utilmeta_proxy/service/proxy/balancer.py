@@ -0,0 +1,183 @@
+import abc
+import random
+from math import gcd
+from functools import reduce
+from typing import Dict, List, Optional, Tuple, Type
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Service, Instance
+from .stats import instance_stats, StatsRegistry
+
+
+def get_weight(instance: Instance) -> float:
+    return max(float(instance.weight or 0), 0.01)
+
+
+class LoadBalancer(abc.ABC):
+    """
+    Order the candidate instances of a request,
+    the first one is the chosen instance and the rest is the fallback order for retries
+    """
+    name: str = None
+    ERROR_PENALTY = 10
+    # cost multiplier of an instance with 100% error rate
+
+    def __init__(self, stats: StatsRegistry = instance_stats):
+        self.stats = stats
+
+    def penalty(self, instance: Instance) -> float:
+        return 1 + self.ERROR_PENALTY * self.stats.get(instance.pk).error_rate
+
+    @abc.abstractmethod
+    def order(self, instances: List[Instance]) -> List[Instance]:
+        """
+        :return: the candidate instances, ordered by preference
+        """
+
+    @classmethod
+    def fallback(cls, instances: List[Instance], *chosen: Instance) -> List[Instance]:
+        return list(chosen) + [inst for inst in instances if inst not in chosen]
+
+
+class PowerOfTwoChoices(LoadBalancer):
+    """
+    Pick 2 random instances, choose the one with less in-flight requests per weight, O(1)
+    """
+    name = 'p2c'
+
+    def cost(self, instance: Instance) -> float:
+        return (self.stats.get(instance.pk).inflight + 1) * self.penalty(instance) / get_weight(instance)
+
+    def order(self, instances: List[Instance]) -> List[Instance]:
+        a, b = random.sample(instances, 2)
+        if self.cost(b) < self.cost(a):
+            a, b = b, a
+        return self.fallback(instances, a, b)
+
+
+class PeakEWMA(PowerOfTwoChoices):
+    """
+    Power of two choices using peak-EWMA latency multiplied by the in-flight requests
+    """
+    name = 'peak_ewma'
+
+    def cost(self, instance: Instance) -> float:
+        stats = self.stats.get(instance.pk)
+        return (stats.get_latency() + 1.0) * (stats.inflight + 1) * self.penalty(instance) / get_weight(instance)
+
+
+class LeastOutstandingRequests(LoadBalancer):
+    """
+    Choose the instance with least in-flight requests per weight, ties are broken randomly
+    """
+    name = 'least_outstanding'
+
+    def order(self, instances: List[Instance]) -> List[Instance]:
+        chosen = min(
+            instances,
+            key=lambda inst: ((self.stats.get(inst.pk).inflight + 1) * self.penalty(inst) / get_weight(inst),
+                              random.random())
+        )
+        return self.fallback(instances, chosen)
+
+
+class SmoothWeightedRoundRobin(LoadBalancer):
+    """
+    Smooth weighted round-robin (as nginx), the schedule of a whole cycle is precomputed
+    for each candidate set, so every pick is O(1)
+    """
+    name = 'weighted_round_robin'
+    MAX_CYCLE = 1000
+    MAX_SCHEDULES = 1024
+
+    def __init__(self, stats: StatsRegistry = instance_stats):
+        super().__init__(stats)
+        self.schedules: Dict[Tuple[Tuple[int, float], ...], List[int]] = {}
+        self.positions: Dict[Tuple[Tuple[int, float], ...], int] = {}
+
+    @classmethod
+    def get_schedule(cls, weights: List[int]) -> List[int]:
+        divisor = reduce(gcd, weights)
+        weights = [w // divisor for w in weights]
+        total = sum(weights)
+        if total > cls.MAX_CYCLE:
+            weights = [max(1, round(w * cls.MAX_CYCLE / total)) for w in weights]
+            total = sum(weights)
+        current = [0] * len(weights)
+        schedule = []
+        for _ in range(total):
+            for i, w in enumerate(weights):
+                current[i] += w
+            index = max(range(len(weights)), key=current.__getitem__)
+            current[index] -= total
+            schedule.append(index)
+        return schedule
+
+    def order(self, instances: List[Instance]) -> List[Instance]:
+        key = tuple((inst.pk, get_weight(inst)) for inst in instances)
+        schedule = self.schedules.get(key)
+        if schedule is None:
+            if len(self.schedules) >= self.MAX_SCHEDULES:
+                self.schedules.clear()
+                self.positions.clear()
+            schedule = self.schedules[key] = self.get_schedule(
+                [max(1, round(w * 100)) for _, w in key])
+        position = self.positions.get(key, 0)
+        self.positions[key] = (position + 1) % len(schedule)
+        return self.fallback(instances, instances[schedule[position]])
+
+
+class MetricsRank(LoadBalancer):
+    """
+    Rank by the average load / time / rps, using the live statistics of this process if observed,
+    otherwise the last cycle values in database
+    """
+    name = 'rank'
+
+    def get_metrics(self, instance: Instance) -> Tuple[float, float, float]:
+        stats = self.stats.get(instance.pk)
+        if stats.observed:
+            return float(instance.avg_load), stats.get_latency(), stats.rps
+        return float(instance.avg_load), float(instance.avg_time), float(instance.avg_rps)
+
+    def order(self, instances: List[Instance]) -> List[Instance]:
+        scores = {inst.pk: 1 for inst in instances}
+        metrics = {inst.pk: self.get_metrics(inst) for inst in instances}
+        for index in range(3):
+            for i, inst in enumerate(sorted(instances, key=lambda _inst: metrics[_inst.pk][index], reverse=True)):
+                scores[inst.pk] += i
+        return sorted(
+            instances,
+            key=lambda inst: scores[inst.pk] * get_weight(inst) * random.randrange(8, 12) / 10,
+            # add randomness
+            reverse=True
+        )
+
+
+LOAD_BALANCERS: Dict[str, Type[LoadBalancer]] = {
+    cls.name: cls for cls in [
+        PowerOfTwoChoices,
+        PeakEWMA,
+        LeastOutstandingRequests,
+        SmoothWeightedRoundRobin,
+        MetricsRank,
+    ]
+}
+_balancers: Dict[str, LoadBalancer] = {}
+
+
+def get_load_balancer(service: Optional[Service] = None) -> LoadBalancer:
+    """
+    Load balancer of the service, specified by "load_balancer" in Service.data or Service.routes,
+    default to the LOAD_BALANCER env
+    """
+    name = None
+    if service:
+        name = (service.data or {}).get('load_balancer')
+        if not name and isinstance(service.routes, dict):
+            name = service.routes.get('load_balancer')
+    if name not in LOAD_BALANCERS:
+        name = env.LOAD_BALANCER if env.LOAD_BALANCER in LOAD_BALANCERS else PowerOfTwoChoices.name
+    balancer = _balancers.get(name)
+    if balancer is None:
+        balancer = _balancers[name] = LOAD_BALANCERS[name]()
+    return balancer
@@ -0,0 +1,174 @@
+import time
+from typing import Callable, Dict, List
+from utilmeta.core import response
+from utilmeta.utils import DEFAULT_RETRY_ON_STATUSES
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Instance
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    closed: requests pass, consecutive failures open the circuit
+    open: requests are rejected until the open duration is passed, then the circuit is half-open
+    half-open: a limited number of probe requests pass, a success closes the circuit and a failure re-opens it
+    with a doubled open duration
+    """
+    __slots__ = ('state', 'failures', 'successes', 'opened', 'open_duration', 'probes')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.successes = 0
+        self.opened = 0.0
+        self.open_duration = 0.0
+        self.probes = 0
+
+
+class BreakerRegistry:
+    MAX_OPEN_FACTOR = 8
+
+    def __init__(self,
+                 failures: int = env.BREAKER_FAILURES,
+                 open_seconds: float = env.BREAKER_OPEN_SECONDS,
+                 half_open_probes: int = env.BREAKER_HALF_OPEN_PROBES,
+                 slow_threshold: float = env.BREAKER_SLOW_THRESHOLD):
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.half_open_probes = max(1, half_open_probes)
+        self.slow_threshold = slow_threshold
+        self.breakers: Dict[int, CircuitBreaker] = {}
+        self.listeners: List[Callable[[int, str, float, float], None]] = []
+        # called with (pk, state, opened, open_duration) when a circuit is opened or closed
+
+    @property
+    def enabled(self):
+        return bool(self.failures)
+
+    def get(self, pk: int) -> CircuitBreaker:
+        breaker = self.breakers.get(pk)
+        if breaker is None:
+            breaker = self.breakers[pk] = CircuitBreaker()
+        return breaker
+
+    def get_state(self, pk: int) -> str:
+        breaker = self.breakers.get(pk)
+        if not breaker:
+            return CLOSED
+        if breaker.state == OPEN and time.monotonic() - breaker.opened >= breaker.open_duration:
+            breaker.state = HALF_OPEN
+            breaker.probes = 0
+            breaker.successes = 0
+        return breaker.state
+
+    def filter(self, instances: List[Instance]) -> List[Instance]:
+        """
+        Exclude the instances with open circuit, half-open instances are kept
+        so that they can be chosen as probes when the budget allows (checked by acquire)
+        """
+        if not self.enabled or not self.breakers:
+            return instances
+        return [inst for inst in instances if self.get_state(inst.pk) != OPEN]
+
+    def acquire(self, pk: int) -> bool:
+        """
+        Whether a request can be sent to the instance now, takes a probe slot if the circuit is half-open
+        """
+        if not self.enabled:
+            return True
+        state = self.get_state(pk)
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        breaker = self.get(pk)
+        if breaker.probes >= self.half_open_probes:
+            return False
+        breaker.probes += 1
+        return True
+
+    def release(self, pk: int):
+        # the acquired request is not sent or cancelled, return the probe slot
+        breaker = self.breakers.get(pk)
+        if breaker and breaker.state == HALF_OPEN:
+            breaker.probes = max(0, breaker.probes - 1)
+
+    def is_failure(self, resp: response.Response, duration_ms: float = None) -> bool:
+        if resp is None or resp.is_aborted:
+            return True
+        if resp.status in DEFAULT_RETRY_ON_STATUSES:
+            return True
+        if self.slow_threshold and duration_ms and duration_ms > self.slow_threshold:
+            return True
+        return False
+
+    def record(self, pk: int, resp: response.Response, duration_ms: float = None):
+        if not self.enabled:
+            return
+        failed = self.is_failure(resp, duration_ms)
+        if not failed and pk not in self.breakers:
+            return
+        breaker = self.get(pk)
+        state = self.get_state(pk)
+        if state == HALF_OPEN:
+            breaker.probes = max(0, breaker.probes - 1)
+            if failed:
+                self.open(breaker, min(
+                    breaker.open_duration * 2, self.open_seconds * self.MAX_OPEN_FACTOR))
+                self.notify(pk, OPEN, breaker.opened, breaker.open_duration)
+                return
+            breaker.successes += 1
+            if breaker.successes >= self.half_open_probes:
+                self.breakers.pop(pk, None)
+                self.notify(pk, CLOSED)
+            return
+        if state == OPEN:
+            # response of a request that was sent before the circuit opened
+            return
+        if not failed:
+            breaker.failures = 0
+            return
+        breaker.failures += 1
+        if breaker.failures >= self.failures:
+            self.open(breaker, self.open_seconds)
+            self.notify(pk, OPEN, breaker.opened, breaker.open_duration)
+
+    def set_state(self, pk: int, state: str, opened: float = 0, open_duration: float = 0):
+        """
+        Apply the circuit opened / closed by another worker (time.monotonic is system-wide)
+        """
+        if state == CLOSED:
+            self.breakers.pop(pk, None)
+            return
+        breaker = self.get(pk)
+        self.open(breaker, open_duration)
+        breaker.opened = opened
+
+    def snapshot(self) -> List[tuple]:
+        """
+        (pk, state, opened, open_duration) of the circuits that are not closed, for a worker that joins
+        """
+        return [(pk, OPEN, breaker.opened, breaker.open_duration)
+                for pk, breaker in list(self.breakers.items()) if breaker.state != CLOSED]
+
+    def notify(self, pk: int, state: str, opened: float = 0, open_duration: float = 0):
+        for listener in self.listeners:
+            try:
+                listener(pk, state, opened, open_duration)
+            except Exception as e:
+                print(f'circuit breaker listener failed with error: {e}')
+
+    @classmethod
+    def open(cls, breaker: CircuitBreaker, duration: float):
+        breaker.state = OPEN
+        breaker.opened = time.monotonic()
+        breaker.open_duration = duration
+        breaker.failures = 0
+        breaker.successes = 0
+        breaker.probes = 0
+
+
+instance_breakers = BreakerRegistry()
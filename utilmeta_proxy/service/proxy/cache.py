@@ -0,0 +1,436 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+from utilmeta.core import response
+from utilmeta.utils import is_hop_by_hop
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Service
+
+CACHEABLE_STATUSES = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+EXCLUDE_CACHE_HEADERS = ('set-cookie', 'content-length', 'age', 'server-timing')
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    directives = {}
+    for item in str(value or '').split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key, sep, val = item.partition('=')
+        directives[key.strip().lower()] = val.strip().strip('"') if sep else None
+    return directives
+
+
+def parse_seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def strip_weak(etag: str) -> str:
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_cache_enabled(service: Optional[Service]) -> bool:
+    """
+    Enabled by "cache" in Service.data or Service.routes, default to the RESPONSE_CACHE env
+    """
+    config = None
+    if service:
+        config = (service.data or {}).get('cache')
+        if config is None and isinstance(service.routes, dict):
+            config = service.routes.get('cache')
+    if config is None:
+        config = env.RESPONSE_CACHE
+    return bool(config)
+
+
+class CacheEntry:
+    __slots__ = ('status', 'headers', 'body', 'stored', 'lifetime', 'no_cache', 'vary')
+
+    def __init__(self, status: int, headers: List[Tuple[str, str]], body: bytes,
+                 stored: float, lifetime: float, no_cache: bool = False, vary: Tuple[str, ...] = ()):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        # the response time minus the age reported by upstream
+        self.lifetime = lifetime
+        # freshness lifetime in seconds
+        self.no_cache = no_cache
+        self.vary = vary
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+    @property
+    def age(self) -> float:
+        return max(time.time() - self.stored, 0)
+
+    @property
+    def fresh(self) -> bool:
+        return not self.no_cache and self.age < self.lifetime
+
+    def is_fresh_for(self, request_headers) -> bool:
+        """
+        Fresh enough to be served for the Cache-Control of the request (no-cache, max-age, min-fresh)
+        """
+        if not self.fresh:
+            return False
+        cache_control = parse_cache_control(request_headers.get('cache-control'))
+        if 'no-cache' in cache_control:
+            return False
+        max_age = parse_seconds(cache_control.get('max-age'))
+        if max_age is not None and self.age > max_age:
+            return False
+        min_fresh = parse_seconds(cache_control.get('min-fresh'))
+        if min_fresh is not None and self.lifetime - self.age < min_fresh:
+            return False
+        return True
+
+    @property
+    def expired(self) -> bool:
+        # stale and not able to revalidate
+        return not self.fresh and not (self.etag or self.last_modified)
+
+    def get_header(self, name: str) -> Optional[str]:
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    @property
+    def etag(self) -> Optional[str]:
+        return self.get_header('etag')
+
+    @property
+    def last_modified(self) -> Optional[str]:
+        return self.get_header('last-modified')
+
+    def revalidated(self, headers: Dict[str, str], lifetime: float) -> 'CacheEntry':
+        # 304 response: update the stored headers and the freshness
+        merged = {k.lower(): (k, v) for k, v in self.headers}
+        for key, value in headers.items():
+            if key.lower() in EXCLUDE_CACHE_HEADERS or is_hop_by_hop(key):
+                continue
+            merged[key.lower()] = (key, value)
+        return CacheEntry(self.status, list(merged.values()), self.body, time.time(), lifetime,
+                          self.no_cache, self.vary)
+
+    def not_modified(self, request_headers) -> bool:
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match:
+            etag = self.etag
+            if not etag:
+                return False
+            tags = [strip_weak(t) for t in if_none_match.split(',')]
+            return '*' in tags or strip_weak(etag) in tags
+        if_modified_since = parse_http_date(request_headers.get('if-modified-since'))
+        last_modified = parse_http_date(self.last_modified)
+        return bool(if_modified_since and last_modified and last_modified <= if_modified_since)
+
+    def to_response(self, request_headers=None) -> response.Response:
+        headers = dict(self.headers)
+        headers['age'] = str(int(self.age))
+        if request_headers is not None and self.status == 200 and self.not_modified(request_headers):
+            for key in ('content-type', 'content-encoding'):
+                headers.pop(key, None)
+            return response.Response(status=304, headers=headers)
+        resp = response.Response(status=self.status, headers=headers, content=self.body)
+        resp.content_type = self.get_header('content-type')
+        return resp
+
+    def dumps(self) -> bytes:
+        meta = json.dumps(dict(
+            status=self.status,
+            headers=self.headers,
+            stored=self.stored,
+            lifetime=self.lifetime,
+            no_cache=self.no_cache,
+            vary=list(self.vary)
+        ))
+        return meta.encode() + b'\n' + self.body
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'CacheEntry':
+        meta, _, body = data.partition(b'\n')
+        meta = json.loads(meta)
+        return cls(
+            status=meta['status'],
+            headers=[tuple(h) for h in meta['headers']],
+            body=body,
+            stored=meta['stored'],
+            lifetime=meta['lifetime'],
+            no_cache=meta['no_cache'],
+            vary=tuple(meta['vary']),
+        )
+
+
+class ResponseCache:
+    """
+    Shared HTTP cache (RFC 9111) of the proxied GET responses,
+    LRU by size in memory, the evicted entries are written to the disk tier if CACHE_DIR is set
+    """
+    def __init__(self,
+                 max_size: int = env.CACHE_MAX_SIZE,
+                 max_entry_size: int = env.CACHE_MAX_ENTRY_SIZE,
+                 directory: str = env.CACHE_DIR,
+                 disk_max_size: int = env.CACHE_DISK_MAX_SIZE):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.directory = directory
+        self.disk_max_size = disk_max_size
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self.size = 0
+        self.varies: Dict[str, Tuple[str, ...]] = {}
+        # primary key -> vary header names of the last stored response
+        self.primaries: Dict[str, str] = {}
+        # key -> primary key of the entries in memory or written to disk by this process
+        self.counts: Dict[str, int] = {}
+        # primary key -> number of the entries, the vary is dropped with the last entry
+        self.disk: Optional['OrderedDict[str, int]'] = None
+        self.disk_size = 0
+        self._disk_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_size)
+
+    @classmethod
+    def get_primary_key(cls, *parts) -> str:
+        return hashlib.sha256(json.dumps([str(p) for p in parts]).encode()).hexdigest()
+
+    @classmethod
+    def get_key(cls, primary: str, vary: Tuple[str, ...], request_headers) -> str:
+        if not vary:
+            return primary
+        values = [f'{name}:{request_headers.get(name) or ""}' for name in vary]
+        return hashlib.sha256('\n'.join([primary] + values).encode()).hexdigest()
+
+    @classmethod
+    def is_cacheable_request(cls, method: str, request_headers) -> bool:
+        if str(method).upper() not in ('GET', 'HEAD'):
+            return False
+        return 'no-store' not in parse_cache_control(request_headers.get('cache-control'))
+
+    def make_entry(self, status: int, headers, body: bytes, request_headers) -> Optional[CacheEntry]:
+        if status not in CACHEABLE_STATUSES:
+            return None
+        if len(body) > self.max_entry_size:
+            return None
+        cache_control = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        if headers.get('set-cookie'):
+            return None
+        vary = tuple(sorted({v.strip().lower() for v in str(headers.get('vary') or '').split(',') if v.strip()}))
+        if '*' in vary:
+            return None
+        if request_headers.get('authorization') and not (
+                'public' in cache_control or 's-maxage' in cache_control or 'must-revalidate' in cache_control):
+            # shared cache must not store the authorized responses unless explicitly allowed
+            return None
+        lifetime = self.get_lifetime(headers, cache_control)
+        no_cache = 'no-cache' in cache_control
+        if not lifetime and not no_cache and not (headers.get('etag') or headers.get('last-modified')):
+            # neither fresh nor able to revalidate
+            return None
+        stored = time.time() - (parse_seconds(headers.get('age')) or 0)
+        return CacheEntry(
+            status=status,
+            headers=[(k, v) for k, v in headers.items()
+                     if k.lower() not in EXCLUDE_CACHE_HEADERS and not is_hop_by_hop(k)],
+            body=body,
+            stored=stored,
+            lifetime=lifetime,
+            no_cache=no_cache,
+            vary=vary,
+        )
+
+    @classmethod
+    def get_lifetime(cls, headers, cache_control: Dict[str, Optional[str]] = None) -> float:
+        if cache_control is None:
+            cache_control = parse_cache_control(headers.get('cache-control'))
+        for directive in ('s-maxage', 'max-age'):
+            seconds = parse_seconds(cache_control.get(directive))
+            if seconds is not None:
+                return seconds
+        expires = parse_http_date(headers.get('expires'))
+        if expires:
+            date = parse_http_date(headers.get('date')) or time.time()
+            return max(expires - date, 0)
+        return 0
+
+    async def get(self, primary: str, request_headers) -> Optional[CacheEntry]:
+        vary = self.varies.get(primary, ())
+        key = self.get_key(primary, vary, request_headers)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry.expired:
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+        if not self.directory:
+            return None
+        entry = await run_in_threadpool(self.read_disk, key)
+        if entry is None or entry.expired:
+            self.untrack(key)
+            return None
+        self.varies.setdefault(primary, entry.vary)
+        await self.store(primary, key, entry)
+        return entry
+
+    async def set(self, primary: str, request_headers, entry: CacheEntry):
+        self.varies[primary] = entry.vary
+        key = self.get_key(primary, entry.vary, request_headers)
+        await self.store(primary, key, entry)
+
+    async def store(self, primary: str, key: str, entry: CacheEntry):
+        self.track(key, primary)
+        evicted = self.put(key, entry)
+        if not evicted:
+            return
+        if self.directory:
+            # the entries written to disk are still cached, the others are dropped
+            removed = await run_in_threadpool(self.write_disk, evicted)
+        else:
+            removed = [key for key, _ in evicted]
+        for key in removed:
+            if key not in self.entries:
+                # a disk entry can be loaded to memory again
+                self.untrack(key)
+
+    def put(self, key: str, entry: CacheEntry) -> List[Tuple[str, CacheEntry]]:
+        current = self.entries.pop(key, None)
+        if current is not None:
+            self.size -= current.size
+        self.entries[key] = entry
+        self.size += entry.size
+        evicted = []
+        while self.size > self.max_size and len(self.entries) > 1:
+            evicted_key, evicted_entry = self.entries.popitem(last=False)
+            self.size -= evicted_entry.size
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        self.untrack(key)
+
+    def track(self, key: str, primary: str):
+        if key in self.primaries:
+            return
+        self.primaries[key] = primary
+        self.counts[primary] = self.counts.get(primary, 0) + 1
+
+    def untrack(self, key: str):
+        primary = self.primaries.pop(key, None)
+        if primary is None:
+            return
+        count = self.counts.get(primary, 0) - 1
+        if count > 0:
+            self.counts[primary] = count
+            return
+        self.counts.pop(primary, None)
+        self.varies.pop(primary, None)
+
+    # disk tier -------------------
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.cache')
+
+    def load_disk(self):
+        if self.disk is not None:
+            return
+        self.disk = OrderedDict()
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for item in os.scandir(self.directory):
+            if item.is_file() and item.name.endswith('.cache'):
+                stat = item.stat()
+                files.append((stat.st_mtime, item.name[:-len('.cache')], stat.st_size))
+        for _, key, size in sorted(files):
+            self.disk[key] = size
+            self.disk_size += size
+
+    def read_disk(self, key: str) -> Optional[CacheEntry]:
+        with self._disk_lock:
+            return self._read_disk(key)
+
+    def _read_disk(self, key: str) -> Optional[CacheEntry]:
+        self.load_disk()
+        if key not in self.disk:
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as file:
+                entry = CacheEntry.loads(file.read())
+        except (OSError, ValueError, KeyError) as e:
+            print(f'read cache entry: {key} failed with error: {e}')
+            self.remove_disk(key)
+            return None
+        self.disk.move_to_end(key)
+        return entry
+
+    def write_disk(self, entries: List[Tuple[str, CacheEntry]]) -> List[str]:
+        with self._disk_lock:
+            return self._write_disk(entries)
+
+    def _write_disk(self, entries: List[Tuple[str, CacheEntry]]) -> List[str]:
+        """
+        :return: keys of the entries that are not kept (not written or evicted from disk)
+        """
+        self.load_disk()
+        removed = []
+        for key, entry in entries:
+            if entry.age > entry.lifetime and not (entry.etag or entry.last_modified):
+                # stale and not able to revalidate
+                removed.append(key)
+                continue
+            data = entry.dumps()
+            try:
+                with open(self.get_path(key), 'wb') as file:
+                    file.write(data)
+            except OSError as e:
+                print(f'write cache entry: {key} failed with error: {e}')
+                removed.append(key)
+                continue
+            self.disk_size += len(data) - self.disk.pop(key, 0)
+            self.disk[key] = len(data)
+        while self.disk_size > self.disk_max_size and self.disk:
+            key = next(iter(self.disk))
+            self.remove_disk(key)
+            removed.append(key)
+        return removed
+
+    def remove_disk(self, key: str):
+        size = self.disk.pop(key, None)
+        if size is None:
+            return
+        self.disk_size -= size
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,78 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from utilmeta.core import response
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Service
+
+COALESCE_METHODS = ('GET', 'HEAD')
+# the response depends on the validators / range of the request (304, 412, 206),
+# these requests are never coalesced whatever the vary headers are configured
+UNCOALESCED_HEADERS = ('if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'range', 'if-range')
+
+
+def get_vary_headers(value: str = env.COALESCE_VARY_HEADERS) -> List[str]:
+    return [h.strip().lower() for h in str(value or '').split(',') if h.strip()]
+
+
+def is_coalesce_enabled(service: Optional[Service]) -> bool:
+    """
+    Enabled by "coalesce" in Service.data or Service.routes, default to the COALESCE env
+    """
+    config = None
+    if service:
+        config = (service.data or {}).get('coalesce')
+        if config is None and isinstance(service.routes, dict):
+            config = service.routes.get('coalesce')
+    if config is None:
+        config = env.COALESCE
+    return bool(config)
+
+
+def copy_response(resp: response.Response) -> response.Response:
+    """
+    Response for another waiter of the shared (buffered) upstream response
+    """
+    if resp.is_aborted:
+        return response.Response(
+            error=resp.error,
+            timeout=resp.is_timeout,
+            aborted=True
+        )
+    shared = response.Response(
+        status=resp.status,
+        reason=resp.reason,
+        headers=resp.headers,
+        cookies=resp.cookies,
+        content=resp.body,
+    )
+    shared.content_type = resp.content_type
+    return shared
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one in-flight call,
+    the call runs in its own task, so that it's not cancelled with the first caller
+    """
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Tuple[object, bool]:
+        """
+        :return: (result, shared), shared is True if the result is from the call of another caller
+        """
+        call = self.calls.get(key)
+        if call is not None:
+            return await asyncio.shield(call), True
+        call = asyncio.ensure_future(func())
+        self.calls[key] = call
+
+        def done(_):
+            if self.calls.get(key) is call:
+                self.calls.pop(key, None)
+
+        call.add_done_callback(done)
+        return await asyncio.shield(call), False
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,199 @@
+import zlib
+from typing import Dict, List, Optional
+from utilmeta.core import response
+from utilmeta_proxy.config.env import env
+from .cache import parse_cache_control
+from .pool import StreamResponse
+
+try:
+    import brotli
+except ImportError:     # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:     # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/x-www-form-urlencoded',
+    'application/graphql',
+    'image/svg+xml',
+)
+COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+NOT_COMPRESSIBLE_TYPES = ('text/event-stream',)
+# event stream is flushed by event, an encoder will hold the events in its buffer
+NO_BODY_STATUSES = (204, 304)
+
+
+class GzipEncoder:
+    def __init__(self, level: int = env.COMPRESS_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level: int = env.COMPRESS_LEVEL):
+        # brotli quality above 5 is too slow for the on-the-fly compression
+        self.compressor = brotli.Compressor(quality=min(level, 5))
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level: int = env.COMPRESS_LEVEL):
+        self.compressor = zstandard.ZstdCompressor(level=min(level, 9)).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.flush()
+
+
+ENCODERS = {'gzip': GzipEncoder}
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS['zstd'] = ZstdEncoder
+PACKAGES = {'br': 'brotli', 'zstd': 'zstandard'}
+
+
+def get_encodings(value: str = env.COMPRESS_ENCODINGS) -> List[str]:
+    """
+    Available encodings by the server preference
+    """
+    return [e.strip().lower() for e in str(value or '').split(',') if e.strip().lower() in ENCODERS]
+
+
+def check_encodings(value: str = env.COMPRESS_ENCODINGS):
+    """
+    Report the configured encodings that are skipped for the missing packages
+    """
+    for encoding in str(value or '').split(','):
+        encoding = encoding.strip().lower()
+        if encoding in PACKAGES and encoding not in ENCODERS:
+            print(f'{PACKAGES[encoding]} package is required for the {encoding} compression '
+                  f'(pip install "utilmeta-proxy[compression]"), {encoding} is skipped')
+
+
+if env.COMPRESSION:
+    check_encodings()
+
+
+def parse_accept_encoding(value: Optional[str]) -> Dict[str, float]:
+    accepts = {}
+    for item in str(value or '').split(','):
+        coding, *params = [p.strip() for p in item.split(';')]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, val = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0
+        accepts[coding.lower()] = q
+    return accepts
+
+
+def negotiate(accept_encoding: Optional[str], encodings: List[str] = None) -> Optional[str]:
+    """
+    Encoding with the highest q-value of the client, ties broken by the server preference
+    """
+    accepts = parse_accept_encoding(accept_encoding)
+    if not accepts:
+        return None
+    wildcard = accepts.get('*', 0)
+    selected = None
+    selected_q = 0
+    for encoding in (get_encodings() if encodings is None else encodings):
+        q = accepts.get(encoding, wildcard)
+        if q > selected_q:
+            selected = encoding
+            selected_q = q
+    return selected
+
+
+def is_compressible(resp: response.Response, method: str = None, min_size: int = env.COMPRESS_MIN_SIZE) -> bool:
+    if resp.is_aborted or resp.status in NO_BODY_STATUSES or resp.status < 200:
+        return False
+    if str(method or '').upper() == 'HEAD':
+        return False
+    headers = resp.headers
+    encoding = str(headers.get('content-encoding') or '').strip().lower()
+    if encoding and encoding != 'identity':
+        # already encoded, pass through
+        return False
+    if 'no-transform' in parse_cache_control(headers.get('cache-control')):
+        return False
+    content_type = str(headers.get('content-type') or resp.content_type or '').split(';')[0].strip().lower()
+    if not content_type or content_type in NOT_COMPRESSIBLE_TYPES:
+        return False
+    if not content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.endswith(COMPRESSIBLE_SUFFIXES):
+        return False
+    if isinstance(resp, StreamResponse):
+        length = headers.get('content-length')
+        if length is None:
+            # chunked upstream response of unknown size
+            return True
+        try:
+            return int(length) >= min_size
+        except ValueError:
+            return False
+    return len(resp.body or b'') >= min_size
+
+
+def set_encoding_headers(resp: response.Response, encoding: str):
+    resp.headers.pop('content-length', None)
+    resp.set_header('content-encoding', encoding)
+    vary = str(resp.headers.get('vary') or '')
+    if 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+        resp.set_header('vary', f'{vary}, Accept-Encoding' if vary.strip() else 'Accept-Encoding')
+    etag = resp.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        # the encoded representation is not byte-identical to the upstream one
+        resp.set_header('etag', f'W/{etag}')
+
+
+def compress_response(resp: response.Response, accept_encoding: Optional[str],
+                      method: str = None) -> response.Response:
+    """
+    Compress the uncompressed upstream response by the client Accept-Encoding,
+    stream responses are compressed chunk by chunk as they are relayed
+    """
+    if not env.COMPRESSION or not is_compressible(resp, method):
+        return resp
+    encoding = negotiate(accept_encoding)
+    if not encoding:
+        return resp
+    encoder = ENCODERS[encoding]()
+    if isinstance(resp, StreamResponse):
+        resp.encoder = encoder
+        set_encoding_headers(resp, encoding)
+        return resp
+    body = encoder.compress(resp.body) + encoder.flush()
+    compressed = response.Response(
+        status=resp.status,
+        headers=resp.headers,
+        cookies=resp.cookies,
+        content=body,
+    )
+    compressed.content_type = resp.content_type
+    set_encoding_headers(compressed, encoding)
+    return compressed
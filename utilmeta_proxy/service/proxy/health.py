@@ -0,0 +1,177 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, Set
+from utilmeta.utils import url_join
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Instance
+from utilmeta_proxy.domain.service.routing import routing_table, RoutingTable
+from .pool import upstream_pool, UpstreamPool
+
+
+class HealthState:
+    __slots__ = ('failures', 'successes', 'ejected', 'next_check', 'checking')
+
+    def __init__(self, next_check: float):
+        self.failures = 0
+        self.successes = 0
+        self.ejected = False
+        self.next_check = next_check
+        self.checking = False
+
+
+class HealthChecker:
+    """
+    Probe the connected instances in the routing table periodically,
+    an instance is ejected from routing after consecutive failures and restored after consecutive successes
+    (in this process only, the connected state in database is not changed)
+    """
+    JITTER = 0.2
+
+    def __init__(self,
+                 routing: RoutingTable = routing_table,
+                 pool: UpstreamPool = upstream_pool,
+                 interval: int = env.HEALTH_CHECK_INTERVAL,
+                 timeout: int = env.HEALTH_CHECK_TIMEOUT,
+                 concurrency: int = env.HEALTH_CHECK_CONCURRENCY,
+                 failures: int = env.HEALTH_CHECK_FAILURES,
+                 successes: int = env.HEALTH_CHECK_SUCCESSES,
+                 path: str = env.HEALTH_CHECK_PATH):
+        self.routing = routing
+        self.pool = pool
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self.failures = max(1, failures)
+        self.successes = max(1, successes)
+        self.path = path
+        self.states: Dict[int, HealthState] = {}
+        self.ejected: Set[int] = set()
+        self.listeners: List[Callable[[int, bool], None]] = []
+        # called with (pk, ejected) when an instance is ejected or restored
+        self._semaphore = None
+        self._task = None
+
+    def is_healthy(self, pk: int) -> bool:
+        return pk not in self.ejected
+
+    def filter(self, instances: List[Instance]) -> List[Instance]:
+        """
+        Exclude the ejected instances, if all the instances are ejected, return them all
+        since the probe may be the one to fail (like a network partition between proxy and instances)
+        """
+        if not self.ejected:
+            return instances
+        healthy = [inst for inst in instances if inst.pk not in self.ejected]
+        return healthy or instances
+
+    def set_ejected(self, pk: int, ejected: bool):
+        """
+        Apply the ejected state reported by the checker of another worker
+        """
+        if ejected:
+            self.ejected.add(pk)
+        else:
+            self.ejected.discard(pk)
+
+    def notify(self, pk: int, ejected: bool):
+        for listener in self.listeners:
+            try:
+                listener(pk, ejected)
+            except Exception as e:
+                print(f'health check listener failed with error: {e}')
+
+    def get_url(self, instance: Instance) -> str:
+        if self.path:
+            return url_join(instance.base_url, self.path)
+        return instance.ops_api
+
+    def next_check(self, now: float = None) -> float:
+        # jitter the interval so that the probes of instances added at the same time are spread out
+        return (now or time.monotonic()) + self.interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+
+    async def probe(self, instance: Instance) -> bool:
+        resp = await self.pool.request(
+            self.get_url(instance),
+            method='GET',
+            timeout=self.timeout,
+        )
+        return not resp.is_aborted and resp.status < 500
+
+    async def check(self, instance: Instance, state: HealthState):
+        try:
+            async with self._semaphore:
+                try:
+                    healthy = await self.probe(instance)
+                except Exception as e:
+                    print(f'health check instance: {instance.base_url} failed with error: {e}')
+                    healthy = False
+            self.report(instance, state, healthy)
+        finally:
+            state.checking = False
+            state.next_check = self.next_check()
+
+    def report(self, instance: Instance, state: HealthState, healthy: bool):
+        if healthy:
+            state.failures = 0
+            state.successes += 1
+            if state.ejected and state.successes >= self.successes:
+                state.ejected = False
+                self.ejected.discard(instance.pk)
+                self.notify(instance.pk, False)
+                print(f'instance: {instance.base_url} recovered, restored to routing')
+        else:
+            state.successes = 0
+            state.failures += 1
+            if not state.ejected and state.failures >= self.failures:
+                state.ejected = True
+                self.ejected.add(instance.pk)
+                self.notify(instance.pk, True)
+                print(f'instance: {instance.base_url} failed {state.failures} health checks, ejected from routing')
+
+    def schedule(self):
+        now = time.monotonic()
+        current = set()
+        for route in list(self.routing.services.values()):
+            for instance in route.connected:
+                current.add(instance.pk)
+                state = self.states.get(instance.pk)
+                if state is None:
+                    # first check of a new instance is spread within an interval
+                    state = self.states[instance.pk] = HealthState(now + random.uniform(0, self.interval))
+                if state.checking or state.next_check > now:
+                    continue
+                state.checking = True
+                asyncio.ensure_future(self.check(instance, state))
+        for pk in list(self.states):
+            if pk not in current and not self.states[pk].checking:
+                # disconnected or removed
+                self.states.pop(pk, None)
+                if pk in self.ejected:
+                    self.ejected.discard(pk)
+                    self.notify(pk, False)
+
+    async def run(self):
+        if not self.routing.loaded:
+            await self.routing.load()
+        tick = min(1.0, self.interval / 2)
+        while True:
+            try:
+                self.schedule()
+            except Exception as e:
+                print(f'schedule health checks failed with error: {e}')
+            await asyncio.sleep(tick)
+
+    def start(self):
+        if self._task or not self.interval:
+            return
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+health_checker = HealthChecker()
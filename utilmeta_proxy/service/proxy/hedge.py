@@ -0,0 +1,86 @@
+from collections import deque
+from typing import Dict, Optional, Tuple
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Service
+
+
+class HedgePolicy:
+    """
+    Hedging of a service: if the first attempt has not answered within the given percentile of the
+    recent response times, a second attempt is sent to the next instance, and the first response wins.
+    The extra attempts are capped by a token bucket: every request deposits <budget> token
+    and every hedge costs one, so hedges are at most <budget> ratio of the requests
+    """
+    WINDOW = 512
+    MIN_SAMPLES = 20
+    RECOMPUTE = 32
+    MAX_TOKENS = 10.0
+
+    def __init__(self,
+                 percentile: float = env.HEDGE_PERCENTILE,
+                 budget: float = env.HEDGE_BUDGET,
+                 min_delay: float = env.HEDGE_MIN_DELAY):
+        self.percentile = min(max(float(percentile), 1.0), 100.0)
+        self.budget = max(float(budget), 0.0)
+        self.min_delay = float(min_delay or 0)
+        self.samples = deque(maxlen=self.WINDOW)
+        self.tokens = 0.0
+        self._delay = None
+        self._recorded = 0
+
+    def record(self, duration_ms: float):
+        self.samples.append(duration_ms)
+        self._recorded += 1
+        if self._recorded >= self.RECOMPUTE:
+            self._delay = None
+
+    @property
+    def delay(self) -> Optional[float]:
+        """
+        Hedge delay in seconds, None if there is not enough samples
+        """
+        if self._delay is None:
+            if len(self.samples) < self.MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+            index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+            self._delay = max(samples[index], self.min_delay) / 1000
+            self._recorded = 0
+        return self._delay
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.budget, self.MAX_TOKENS)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+HEDGE_OPTIONS = ('percentile', 'budget', 'min_delay')
+_policies: Dict[int, Tuple[dict, HedgePolicy]] = {}
+
+
+def get_hedge_policy(service: Optional[Service]) -> Optional[HedgePolicy]:
+    """
+    Hedge policy of the service, enabled by "hedge" in Service.data or Service.routes
+    (true, or a dict of percentile / budget / min_delay), default to the HEDGE env
+    """
+    if not service:
+        return None
+    config = (service.data or {}).get('hedge')
+    if config is None and isinstance(service.routes, dict):
+        config = service.routes.get('hedge')
+    if config is None:
+        config = env.HEDGE
+    if not config:
+        _policies.pop(service.pk, None)
+        return None
+    options = {k: v for k, v in config.items() if k in HEDGE_OPTIONS} if isinstance(config, dict) else {}
+    current = _policies.get(service.pk)
+    if current and current[0] == options:
+        return current[1]
+    policy = HedgePolicy(**options)
+    _policies[service.pk] = (options, policy)
+    return policy
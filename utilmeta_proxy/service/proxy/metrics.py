@@ -0,0 +1,295 @@
+import abc
+import weakref
+from bisect import bisect_left
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from utilmeta_proxy.config.env import env
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# seconds
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(abc.ABC):
+    """
+    Metric of label values -> value, updated from the event loop thread only, so no lock is taken
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abc.abstractmethod
+    def get_values(self) -> Dict[tuple, object]:
+        """
+        :return: label values -> value of this process
+        """
+
+    @abc.abstractmethod
+    def collect(self, values: Dict[tuple, object]) -> Iterable[Tuple[str, tuple, Tuple[Tuple[str, str], ...], float]]:
+        """
+        :return: iterable of (name suffix, label values, extra labels, value)
+        """
+
+    @classmethod
+    def merge_value(cls, value, other):
+        return value + other
+
+    def dump(self) -> list:
+        return [[list(labels), value] for labels, value in list(self.get_values().items())]
+
+    def merge(self, shared: Iterable[list]) -> Dict[tuple, object]:
+        """
+        Values of this process merged with the dumped values of the other workers
+        """
+        values = dict(self.get_values())
+        for dumped in shared:
+            for labels, value in dumped or []:
+                labels = tuple(labels)
+                values[labels] = self.merge_value(values[labels], value) if labels in values else value
+        return values
+
+    def format_labels(self, values: tuple, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in pairs) + '}'
+
+    def render(self, shared: Iterable[list] = ()) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        for suffix, values, extra, value in self.collect(self.merge(shared)):
+            lines.append(f'{self.name}{suffix}{self.format_labels(values, extra)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get_values(self):
+        return self.values
+
+    def collect(self, values):
+        for labels, value in values.items():
+            yield '', labels, (), value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Callable[[], Dict[tuple, float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[tuple, float] = {}
+        self.function = function
+        # values collected on scrape instead of updated on the hot path
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, labels: tuple, value: float):
+        self.values[labels] = value
+
+    def get_values(self):
+        if not self.function:
+            return self.values
+        try:
+            return self.function()
+        except Exception as e:
+            print(f'collect metric: {self.name} failed with error: {e}')
+            return {}
+
+    def collect(self, values):
+        for labels, value in values.items():
+            yield '', labels, (), value
+
+
+class Histogram(Metric):
+    """
+    Fixed-bucket histogram, an observation is one bisect and 3 increments
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[tuple, list] = {}
+        # labels -> [count of each bucket (not cumulative)..., count of +Inf, sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def get_values(self):
+        return self.series
+
+    @classmethod
+    def merge_value(cls, value, other):
+        return [a + b for a, b in zip(value, other)]
+
+    def collect(self, values):
+        for labels, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                yield '_bucket', labels, (('le', format_value(float(bound))),), cumulative
+            yield '_sum', labels, (), series[-2]
+            yield '_count', labels, (), series[-1]
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = 'utilmeta_proxy', enabled: bool = env.METRICS):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.metrics: List[Metric] = []
+        self.shared: Optional[Callable[[], List[dict]]] = None
+        # the dumped metrics of the other worker processes, merged on scrape
+
+    def get_name(self, name: str) -> str:
+        return f'{self.prefix}_{name}' if self.prefix else name
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(self.get_name(name), documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+              function: Callable[[], Dict[tuple, float]] = None) -> Gauge:
+        return self.register(Gauge(self.get_name(name), documentation, labelnames, function=function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(self.get_name(name), documentation, labelnames, buckets=buckets))
+
+    def dump(self) -> dict:
+        return {metric.name: metric.dump() for metric in self.metrics}
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format (also accepted by OpenMetrics scrapers),
+        the metrics of all the workers are summed up if they are shared
+        """
+        shared = []
+        if self.shared:
+            try:
+                shared = self.shared()
+            except Exception as e:
+                print(f'load shared metrics failed with error: {e}')
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render([dumped.get(metric.name) for dumped in shared]))
+        return '\n'.join(lines) + '\n'
+
+
+active_requests: 'weakref.WeakKeyDictionary[object, str]' = weakref.WeakKeyDictionary()
+# request handler -> proxy type, a handler cancelled before finishing is dropped when collected
+
+
+def get_inflight() -> Dict[tuple, float]:
+    counts = {}
+    for proxy_type in list(active_requests.values()):
+        counts[(proxy_type,)] = counts.get((proxy_type,), 0) + 1
+    return counts
+
+
+def get_instance_label(instance) -> str:
+    if instance is None:
+        return ''
+    return instance.remote_id or str(instance.pk)
+
+
+def get_upstream_inflight() -> Dict[tuple, float]:
+    from utilmeta_proxy.domain.service.routing import routing_table
+    from .stats import instance_stats
+    instances = {}
+    for route in list(routing_table.services.values()):
+        instances.update(route.instances)
+    return {(get_instance_label(instances.get(pk)) or str(pk),): stats.inflight
+            for pk, stats in list(instance_stats.instances.items())}
+
+
+def get_tunnels() -> Dict[tuple, float]:
+    from .pool import tunnel_limiter
+    return {(): tunnel_limiter.active}
+
+
+def get_upstream_clients() -> Dict[tuple, float]:
+    from .pool import upstream_pool
+    return {(): len(upstream_pool.clients)}
+
+
+proxy_metrics = MetricsRegistry()
+
+REQUEST_LABELS = ('proxy_type', 'service', 'instance', 'status')
+requests_total = proxy_metrics.counter(
+    'requests_total', 'Proxied requests', REQUEST_LABELS)
+request_duration = proxy_metrics.histogram(
+    'request_duration_seconds', 'Proxied requests until the response headers', REQUEST_LABELS)
+upstream_duration = proxy_metrics.histogram(
+    'upstream_duration_seconds', 'Upstream attempts until the response headers', ('proxy_type', 'service', 'instance'))
+upstream_connect = proxy_metrics.histogram(
+    'upstream_connect_seconds', 'New upstream connections (TCP and TLS handshake)', ('proxy_type', 'service', 'instance'))
+retries_total = proxy_metrics.counter(
+    'retries_total', 'Retried upstream attempts', ('proxy_type', 'service'))
+lookup_duration = proxy_metrics.histogram(
+    'lookup_duration_seconds', 'Routing / supervisor / source lookups, including the database queries of cache misses',
+    ('lookup',))
+inflight_requests = proxy_metrics.gauge(
+    'inflight_requests', 'Proxied requests in progress', ('proxy_type',), function=get_inflight)
+upstream_inflight = proxy_metrics.gauge(
+    'upstream_inflight_requests', 'Upstream requests in progress by instance', ('instance',),
+    function=get_upstream_inflight)
+tunnels = proxy_metrics.gauge(
+    'tunnels', 'Open WebSocket tunnels and event streams', function=get_tunnels)
+upstream_clients = proxy_metrics.gauge(
+    'upstream_clients', 'Pooled upstream clients (one per origin)', function=get_upstream_clients)
+
+
+async def observe_lookup(lookup: str, awaitable: Awaitable, timings: Dict[str, float] = None):
+    """
+    :param timings: phase timings (ms) of the request, the lookup is added to the "route" phase
+    """
+    if not proxy_metrics.enabled and timings is None:
+        return await awaitable
+    started = perf_counter()
+    try:
+        return await awaitable
+    finally:
+        duration = perf_counter() - started
+        if proxy_metrics.enabled:
+            lookup_duration.observe((lookup,), duration)
+        if timings is not None:
+            timings['route'] = timings.get('route', 0) + duration * 1000
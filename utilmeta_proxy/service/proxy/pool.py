@@ -0,0 +1,358 @@
+import asyncio
+import time
+import httpx
+from urllib.parse import urlsplit
+from utilmeta.core import response
+from utilmeta.core.cli.base import is_timeout_error
+from utilmeta.core.response.backends.httpx import HttpxClientResponseAdaptor
+from utilmeta.utils import url_join, is_hop_by_hop, Headers
+from typing import Dict, Optional, Tuple
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Service
+
+try:
+    import h2
+except ImportError:     # pragma: no cover
+    h2 = None
+
+UNSET_CLIENT_HEADERS = ('accept', 'user-agent')
+# default headers of httpx that are not forwarded unless the client sends them
+
+
+def get_origin(base_url: str) -> str:
+    parsed = urlsplit(base_url)
+    return f'{parsed.scheme}://{parsed.netloc}'.lower()
+
+
+def is_http2_enabled(service: Optional[Service]) -> bool:
+    """
+    Enabled by "http2" in Service.data or Service.routes, default to the UPSTREAM_HTTP2 env,
+    the instances of the service should accept HTTP/2 with prior knowledge (h2c) on their plaintext port
+    """
+    config = None
+    if service:
+        config = (service.data or {}).get('http2')
+        if config is None and isinstance(service.routes, dict):
+            config = service.routes.get('http2')
+    if config is None:
+        config = env.UPSTREAM_HTTP2
+    return bool(config)
+
+
+def get_relay_headers(upstream: httpx.Response) -> Headers:
+    headers = Headers({})
+    for key, value in upstream.headers.items():
+        if is_hop_by_hop(key) or key.lower() == 'set-cookie':
+            continue
+        headers[key] = value
+    return headers
+
+
+def buffered_response(upstream: httpx.Response, body: bytes) -> response.Response:
+    """
+    Upstream response with the raw body (content-encoding untouched), like the StreamResponse
+    """
+    headers = get_relay_headers(upstream)
+    # the length of the relayed body is set by the server
+    headers.pop('content-length', None)
+    resp = response.Response(
+        status=upstream.status_code,
+        reason=upstream.reason_phrase,
+        headers=headers,
+        cookies=HttpxClientResponseAdaptor(upstream).cookies,
+        content=body,
+    )
+    resp.content_type = upstream.headers.get('content-type')
+    return resp
+
+
+async def read_response(upstream: httpx.Response) -> response.Response:
+    """
+    Read the raw body of the streamed upstream response, httpx does not decode it (br / zstd is not supported)
+    and the encoded body can be relayed as is
+    """
+    try:
+        body = b''.join([chunk async for chunk in upstream.aiter_raw()])
+    finally:
+        await upstream.aclose()
+    return buffered_response(upstream, body)
+
+
+class UpstreamTrace:
+    """
+    httpcore trace hook of an upstream request, measures the connect (TCP and TLS handshake)
+    if a new connection is opened for the request, and the time until the response headers are received
+    """
+    __slots__ = ('started', 'connect_started', 'connect_ms', 'headers_ms')
+    HEADERS_EVENTS = ('http11.receive_response_headers.complete', 'http2.receive_response_headers.complete')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.connect_started = None
+        self.connect_ms = None
+        self.headers_ms = None
+
+    async def __call__(self, event: str, info: dict):
+        if event == 'connection.connect_tcp.started':
+            self.connect_started = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            if self.connect_started is not None:
+                self.connect_ms = (time.perf_counter() - self.connect_started) * 1000
+        elif event in self.HEADERS_EVENTS:
+            self.headers_ms = (time.perf_counter() - self.started) * 1000
+
+
+class PooledClient:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.active = 0
+
+    def release(self):
+        self.active -= 1
+        self.last_used = time.monotonic()
+
+
+class StreamResponse(response.Response):
+    """
+    Upstream response relayed to the client chunk by chunk (raw bytes, content-encoding untouched),
+    the next chunk is only read from upstream after the previous one is sent
+    """
+    def __init__(self, upstream: httpx.Response, pooled: PooledClient = None,
+                 chunk_size: int = env.STREAM_CHUNK_SIZE):
+        self.upstream = upstream
+        self.pooled = pooled
+        self.chunk_size = chunk_size
+        self._released = False
+        self._tee = None
+        self._close_callbacks = []
+        self.encoder = None
+        # set by the compression stage, chunks are encoded after they are collected by tee
+
+        headers = get_relay_headers(upstream)
+        super().__init__(
+            status=upstream.status_code,
+            reason=upstream.reason_phrase,
+            headers=headers,
+            cookies=HttpxClientResponseAdaptor(upstream).cookies,
+            event_stream=self.iter_body(),
+        )
+        # event stream defaults that does not belong to the upstream response
+        self.content_type = upstream.headers.get('content-type')
+        if 'cache-control' not in upstream.headers:
+            self.headers.pop('cache-control', None)
+
+    @property
+    def is_event_stream(self) -> bool:
+        return str(self.upstream.headers.get('content-type') or '').lower().startswith('text/event-stream')
+
+    def on_close(self, callback):
+        self._close_callbacks.append(callback)
+
+    def tee(self, callback, max_size: int):
+        """
+        Also collect the relayed body (up to max_size), callback(body) is called if it's completely relayed
+        """
+        self._tee = (callback, max_size)
+
+    async def iter_body(self):
+        chunks = [] if self._tee else None
+        size = 0
+        try:
+            # events are relayed as soon as they arrive instead of filling up a chunk
+            async for chunk in self.upstream.aiter_raw(None if self.is_event_stream else self.chunk_size):
+                if chunks is not None:
+                    size += len(chunk)
+                    if size > self._tee[1]:
+                        chunks = None
+                    else:
+                        chunks.append(chunk)
+                if self.encoder:
+                    chunk = self.encoder.compress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if self.encoder:
+                chunk = self.encoder.flush()
+                if chunk:
+                    yield chunk
+            if chunks is not None:
+                self._tee[0](b''.join(chunks))
+        except Exception as e:
+            # status and headers are already sent, the client will receive a truncated body
+            print(f'relay upstream response: {self.upstream.url} failed with error: {e}')
+        finally:
+            await self.aclose()
+
+    async def aclose(self, fail_silently=True):
+        if self._released:
+            return
+        self._released = True
+        try:
+            await self.upstream.aclose()
+        finally:
+            if self.pooled:
+                self.pooled.release()
+            for callback in self._close_callbacks:
+                callback()
+
+
+class TunnelLimiter:
+    """
+    Bound of the long-lived connections (WebSocket tunnels and event streams),
+    each one holds an upstream connection for as long as the client keeps it open
+    """
+    def __init__(self, max_connections: int = env.TUNNEL_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self.active = 0
+
+    def acquire(self) -> bool:
+        if self.max_connections and self.active >= self.max_connections:
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active = max(self.active - 1, 0)
+
+
+class UpstreamPool:
+    """
+    Process-wide pool of keep-alive httpx clients, one per upstream origin (and protocol),
+    so that the instance base_url and ops_api (same netloc) share connections
+    and retries to the same host reuse the established sockets,
+    HTTP/2 clients multiplex the concurrent requests to a host over a few connections
+    """
+    SWEEP_INTERVAL = 30
+
+    def __init__(self,
+                 max_connections: int = env.UPSTREAM_MAX_CONNECTIONS,
+                 max_keepalive: int = env.UPSTREAM_MAX_KEEPALIVE,
+                 keepalive_expiry: float = env.UPSTREAM_KEEPALIVE_EXPIRY,
+                 idle_timeout: float = env.UPSTREAM_IDLE_TIMEOUT):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.idle_timeout = idle_timeout
+        self.clients: Dict[Tuple[str, bool], PooledClient] = {}
+        # (origin, http2) -> client
+        self._last_sweep = time.monotonic()
+        self._h2_missing = False
+
+    def create_client(self, origin: str, http2: bool = False) -> httpx.AsyncClient:
+        if http2 and origin.startswith('http://'):
+            # h2c: HTTP/2 with prior knowledge, the HTTP/1.1 upgrade is not supported by httpx
+            client = httpx.AsyncClient(
+                limits=self.limits,
+                follow_redirects=False,
+                http1=False,
+                http2=True,
+            )
+        else:
+            client = httpx.AsyncClient(
+                limits=self.limits,
+                follow_redirects=False,
+                # h2 over TLS is negotiated by ALPN, fallback to HTTP/1.1 if the server does not support it
+                http2=http2,
+            )
+        # httpx adds Accept, Accept-Encoding (gzip, deflate) and its User-Agent to every request,
+        # the upstream should see the headers of the client only, and send an uncompressed body
+        # unless the client accepts an encoding (the streamed body is relayed as it is)
+        for key in UNSET_CLIENT_HEADERS:
+            client.headers.pop(key, None)
+        client.headers['accept-encoding'] = 'identity'
+        return client
+
+    def get(self, base_url: str, http2: bool = False) -> PooledClient:
+        if http2 and h2 is None:
+            if not self._h2_missing:
+                print('h2 package is required for the HTTP/2 upstream connections '
+                      '(pip install "utilmeta-proxy[http2]"), using HTTP/1.1')
+                self._h2_missing = True
+            http2 = False
+        origin = get_origin(base_url)
+        key = (origin, bool(http2))
+        pooled = self.clients.get(key)
+        if not pooled or pooled.client.is_closed:
+            pooled = PooledClient(self.create_client(origin, http2=http2))
+            self.clients[key] = pooled
+        pooled.last_used = time.monotonic()
+        self.sweep()
+        return pooled
+
+    def sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for key, pooled in list(self.clients.items()):
+            if pooled.active:
+                continue
+            if now - pooled.last_used > self.idle_timeout:
+                self.clients.pop(key, None)
+                asyncio.ensure_future(pooled.client.aclose())
+
+    async def request(
+        self,
+        base_url: str,
+        method: str,
+        path: str = None,
+        query_string: str = None,
+        headers: dict = None,
+        content=None,
+        timeout: float = None,
+        stream: bool = False,
+        idle_timeout: float = None,
+        http2: bool = False,
+        trace: UpstreamTrace = None,
+    ) -> response.Response:
+        url = url_join(base_url, path) if path else base_url
+        if query_string:
+            url = f'{url}?{query_string}'
+        pooled = self.get(base_url, http2=http2)
+        pooled.active += 1
+        try:
+            request = pooled.client.build_request(
+                method=method,
+                url=url,
+                headers=headers,
+                content=content or None,
+                timeout=httpx.Timeout(float(timeout) if timeout else None, read=idle_timeout)
+                if idle_timeout else (float(timeout) if timeout else None),
+                extensions={'trace': trace} if trace else None,
+            )
+            # the raw body is read even if buffered, so that the upstream content-encoding is kept
+            resp = await pooled.client.send(request, stream=True)
+            if stream:
+                # connection is released when the body is relayed or the response is closed
+                return StreamResponse(resp, pooled=pooled)
+            resp = await read_response(resp)
+        except asyncio.CancelledError:
+            # cancelled by a winning hedged attempt or the caller
+            pooled.release()
+            raise
+        except Exception as e:
+            pooled.release()
+            # same as a fail_silently client
+            return response.Response(
+                error=e,
+                timeout=is_timeout_error(e),
+                aborted=True
+            )
+        pooled.release()
+        return resp
+
+    async def aclose(self):
+        clients = list(self.clients.values())
+        self.clients = {}
+        for pooled in clients:
+            try:
+                await pooled.client.aclose()
+            except Exception as e:
+                print(f'close upstream client failed with error: {e}')
+
+
+upstream_pool = UpstreamPool()
+tunnel_limiter = TunnelLimiter()
@@ -0,0 +1,67 @@
+import time
+from utilmeta_proxy.config.env import env
+
+
+class Deadline:
+    """
+    Overall deadline of a proxied request, split across the attempts
+    """
+    MIN_TIMEOUT = 0.05
+
+    def __init__(self, timeout: float, max_attempts: int = env.RETRY_MAX_ATTEMPTS):
+        self.timeout = float(timeout)
+        self.expires = time.monotonic() + self.timeout
+        self.max_attempts = max(1, max_attempts)
+
+    @property
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining < self.MIN_TIMEOUT
+
+    def get_timeout(self, attempts: int = 1) -> float:
+        """
+        Timeout of the current attempt if there may be <attempts> attempts left (including the current),
+        the last attempt takes all the remaining time
+        """
+        attempts = min(max(attempts, 1), self.max_attempts)
+        return max(self.remaining / attempts, self.MIN_TIMEOUT)
+
+
+class RetryBudget:
+    """
+    Process-wide token bucket of retries: every successful request deposits <ratio> token,
+    and the bucket is refilled by <min_per_second> so that retries are still allowed under low traffic,
+    every retry costs one token, so when the cluster is unhealthy retries are turned off
+    instead of multiplying the load
+    """
+    def __init__(self,
+                 ratio: float = env.RETRY_BUDGET_RATIO,
+                 min_per_second: float = env.RETRY_BUDGET_MIN_PER_SECOND,
+                 max_tokens: float = env.RETRY_BUDGET_MAX_TOKENS):
+        self.ratio = max(float(ratio), 0.0)
+        self.min_per_second = max(float(min_per_second), 0.0)
+        self.max_tokens = max(float(max_tokens), 1.0)
+        self.tokens = self.max_tokens
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.min_per_second:
+            self.tokens = min(self.tokens + (now - self.updated) * self.min_per_second, self.max_tokens)
+        self.updated = now
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self) -> bool:
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+retry_budget = RetryBudget()
@@ -0,0 +1,188 @@
+import asyncio
+import math
+import time
+from typing import Callable, Dict, List, Tuple
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Instance
+
+
+class InstanceStats:
+    """
+    Live statistics of an upstream instance observed by this proxy process
+    """
+    __slots__ = ('inflight', 'latency', 'updated', 'error_rate', 'observed',
+                 'seconds', 'counts', 'requests', 'duration', 'avg_time', 'avg_rps')
+    DECAY = 10.0
+    # seconds for a latency peak to decay
+    ERROR_ALPHA = 0.1
+    WINDOW = 10
+    # seconds of the sliding window to count rps
+
+    def __init__(self):
+        self.inflight = 0
+        self.latency = 0.0
+        # peak-sensitive EWMA of response time (ms)
+        self.updated = time.monotonic()
+        self.error_rate = 0.0
+        self.observed = False
+        self.seconds = [0] * self.WINDOW
+        self.counts = [0] * self.WINDOW
+        # requests and duration since the last flush
+        self.requests = 0
+        self.duration = 0.0
+        # values of the last flush
+        self.avg_time = 0.0
+        self.avg_rps = 0.0
+
+    def get_latency(self) -> float:
+        # decay towards 0 while not observed, so that an instance with a stale peak gets probed again
+        return self.latency * math.exp(-(time.monotonic() - self.updated) / self.DECAY)
+
+    @property
+    def rps(self) -> float:
+        second = int(time.monotonic())
+        return sum(count for sec, count in zip(self.seconds, self.counts)
+                   if second - sec < self.WINDOW) / self.WINDOW
+
+    def observe(self, duration_ms: float, error: bool = False):
+        now = time.monotonic()
+        if duration_ms > self.latency:
+            # react to latency peaks immediately, decay slowly
+            self.latency = duration_ms
+        else:
+            w = math.exp(-(now - self.updated) / self.DECAY)
+            self.latency = self.latency * w + duration_ms * (1 - w)
+        self.updated = now
+        self.error_rate += self.ERROR_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        self.observed = True
+
+        second = int(now)
+        index = second % self.WINDOW
+        if self.seconds[index] != second:
+            self.seconds[index] = second
+            self.counts[index] = 0
+        self.counts[index] += 1
+        self.requests += 1
+        self.duration += duration_ms
+
+
+class StatsRegistry:
+    """
+    The leader (the only worker by default) writes the stats of all the workers to database,
+    the other workers report their counts since the last flush to it by the listeners
+    """
+    def __init__(self, flush_interval: int = env.STATS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.instances: Dict[int, InstanceStats] = {}
+        self.flushed = time.monotonic()
+        self.leader = True
+        self.reported: Dict[int, List[float]] = {}
+        # (requests, duration) reported by the other workers since the last flush
+        self.listeners: List[Callable[[Dict[int, Tuple[int, float]]], None]] = []
+        # called with {pk: (requests, duration)} when a non-leader worker flushes
+        self._task = None
+
+    def get(self, pk: int) -> InstanceStats:
+        stats = self.instances.get(pk)
+        if stats is None:
+            stats = self.instances[pk] = InstanceStats()
+        return stats
+
+    def start(self, pk: int) -> float:
+        self.get(pk).inflight += 1
+        return time.monotonic()
+
+    def finish(self, pk: int, started: float, error: bool = False) -> float:
+        stats = self.get(pk)
+        stats.inflight = max(0, stats.inflight - 1)
+        duration_ms = (time.monotonic() - started) * 1000
+        stats.observe(duration_ms, error=error)
+        return duration_ms
+
+    def cancel(self, pk: int):
+        # cancelled attempt (like a hedged loser), not observed
+        stats = self.get(pk)
+        stats.inflight = max(0, stats.inflight - 1)
+
+    def collect(self) -> Dict[int, Tuple[int, float]]:
+        """
+        Take the requests and duration of this worker since the last flush
+        """
+        counts = {}
+        for pk, stats in list(self.instances.items()):
+            if stats.requests:
+                counts[pk] = (stats.requests, stats.duration)
+                stats.requests = 0
+                stats.duration = 0.0
+        return counts
+
+    def report(self, counts: Dict[int, Tuple[int, float]]):
+        """
+        Add the counts reported by another worker, aggregated by the next flush of the leader
+        """
+        if not self.leader:
+            return
+        for pk, (requests, duration) in counts.items():
+            total = self.reported.setdefault(int(pk), [0, 0.0])
+            total[0] += int(requests)
+            total[1] += float(duration)
+
+    def notify(self, counts: Dict[int, Tuple[int, float]]):
+        for listener in self.listeners:
+            try:
+                listener(counts)
+            except Exception as e:
+                print(f'instance stats listener failed with error: {e}')
+
+    async def flush(self):
+        """
+        Write the aggregated avg_time / avg_rps since the last flush to instances in one bulk update,
+        a non-leader worker reports its counts instead, so that avg_rps is the rate of all the workers
+        """
+        now = time.monotonic()
+        period = max(now - self.flushed, 1.0)
+        self.flushed = now
+        counts = self.collect()
+        reported, self.reported = self.reported, {}
+        if not self.leader:
+            if counts:
+                self.notify(counts)
+            return
+        for pk, (requests, duration) in reported.items():
+            local_requests, local_duration = counts.get(pk, (0, 0.0))
+            counts[pk] = (local_requests + requests, local_duration + duration)
+        updates = []
+        for pk in set(counts).union(pk for pk, stats in self.instances.items() if stats.avg_rps):
+            stats = self.get(pk)
+            requests, duration = counts.get(pk, (0, 0.0))
+            if requests:
+                stats.avg_time = round(duration / requests, 2)
+            stats.avg_rps = round(requests / period, 2)
+            updates.append(Instance(pk=pk, avg_time=stats.avg_time, avg_rps=stats.avg_rps))
+        if updates:
+            await Instance.objects.abulk_update(updates, fields=['avg_time', 'avg_rps'])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f'flush instance stats failed with error: {e}')
+
+    def start_flush(self):
+        if self._task or not self.flush_interval:
+            return
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop_flush(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f'flush instance stats failed with error: {e}')
+
+
+instance_stats = StatsRegistry()
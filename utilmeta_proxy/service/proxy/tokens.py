@@ -0,0 +1,75 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.supervisor import supervisor_cache
+
+
+class VerifiedToken:
+    __slots__ = ('claims', 'expires', 'supervisor')
+
+    def __init__(self, claims: dict, expires: float, supervisor=None):
+        self.claims = claims
+        self.expires = expires
+        self.supervisor = supervisor
+        # the resolved utilmeta.ops.models.Supervisor
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of the tokens that passed signature and claims verification,
+    keyed by the digest of the scope (cluster / node id) and token, expires at the "exp" of the token
+    """
+    def __init__(self, max_size: int = env.TOKEN_CACHE_SIZE, max_ttl: int = env.TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.tokens: 'OrderedDict[bytes, VerifiedToken]' = OrderedDict()
+
+    @classmethod
+    def get_key(cls, token: str, scope: str = None) -> bytes:
+        return hashlib.sha256(f'{scope or ""}:{token}'.encode()).digest()
+
+    def get(self, token: str, scope: str = None) -> Optional[VerifiedToken]:
+        if not self.max_size or not token:
+            return None
+        key = self.get_key(token, scope)
+        entry = self.tokens.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.time():
+            self.tokens.pop(key, None)
+            return None
+        self.tokens.move_to_end(key)
+        return entry
+
+    def set(self, token: str, claims: dict, scope: str = None, supervisor=None) -> Optional[VerifiedToken]:
+        if not self.max_size or not token:
+            return None
+        expires = time.time() + self.max_ttl
+        exp = claims.get('exp') if isinstance(claims, dict) else None
+        if isinstance(exp, (int, float)):
+            expires = min(expires, exp)
+        entry = VerifiedToken(claims, expires=expires, supervisor=supervisor)
+        key = self.get_key(token, scope)
+        self.tokens[key] = entry
+        self.tokens.move_to_end(key)
+        while len(self.tokens) > self.max_size:
+            self.tokens.popitem(last=False)
+        return entry
+
+    def invalidate(self, node_id: str = None):
+        """
+        Drop the tokens resolved to supervisor of the node id, or all the tokens
+        """
+        if node_id is None:
+            self.tokens.clear()
+            return
+        for key, entry in list(self.tokens.items()):
+            if entry.supervisor is not None and getattr(entry.supervisor, 'node_id', None) == node_id:
+                self.tokens.pop(key, None)
+
+
+token_cache = TokenCache()
+# tokens that resolved the changed supervisor should resolve it again
+supervisor_cache.listeners.append(token_cache.invalidate)
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy import __version__
+
+TRACEPARENT_PATTERN = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+INVALID_TRACE_ID = '0' * 32
+INVALID_SPAN_ID = '0' * 16
+SAMPLED_FLAG = 0x01
+MAX_TRACESTATE_LENGTH = 512
+# OTLP span kind / status code
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+
+def generate_trace_id() -> str:
+    return f'{random.getrandbits(128) or 1:032x}'
+
+
+def generate_span_id() -> str:
+    return f'{random.getrandbits(64) or 1:016x}'
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str, int]]:
+    """
+    W3C traceparent header -> (trace id, parent span id, trace flags), None if absent or invalid
+    """
+    if not value:
+        return None
+    match = TRACEPARENT_PATTERN.match(str(value).strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    if version == 'ff' or (version == '00' and rest):
+        # ff is forbidden, the fields after the flags are only allowed for the future versions
+        return None
+    if trace_id == INVALID_TRACE_ID or span_id == INVALID_SPAN_ID:
+        return None
+    return trace_id, span_id, int(flags, 16)
+
+
+def format_traceparent(trace_id: str, span_id: str, sampled: bool) -> str:
+    return f'00-{trace_id}-{span_id}-{SAMPLED_FLAG if sampled else 0:02x}'
+
+
+def encode_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def encode_attributes(attributes: dict) -> List[dict]:
+    return [{'key': key, 'value': encode_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """
+    A finished span is handed to the tracer to export, nothing is sent on the request path
+    """
+    __slots__ = ('tracer', 'name', 'kind', 'trace_id', 'span_id', 'parent_id', 'sampled', 'tracestate',
+                 'start_time', 'end_time', 'attributes', 'status', 'status_message')
+
+    def __init__(self, tracer: 'Tracer', name: str, kind: int, trace_id: str, parent_id: Optional[str],
+                 sampled: bool, tracestate: Optional[str] = None, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = generate_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.tracestate = tracestate
+        self.start_time = time.time_ns()
+        self.end_time = None
+        self.attributes = attributes or {}
+        self.status = STATUS_UNSET
+        self.status_message = None
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self.trace_id, self.span_id, self.sampled)
+
+    def child(self, name: str, kind: int = SPAN_KIND_CLIENT, attributes: dict = None) -> 'Span':
+        return Span(self.tracer, name, kind, self.trace_id, self.span_id, self.sampled,
+                    tracestate=self.tracestate, attributes=attributes)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message: str = None):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def end(self):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if self.sampled:
+            self.tracer.add(self)
+
+    def to_otlp(self) -> dict:
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time or self.start_time),
+            'attributes': encode_attributes(self.attributes),
+            'status': {'code': self.status},
+        }
+        if self.parent_id:
+            data['parentSpanId'] = self.parent_id
+        if self.tracestate:
+            data['traceState'] = self.tracestate
+        if self.status_message:
+            data['status']['message'] = self.status_message
+        return data
+
+
+class FileExporter:
+    """
+    Append each batch as one line of OTLP JSON (ExportTraceServiceRequest) to the file, for offline testing
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, line: str):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    async def export(self, payload: dict):
+        # file I/O in the default executor, keep it off the event loop
+        await asyncio.get_event_loop().run_in_executor(None, self.write, json.dumps(payload, separators=(',', ':')))
+
+    async def aclose(self):
+        pass
+
+
+class OTLPExporter:
+    """
+    OTLP/HTTP with JSON encoding to the collector endpoint (like http://127.0.0.1:4318/v1/traces)
+    """
+    def __init__(self, endpoint: str, timeout: float = env.TRACING_EXPORT_TIMEOUT):
+        import httpx
+        if not endpoint.rstrip('/').endswith('/v1/traces'):
+            endpoint = endpoint.rstrip('/') + '/v1/traces'
+        self.endpoint = endpoint
+        self.client = httpx.AsyncClient(timeout=timeout)
+
+    async def export(self, payload: dict):
+        resp = await self.client.post(self.endpoint, json=payload)
+        if resp.status_code >= 400:
+            raise ValueError(f'collector responded {resp.status_code}: {resp.text[:200]}')
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class Tracer:
+    """
+    Spans of the proxied requests, exported in batches by a background task.
+    The queue is bounded, finished spans are dropped instead of blocking when the exporter falls behind
+    """
+    def __init__(self,
+                 enabled: bool = env.TRACING,
+                 sample: float = env.TRACING_SAMPLE,
+                 queue_size: int = env.TRACING_QUEUE_SIZE,
+                 batch_size: int = env.TRACING_BATCH_SIZE,
+                 export_interval: float = env.TRACING_EXPORT_INTERVAL):
+        self.enabled = enabled
+        self.sample = sample
+        self.queue_size = queue_size
+        self.batch_size = max(1, batch_size)
+        self.export_interval = export_interval
+        self.queue: Deque[Span] = deque()
+        self.dropped = 0
+        self.exporter = None
+        self._event: Optional[asyncio.Event] = None
+        self._task = None
+
+    @property
+    def active(self) -> bool:
+        """
+        Spans are created and propagated only when they are exported,
+        otherwise the traceparent / tracestate of the client are forwarded unchanged
+        """
+        return self._task is not None
+
+    def get_exporter(self):
+        if env.TRACING_EXPORTER == 'file':
+            return FileExporter(env.TRACING_FILE or os.path.join(os.getcwd(), 'traces.jsonl'))
+        if env.TRACING_EXPORTER == 'otlp':
+            if not env.TRACING_ENDPOINT:
+                print('tracing: TRACING_ENDPOINT is required for the otlp exporter, spans will not be exported')
+                return None
+            return OTLPExporter(env.TRACING_ENDPOINT)
+        return None
+
+    def start_span(self, name: str, traceparent: str = None, tracestate: str = None,
+                   attributes: dict = None) -> Optional[Span]:
+        """
+        Continue the trace of the incoming traceparent (following its sampled flag),
+        or start a new trace sampled by the ratio
+        """
+        if not self.active:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, flags = parent
+            sampled = bool(flags & SAMPLED_FLAG)
+        else:
+            trace_id, parent_id = generate_trace_id(), None
+            sampled = self.sample >= 1 or random.random() < self.sample
+            # the tracestate is meaningless without a valid traceparent
+            tracestate = None
+        if tracestate and len(tracestate) > MAX_TRACESTATE_LENGTH:
+            tracestate = None
+        return Span(self, name, SPAN_KIND_SERVER, trace_id, parent_id, sampled,
+                    tracestate=tracestate, attributes=attributes)
+
+    def add(self, span: Span):
+        if self._task is None:
+            # not exporting (exporter not configured or not started)
+            return
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append(span)
+        if len(self.queue) >= self.batch_size and self._event:
+            self._event.set()
+
+    def make_payload(self, spans: List[Span]) -> dict:
+        resource = {
+            'service.name': 'utilmeta-proxy',
+            'service.version': __version__,
+            'service.instance.id': env.BASE_URL,
+        }
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': encode_attributes(resource)},
+                'scopeSpans': [{
+                    'scope': {'name': 'utilmeta_proxy', 'version': __version__},
+                    'spans': [span.to_otlp() for span in spans],
+                }],
+            }]
+        }
+
+    async def flush(self):
+        while self.queue and self.exporter:
+            spans = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            try:
+                await self.exporter.export(self.make_payload(spans))
+            except Exception as e:
+                # a failed batch is dropped, retrying would let the queue grow behind a dead collector
+                self.dropped += len(spans)
+                print(f'tracing: export {len(spans)} spans failed with error: {e}')
+                return
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout=self.export_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            await self.flush()
+
+    def start(self):
+        if not self.enabled or self._task:
+            return
+        self.exporter = self.get_exporter()
+        if self.exporter is None:
+            return
+        self._event = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        self._task = None
+        await self.flush()
+        self.queue.clear()
+        await self.exporter.aclose()
+        self.exporter = None
+
+
+tracer = Tracer()
@@ -0,0 +1,248 @@
+import asyncio
+import time
+from ipaddress import ip_address
+from typing import List, Optional, Tuple
+from starlette.responses import JSONResponse
+from starlette.routing import WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from utilmeta.core import response
+from utilmeta.utils import exceptions, url_join, Headers
+from utilmeta_proxy.config.env import env
+from utilmeta_proxy.domain.service.models import Instance
+from utilmeta_proxy.domain.service.routing import routing_table
+from utilmeta_proxy.service.proxy.api import ProxyAPI, forward_header, stamp_source, select_instances, \
+    rank_instances
+from utilmeta_proxy.service.proxy.pool import tunnel_limiter
+from utilmeta_proxy.service.proxy.stats import instance_stats
+from utilmeta_proxy.service.proxy.breaker import instance_breakers
+from utilmeta_proxy.service.proxy.retry import Deadline
+
+try:
+    from websockets.asyncio.client import connect, ClientConnection
+    from websockets.exceptions import ConnectionClosed, InvalidStatus
+except ImportError:     # pragma: no cover
+    connect = ClientConnection = ConnectionClosed = InvalidStatus = None
+
+HANDSHAKE_HEADERS = (
+    'host',
+    'sec-websocket-key',
+    'sec-websocket-version',
+    'sec-websocket-extensions',
+    'sec-websocket-protocol',
+    'sec-websocket-accept',
+)
+# close codes that can not be sent in a close frame
+RESERVED_CLOSE_CODES = (1005, 1006, 1015)
+
+
+def get_header(headers, *names: str) -> Optional[str]:
+    for name in names:
+        value = headers.get(name)
+        if value:
+            return value
+    return None
+
+
+def get_websocket_url(base_url: str, path: str = None, query_string: str = None) -> str:
+    url = url_join(base_url, path) if path else base_url
+    if url.startswith('https://'):
+        url = 'wss://' + url[len('https://'):]
+    elif url.startswith('http://'):
+        url = 'ws://' + url[len('http://'):]
+    if query_string:
+        url = f'{url}?{query_string}'
+    return url
+
+
+class WebSocketTunnel:
+    """
+    Tunnel the WebSocket connection of a discovery request to an instance of the service,
+    with the same routing / source stamping as the ProxyAPI, frames are piped both ways until either side closes
+    """
+    def __init__(self, idle_timeout: float = env.TUNNEL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+
+    @classmethod
+    async def deny(cls, websocket: WebSocket, error: Exception):
+        status = getattr(error, 'status', None) or 500
+        if 'websocket.http.response' in websocket.scope.get('extensions', {}):
+            await websocket.send_denial_response(JSONResponse({'error': str(error)}, status_code=status))
+        else:
+            # the server will respond 403 for the handshake
+            await websocket.close(code=1013 if status == 503 else 1008, reason=str(error)[:120])
+
+    async def handle(self, websocket: WebSocket):
+        if connect is None:
+            await self.deny(websocket, exceptions.ServiceUnavailable(
+                'websockets package is required for tunneling: pip install "utilmeta-proxy[websocket]"'))
+            return
+        headers = websocket.headers
+        proxy_type = get_header(headers, 'x-utilmeta-proxy-type', 'x-proxy-type')
+        service_name = get_header(headers, 'x-utilmeta-service-name', 'x-service-name')
+        forwarded = Headers({k: v for k, v in headers.items()
+                             if forward_header(k) and k.lower() not in HANDSHAKE_HEADERS})
+        try:
+            if proxy_type != 'discovery' or not service_name:
+                raise exceptions.NotFound
+            address = ip_address(websocket.client.host) if websocket.client else None
+            if address is None:
+                raise exceptions.NotFound
+            await stamp_source(address, forwarded)
+            route = await routing_table.get(service_name)
+            if not route:
+                raise exceptions.NotFound
+            instances = rank_instances(route.service, select_instances(
+                route,
+                instance_id=get_header(headers, 'x-utilmeta-instance-id', 'x-instance-id'),
+                accept_version=get_header(headers, 'x-utilmeta-accept-version', 'x-accept-version'),
+            ))
+        except (exceptions.HttpError, ValueError) as e:
+            await self.deny(websocket, e)
+            return
+
+        if not tunnel_limiter.acquire():
+            await self.deny(websocket, exceptions.ServiceUnavailable('Too many tunnel connections'))
+            return
+        try:
+            await self.tunnel(websocket, instances, forwarded)
+        finally:
+            tunnel_limiter.release()
+
+    async def connect_upstream(self, websocket: WebSocket, instances: List[Instance], headers: Headers) \
+            -> Tuple[Optional['ClientConnection'], Optional[Instance]]:
+        timeout = get_header(websocket.headers, 'x-utilmeta-request-timeout', 'x-request-timeout')
+        try:
+            deadline = Deadline(float(timeout) if timeout else env.DEFAULT_TIMEOUT)
+        except ValueError:
+            deadline = Deadline(env.DEFAULT_TIMEOUT)
+        path = websocket.path_params.get('path')
+        query_string = websocket.scope.get('query_string', b'').decode('latin-1')
+        attempts = 0
+        for instance in instances:
+            if attempts >= deadline.max_attempts or deadline.expired:
+                break
+            if not instance_breakers.acquire(instance.pk):
+                continue
+            attempts += 1
+            url = get_websocket_url(instance.base_url, path, query_string)
+            started = instance_stats.start(instance.pk)
+            try:
+                upstream = await connect(
+                    url,
+                    additional_headers=list(headers.items()),
+                    subprotocols=websocket.scope.get('subprotocols') or None,
+                    open_timeout=deadline.get_timeout(len(instances) - attempts + 1),
+                    max_size=None,
+                    compression=None,
+                )
+            except asyncio.CancelledError:
+                instance_stats.cancel(instance.pk)
+                instance_breakers.release(instance.pk)
+                raise
+            except Exception as e:
+                print(f'connect websocket: {url} failed with error: {e}')
+                resp = None
+                if InvalidStatus and isinstance(e, InvalidStatus):
+                    resp = response.Response(status=e.response.status_code)
+                duration_ms = instance_stats.finish(instance.pk, started, error=True)
+                instance_breakers.record(instance.pk, resp, duration_ms)
+                continue
+            duration_ms = instance_stats.finish(instance.pk, started, error=False)
+            # the handshake response
+            instance_breakers.record(instance.pk, response.Response(status=101), duration_ms)
+            return upstream, instance
+        return None, None
+
+    async def tunnel(self, websocket: WebSocket, instances: List[Instance], headers: Headers):
+        upstream, instance = await self.connect_upstream(websocket, instances, headers)
+        if upstream is None:
+            await self.deny(websocket, exceptions.ServiceUnavailable('Upstream WebSocket connection failed'))
+            return
+        # the tunnel holds a connection to the instance, count it for the load balancing
+        instance_stats.start(instance.pk)
+        try:
+            await websocket.accept(subprotocol=upstream.subprotocol)
+            activity = [time.monotonic()]
+            # last message time of either direction
+            client_task = asyncio.ensure_future(self.pipe_client(websocket, upstream, activity))
+            upstream_task = asyncio.ensure_future(self.pipe_upstream(websocket, upstream, activity))
+            done, pending = await asyncio.wait([client_task, upstream_task], return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in pending:
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+            for task in done:
+                if not task.cancelled() and task.exception():
+                    print(f'websocket tunnel to {instance.base_url} failed with error: {task.exception()}')
+        finally:
+            instance_stats.cancel(instance.pk)
+            await upstream.close()
+            try:
+                await websocket.close()
+            except RuntimeError:
+                # already closed
+                pass
+
+    def is_idle(self, activity: List[float]) -> bool:
+        return bool(self.idle_timeout) and time.monotonic() - activity[0] >= self.idle_timeout
+
+    async def pipe_client(self, websocket: WebSocket, upstream: 'ClientConnection', activity: List[float]):
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.receive(), timeout=self.idle_timeout or None)
+            except asyncio.TimeoutError:
+                if not self.is_idle(activity):
+                    continue
+                await upstream.close(code=1001, reason='idle timeout')
+                return
+            activity[0] = time.monotonic()
+            if message['type'] == 'websocket.disconnect':
+                code = message.get('code') or 1000
+                await upstream.close(code=1000 if code in RESERVED_CLOSE_CODES else code)
+                return
+            if message.get('bytes') is not None:
+                await upstream.send(message['bytes'])
+            elif message.get('text') is not None:
+                await upstream.send(message['text'])
+
+    async def pipe_upstream(self, websocket: WebSocket, upstream: 'ClientConnection', activity: List[float]):
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(upstream.recv(), timeout=self.idle_timeout or None)
+                except asyncio.TimeoutError:
+                    if not self.is_idle(activity):
+                        continue
+                    await websocket.close(code=1001, reason='idle timeout')
+                    return
+                activity[0] = time.monotonic()
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+        except ConnectionClosed as e:
+            code = e.rcvd.code if e.rcvd else 1000
+            try:
+                await websocket.close(code=1000 if code in RESERVED_CLOSE_CODES else code,
+                                      reason=e.rcvd.reason if e.rcvd else None)
+            except (RuntimeError, WebSocketDisconnect):
+                pass
+
+
+websocket_tunnel = WebSocketTunnel()
+
+
+def get_websocket_routes(root_url: str) -> List[WebSocketRoute]:
+    """
+    Routes of the tunnel at the same path as the ProxyAPI, mounted under the root API at root_url
+    """
+    from utilmeta_proxy.service.api import RootAPI
+    route = next(r.route for r in RootAPI._routes if r.handler is ProxyAPI)
+    path = '/' + '/'.join(part.strip('/') for part in (root_url, route) if part.strip('/'))
+    return [
+        WebSocketRoute(path, websocket_tunnel.handle),
+        WebSocketRoute(path + '/{path:path}', websocket_tunnel.handle),
+    ]
@@ -0,0 +1,447 @@
+import asyncio
+import json
+import os
+import socket
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Type
+from django.db import models
+from utilmeta_proxy.config.env import env
+
+try:
+    import fcntl
+except ImportError:     # pragma: no cover
+    fcntl = None
+
+
+# fields that are not needed by the routing of other workers, left deferred (loaded on access) there
+DEFERRED_FIELDS = ('resources',)
+
+
+def get_state_dir() -> str:
+    if env.WORKER_STATE_DIR:
+        return env.WORKER_STATE_DIR
+    from utilmeta_proxy.config.service import port
+    # the proxies on different ports of the host do not share the state
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, f'utilmeta-proxy-{port}')
+    uid = os.getuid() if hasattr(os, 'getuid') else os.getpid()
+    return os.path.join(tempfile.gettempdir(), f'utilmeta-proxy-{uid}-{port}')
+
+
+def check_state_dir(directory: str):
+    """
+    Any process that can write to the directory can send messages to the workers or take the leader lock,
+    so it must be a real directory owned by the current user and not accessible by the others
+    """
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f'worker state dir: {repr(directory)} is not a directory')
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        raise PermissionError(f'worker state dir: {repr(directory)} is owned by uid {st.st_uid}, '
+                              f'not the current user ({os.getuid()})')
+    if st.st_mode & 0o077:
+        raise PermissionError(f'worker state dir: {repr(directory)} is accessible by other users '
+                              f'(mode {oct(stat.S_IMODE(st.st_mode))}), 0o700 is required')
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # Decimal / UUID, restored by the field to_python
+    return str(value)
+
+
+def dump_model(obj: models.Model) -> dict:
+    return {
+        field.attname: getattr(obj, field.attname) for field in obj._meta.concrete_fields
+        if field.attname not in DEFERRED_FIELDS and field.attname in obj.__dict__
+    }
+
+
+def load_model(model: Type[models.Model], data: dict) -> models.Model:
+    fields = [field for field in model._meta.concrete_fields if field.attname in data]
+    return model.from_db(None, [f.attname for f in fields], [f.to_python(data[f.attname]) for f in fields])
+
+
+class WorkerBus:
+    """
+    Local IPC channel between the worker processes of the proxy on this host:
+    each worker binds a unix datagram socket in the private state directory, a published change (JSON)
+    is sent to the sockets of all the other workers and applied by their subscribers without querying database,
+    the delivery is best-effort, every worker still reconciles its routing table with database periodically.
+    A worker holding the leader lock (flock) runs the host-wide tasks (health checks, connect),
+    if the leader exits, the lock is taken over by another worker
+    """
+    PEERS_REFRESH = 2
+    LEADER_RETRY = 5
+    MAX_MESSAGE_SIZE = 256 * 1024
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self.path = None
+        self.sock: Optional[socket.socket] = None
+        self.handlers: Dict[str, List[Callable]] = {}
+        self.leader_callbacks: List[Callable] = []
+        self.leader = False
+        self.applying = False
+        # applying a change of other worker, the change should not be published again
+        self._peers: List[str] = []
+        self._peers_loaded = 0.0
+        self._lock_file = None
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sock is not None
+
+    def subscribe(self, topic: str, handler: Callable):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def on_leader(self, callback: Callable):
+        """
+        Called when this worker become the leader of the host
+        """
+        self.leader_callbacks.append(callback)
+
+    def encode(self, topic: str, args: tuple) -> Optional[bytes]:
+        try:
+            data = json.dumps([topic, args], default=encode_value, separators=(',', ':')).encode()
+        except Exception as e:
+            print(f'worker bus: serialize {topic} failed with error: {e}')
+            return None
+        if len(data) > self.MAX_MESSAGE_SIZE:
+            print(f'worker bus: {topic} message exceed the max size: {len(data)}, ignored')
+            return None
+        return data
+
+    def publish(self, topic: str, *args):
+        if not self.sock or self.applying:
+            return
+        data = self.encode(topic, args)
+        if data is None:
+            return
+        for peer in self.get_peers():
+            self.sendto(data, peer, topic)
+
+    def send(self, peer: str, topic: str, *args):
+        """
+        Send to one worker (like a reply to its message), sent while applying a change
+        """
+        if not self.sock or not self.is_peer(peer):
+            return
+        data = self.encode(topic, args)
+        if data is not None:
+            self.sendto(data, peer, topic)
+
+    def sendto(self, data: bytes, peer: str, topic: str):
+        try:
+            self.sock.sendto(data, peer)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # the worker exited
+            self.remove_peer(peer)
+        except (BlockingIOError, OSError) as e:
+            print(f'worker bus: send {topic} to {peer} failed with error: {e}')
+
+    def is_peer(self, path) -> bool:
+        if not isinstance(path, str) or path == self.path:
+            return False
+        name = os.path.basename(path)
+        return os.path.dirname(path) == self.directory and name.startswith('worker-') and name.endswith('.sock')
+
+    def get_peers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peers_loaded < self.PEERS_REFRESH:
+            return self._peers
+        self._peers_loaded = now
+        try:
+            self._peers = [
+                os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith('worker-') and name.endswith('.sock')
+                and os.path.join(self.directory, name) != self.path
+            ]
+        except OSError:
+            self._peers = []
+        return self._peers
+
+    def remove_peer(self, peer: str):
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.remove(peer)
+        except OSError:
+            pass
+
+    def receive(self):
+        while True:
+            try:
+                data = self.sock.recv(self.MAX_MESSAGE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f'worker bus: receive failed with error: {e}')
+                return
+            try:
+                topic, args = json.loads(data)
+                if not isinstance(topic, str) or not isinstance(args, list):
+                    raise ValueError('[topic, args] expected')
+            except Exception as e:
+                print(f'worker bus: invalid message: {e}')
+                continue
+            self.applying = True
+            try:
+                for handler in self.handlers.get(topic, []):
+                    try:
+                        handler(*args)
+                    except Exception as e:
+                        print(f'worker bus: handle {topic} failed with error: {e}')
+            finally:
+                self.applying = False
+
+    def elect(self) -> bool:
+        if self.leader:
+            return True
+        if fcntl is None:
+            # no cross-process lock on this platform, every worker runs the host-wide tasks
+            self.leader = True
+        else:
+            if self._lock_file is None:
+                self._lock_file = open(os.path.join(self.directory, 'leader.lock'), 'a+')
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            self.leader = True
+            self._lock_file.seek(0)
+            self._lock_file.truncate()
+            self._lock_file.write(str(os.getpid()))
+            self._lock_file.flush()
+        print(f'worker [{os.getpid()}] is the leader of the proxy workers')
+        for callback in self.leader_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f'worker bus: leader callback {callback} failed with error: {e}')
+        return True
+
+    @contextmanager
+    def lock(self, name: str):
+        """
+        Exclusive lock of the name across the workers of the host, it blocks, so acquire it in a thread
+        """
+        if fcntl is None or not self.directory:
+            yield
+            return
+        with open(os.path.join(self.directory, f'{name}.lock'), 'a+') as file:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            # closing the file releases the flock
+            yield
+
+    async def run_election(self):
+        while not self.elect():
+            await asyncio.sleep(self.LEADER_RETRY)
+        self._task = None
+
+    def start(self):
+        if self.sock is not None:
+            return
+        self.directory = self.directory or get_state_dir()
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # refuse to start on a directory created by another user
+        check_state_dir(self.directory)
+        if hasattr(socket, 'AF_UNIX'):
+            self.directory = os.path.abspath(self.directory)
+            self.path = os.path.join(self.directory, f'worker-{os.getpid()}.sock')
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.path)
+            sock.setblocking(False)
+            asyncio.get_event_loop().add_reader(sock.fileno(), self.receive)
+            self.sock = sock
+            # a new or restarted worker asks the leader for the current shared state
+            self.publish('join', self.path)
+        if not self.elect():
+            self._task = asyncio.ensure_future(self.run_election())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self.sock is not None:
+            try:
+                asyncio.get_event_loop().remove_reader(self.sock.fileno())
+            except Exception:
+                pass
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        if self._lock_file is not None:
+            # closing the file releases the flock
+            self._lock_file.close()
+            self._lock_file = None
+        self.leader = False
+
+
+worker_bus = WorkerBus()
+
+
+class MetricsShare:
+    """
+    The scrapes of the metrics land on any worker, so every worker dumps its metrics to the state dir
+    periodically, and the worker serving a scrape sums up its own metrics and the dumps of the other live workers
+    (at most one interval behind), the dump of an exited worker is dropped like a restart of a single process
+    """
+    PREFIX = 'metrics-'
+
+    def __init__(self, bus: WorkerBus = worker_bus, interval: float = env.METRICS_SHARE_INTERVAL):
+        self.bus = bus
+        self.interval = interval
+        self._task = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bus.directory, f'{self.PREFIX}{os.getpid()}.json')
+
+    def write(self):
+        from utilmeta_proxy.service.proxy.metrics import proxy_metrics
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w') as file:
+            json.dump(proxy_metrics.dump(), file, default=encode_value)
+        os.replace(temp, self.path)
+
+    def read(self) -> List[dict]:
+        shared = []
+        for name in os.listdir(self.bus.directory):
+            if not name.startswith(self.PREFIX) or not name.endswith('.json'):
+                continue
+            pid = name[len(self.PREFIX):-len('.json')]
+            if pid == str(os.getpid()):
+                continue
+            path = os.path.join(self.bus.directory, name)
+            if not os.path.exists(os.path.join(self.bus.directory, f'worker-{pid}.sock')):
+                # the worker is exited
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as file:
+                    shared.append(json.load(file))
+            except (OSError, ValueError) as e:
+                print(f'read metrics of worker [{pid}] failed with error: {e}')
+        return shared
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.write()
+            except Exception as e:
+                print(f'dump worker metrics failed with error: {e}')
+
+    def start(self):
+        from utilmeta_proxy.service.proxy.metrics import proxy_metrics
+        if self._task or not self.interval or not proxy_metrics.enabled or env.WORKERS <= 1:
+            return
+        if not self.bus.enabled:
+            return
+        proxy_metrics.shared = self.read
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if not self._task:
+            return
+        self._task.cancel()
+        self._task = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+metrics_share = MetricsShare()
+
+
+def share_state(bus: WorkerBus = worker_bus):
+    """
+    Publish the changes of the routing table, health status, circuit breakers and supervisors
+    to the other workers, and apply theirs. The leader sends the ejected instances and open circuits
+    to a joining worker, and aggregates the instance stats reported by the workers.
+    Verified tokens are not shared, each worker verifies a token before caching it,
+    the supervisor invalidations drop the cached tokens of the supervisor in every worker
+    """
+    from utilmeta_proxy.domain.service.models import Service, Instance
+    from utilmeta_proxy.domain.service.routing import routing_table
+    from utilmeta_proxy.domain.service.supervisor import supervisor_cache
+    from utilmeta_proxy.service.proxy.health import health_checker
+    from utilmeta_proxy.service.proxy.breaker import instance_breakers
+    from utilmeta_proxy.service.proxy.stats import instance_stats
+    from utilmeta_proxy.domain.service.sync import supervisor_sync
+
+    routing_table.listeners.append(
+        lambda change, obj, *args: bus.publish('routing', change, dump_model(obj), *args))
+    health_checker.listeners.append(lambda pk, ejected: bus.publish('health', pk, ejected))
+    instance_breakers.listeners.append(lambda *args: bus.publish('breaker', *args))
+    supervisor_cache.listeners.append(lambda node_id: bus.publish('supervisor', node_id))
+    instance_stats.listeners.append(lambda counts: bus.publish('stats', counts))
+    # only the leader writes the stats to database
+    instance_stats.leader = False
+    bus.on_leader(lambda: setattr(instance_stats, 'leader', True))
+    # the registrations of a service can arrive at several workers, it's connected / synced by one at a time
+    supervisor_sync.lock = lambda service_id: bus.lock(f'sync-{service_id}')
+
+    def apply_routing(change: str, data: dict, *args):
+        if change == 'service':
+            routing_table.update_service(load_model(Service, data), *args)
+        elif change == 'instance':
+            routing_table.update_instance(load_model(Instance, data))
+        elif change == 'remove':
+            routing_table.remove_instance(load_model(Instance, data))
+
+    def send_snapshot(path: str):
+        if not bus.leader:
+            return
+        bus.send(path, 'snapshot', sorted(health_checker.ejected), instance_breakers.snapshot())
+
+    def apply_snapshot(ejected: list, breakers: list):
+        for pk in ejected:
+            health_checker.set_ejected(pk, True)
+        for args in breakers:
+            instance_breakers.set_state(*args)
+
+    bus.subscribe('routing', apply_routing)
+    bus.subscribe('join', send_snapshot)
+    bus.subscribe('snapshot', apply_snapshot)
+    bus.subscribe('stats', instance_stats.report)
+    bus.subscribe('health', health_checker.set_ejected)
+    bus.subscribe('breaker', instance_breakers.set_state)
+    bus.subscribe('supervisor', supervisor_cache.invalidate)
+
+
+def run_workers(service, workers: int = env.WORKERS):
+    """
+    Run the proxy in multiple worker processes (uvicorn workers) to use all the cores
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise ImportError('uvicorn package is required to run multiple workers: '
+                          'pip install "utilmeta-proxy[workers]"')
+    service.resolve_port()
+    service.print_info()
+    service.write_pid()
+    uvicorn.run(
+        'utilmeta_proxy.main:app',
+        host=service.host or '127.0.0.1',
+        port=service.port,
+        workers=workers,
+    )